@@ -1,82 +1,327 @@
-import os
-import datetime
+import tempfile
+import functools
 import pandas as pd
-from sqlalchemy import create_engine, Column, Integer, String, Text
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import func
 import streamlit as st
 
-# ====== CONFIGURAÇÕES INICIAIS ======
-db_path = "database.db"
-engine = create_engine(f"sqlite:///{db_path}")
-Base = declarative_base()
+from nfse_parser import extract_xmls_from_zip
+from nfse_fila import criar_lote, executar_trabalhador, situacao_lote, lotes_incompletos, arquivos_em_quarentena
+from nfse_db import (
+    NFSe, NFSeCampos, session_scope, descomprimir_xml, contar_sem_campos, preencher_campos_pendentes,
+    numeros_duplicados, lacunas_sequencia, buscar_notas, resumo_numeracao, lacunas_abertas, numeros_repetidos,
+    numeros_cancelados, anos_arquivaveis, anos_arquivados, arquivar_ano, exportar_xmls_zip, listar_clientes,
+)
 
-# Modelo/Table: NFSe
-class NFSe(Base):
-    __tablename__ = "nfses"
-    id = Column(Integer, primary_key=True)
-    cliente = Column(String(255), nullable=False)
-    data_envio = Column(String(50), nullable=False)
-    arquivo_xml = Column(Text, nullable=False)  # XML salvo como texto puro
+# ====== CONFIGURAÇÕES INICIAIS ======
+TAMANHOS_PAGINA = [25, 50, 100, 200]  # Opções de registros por página na listagem
+LIMITE_RESULTADOS_BUSCA = 200  # Máximo de resultados exibidos na busca textual
 
-if not os.path.exists(db_path):
-    Base.metadata.create_all(engine)
 
-Session = sessionmaker(bind=engine)
-session = Session()
+# ====== FUNÇÕES DA APLICAÇÃO ======
+# Função: Ler os XMLs enviados (arquivos .xml soltos ou dentro de arquivos .zip)
+def ler_arquivos_enviados(arquivos):
+    """Retorna a lista de (nome, conteúdo) dos XMLs enviados e a lista de (nome, erro) dos que falharam."""
+    xmls, erros = [], []
+    for arquivo in arquivos:
+        if arquivo.name.lower().endswith(".zip"):
+            xmls_zip, erros_zip = extract_xmls_from_zip(arquivo, arquivo.name)
+            xmls.extend(xmls_zip)
+            erros.extend(erros_zip)
+        else:
+            try:
+                xmls.append((arquivo.name, arquivo.read().decode("utf-8")))
+            except UnicodeDecodeError as e:
+                erros.append((arquivo.name, e))
+    return xmls, erros
 
 
-# ====== FUNÇÕES DA APLICAÇÃO ======
 # Função: Upload de XML e Salvamento no Banco de Dados
 def upload_xml():
-    """Permite que o usuário envie arquivos XML e salve no banco de dados."""
-    st.subheader("Envie seu XML")
-    arquivo = st.file_uploader("Selecione um arquivo XML:", type=["xml"])
+    """Permite que o usuário envie arquivos XML (ou ZIPs com XMLs) e salve todos no banco de dados."""
+    st.subheader("Envie seus XMLs")
+    arquivos = st.file_uploader(
+        "Selecione os arquivos XML ou ZIP:", type=["xml", "zip"], accept_multiple_files=True
+    )
+
+    if arquivos:
+        cliente = st.text_input("Informe o nome do cliente:")
+
+        if cliente and st.button("Salvar XMLs"):
+            xmls, erros = ler_arquivos_enviados(arquivos)
+            st.info(f"{len(xmls)} XMLs encontrados.")
+            if erros:
+                with st.expander(f"{len(erros)} arquivos não puderam ser lidos"):
+                    for nome, erro in erros:
+                        st.write(f"{nome}: {erro}")
+            if xmls:
+                # O lote vai inteiro para a fila antes de ser processado: se a página fechar no meio,
+                # ele pode ser retomado depois em "Lotes interrompidos"
+                lote_id = criar_lote(cliente, xmls)
+                processar_lote(lote_id)
+
+
+# Função: Processar (ou retomar) um lote da fila, com barra de progresso
+def processar_lote(lote_id):
+    """Processa as partes pendentes do lote e mostra o resultado (gravados, repetidos e quarentena)."""
+    progress_bar = st.progress(0)
+    status_text = st.empty()
+
+    def atualizar_progresso(lote):
+        situacao = situacao_lote(lote)
+        total = sum(situacao.values())
+        progress_bar.progress((total - situacao['pendente']) / total)
+        status_text.text(f"Processados {total - situacao['pendente']}/{total} XMLs")
 
-    if arquivo:
-        try:
-            xml_content = arquivo.read().decode("utf-8")  # Lê o conteúdo do XML
-            cliente = st.text_input("Informe o nome do cliente:")
+    try:
+        executar_trabalhador(lote_id, progresso=atualizar_progresso)
+    finally:
+        progress_bar.empty()
+        status_text.empty()
 
-            if cliente and st.button("Salvar XML"):
-                data_envio = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")  # Data de envio
-                novo_registro = NFSe(cliente=cliente, data_envio=data_envio, arquivo_xml=xml_content)
+    situacao = situacao_lote(lote_id)
+    st.success(f"{situacao['ok']} XMLs do lote {lote_id} salvos com sucesso!")
+    if situacao['duplicado']:
+        st.info(f"{situacao['duplicado']} XMLs ou notas já armazenados (ignorados).")
+    if situacao['pendente']:
+        st.warning(f"{situacao['pendente']} XMLs ainda pendentes (serão tentados novamente ao retomar o lote).")
+    quarentena = arquivos_em_quarentena(lote_id)
+    if quarentena:
+        with st.expander(f"{len(quarentena)} XMLs em quarentena"):
+            for _, nome, tentativas, erro in quarentena:
+                st.write(f"{nome} ({tentativas} tentativas): {erro}")
 
-                session.add(novo_registro)
-                session.commit()
 
-                st.success(f"XML do cliente '{cliente}' salvo com sucesso!")
-        except Exception as e:
-            st.error(f"Erro ao processar o arquivo: {e}")
+# Função: Retomar lotes que ficaram com arquivos pendentes (página fechada, processo interrompido)
+def lotes_interrompidos():
+    """Lista os lotes incompletos da fila e permite retomá-los de onde pararam."""
+    st.subheader("Lotes interrompidos")
+    lotes = lotes_incompletos()
+    if not lotes:
+        st.info("Nenhum lote com arquivos pendentes.")
+        return
+    for lote_id, cliente, criado_em, total_arquivos, pendentes in lotes:
+        st.write(f"Lote {lote_id} - cliente '{cliente}' - enviado em {criado_em}: {pendentes} de {total_arquivos} XMLs pendentes")
+        if st.button("Retomar", key=f"retomar-lote-{lote_id}"):
+            processar_lote(lote_id)
+
+
+# Função: Carregar o XML de um único registro (a coluna arquivo_xml não é lida na listagem)
+def carregar_xml(registro_id):
+    """Busca e descomprime apenas o conteúdo XML do registro informado."""
+    with session_scope() as session:
+        return descomprimir_xml(session.query(NFSe.xml_comprimido).filter(NFSe.id == registro_id).scalar())
+
+def xml_para_download(registro_id):
+    """Conteúdo XML do registro em bytes (UTF-8), para o botão de download."""
+    return carregar_xml(registro_id).encode("utf-8")
+
+
+# Função: Gerar o ZIP de exportação (executada só quando o usuário clica em baixar)
+def gerar_zip_xmls(**filtros):
+    """Grava o ZIP (filtros de exportar_xmls_zip) em um arquivo temporário, um XML por vez, e o devolve aberto para o download."""
+    arquivo = tempfile.TemporaryFile(suffix=".zip")
+    with session_scope() as session:
+        exportar_xmls_zip(session, arquivo, **filtros)
+    arquivo.seek(0)
+    return arquivo
+
+
+# Função: Aplicar os filtros da listagem (resolvidos em SQL sobre os campos indexados de nfse_campos)
+def filtrar_registros(query, filtro_prestador, filtro_tomador, filtro_competencia):
+    """Acrescenta à query de NFSe os filtros por CNPJ do prestador, CNPJ/CPF do tomador e competência."""
+    if filtro_prestador or filtro_tomador or filtro_competencia:
+        query = query.join(NFSeCampos, NFSeCampos.nfse_id == NFSe.id)
+        if filtro_prestador:
+            query = query.filter(NFSeCampos.prestador_cpf_cnpj == "".join(filter(str.isdigit, filtro_prestador)))
+        if filtro_tomador:
+            query = query.filter(NFSeCampos.tomador_cpf_cnpj == "".join(filter(str.isdigit, filtro_tomador)))
+        if filtro_competencia:
+            query = query.filter(NFSeCampos.competencia == filtro_competencia.strip())
+    return query
 
 
 # Função: Exibir e Gerenciar Registros do Banco de Dados
 def listar_registros():
-    """Exibe todos os registros no banco de dados e permite visualizar/baixar XMLs."""
+    """Exibe os registros do banco de dados paginados e permite visualizar/baixar XMLs sob demanda."""
     st.subheader("NFS-e Registradas no Banco de Dados")
 
-    registros = session.query(NFSe).all()  # Busca todos os registros do banco
+    # Filtros resolvidos em SQL sobre os campos indexados (tabela nfse_campos)
+    col_prestador, col_tomador, col_competencia = st.columns(3)
+    with col_prestador:
+        filtro_prestador = st.text_input("CNPJ do prestador:", key="filtro-prestador")
+    with col_tomador:
+        filtro_tomador = st.text_input("CNPJ/CPF do tomador:", key="filtro-tomador")
+    with col_competencia:
+        filtro_competencia = st.text_input("Competência (AAAA-MM):", key="filtro-competencia")
+
+    with session_scope() as session:
+        query = filtrar_registros(session.query(NFSe.id), filtro_prestador, filtro_tomador, filtro_competencia)
+        total_registros = query.with_entities(func.count(NFSe.id)).scalar()
 
-    if not registros:
+    if not total_registros:
         st.info("Nenhuma NFS-e encontrada.")
-    else:
-        for idx, registro in enumerate(registros):
-            st.subheader(f"NFS-e ID: {registro.id} - Cliente: {registro.cliente}")
-            st.text(f"Data de Envio: {registro.data_envio}")
+        return
+
+    # Com prestador e competência definidos, a análise de sequência sai direto do SQL
+    if filtro_prestador and filtro_competencia:
+        cnpj = "".join(filter(str.isdigit, filtro_prestador))
+        with st.expander("Análise de Sequência de NF (prestador/competência filtrados)"):
+            with session_scope() as session:
+                duplicados = numeros_duplicados(session, cnpj, filtro_competencia.strip())
+                lacunas = lacunas_sequencia(session, cnpj, filtro_competencia.strip())
+            if not duplicados and not lacunas:
+                st.success("Nenhum número duplicado ou faltante.")
+            for numero, quantidade in duplicados:
+                st.write(f"NF {numero} aparece {quantidade} vezes.")
+            for primeiro, ultimo in lacunas:
+                st.write(f"NF {primeiro} ausente na sequência." if primeiro == ultimo else f"NFs {primeiro} a {ultimo} ausentes na sequência.")
+
+    # Índice de numeração persistido: considera todos os envios e competências do prestador
+    with st.expander("Numeração de NF por prestador (todos os envios)"):
+        with session_scope() as session:
+            resumo = resumo_numeracao(session)
+            if filtro_prestador:
+                cnpj = "".join(filter(str.isdigit, filtro_prestador))
+                repetidos = numeros_repetidos(session, cnpj)
+                cancelados = numeros_cancelados(session, cnpj)
+                abertas = lacunas_abertas(session, cnpj)
+        st.dataframe(
+            pd.DataFrame(resumo, columns=["Prestador", "Menor Nº", "Maior Nº", "Emitidas", "Canceladas", "Repetidas", "Faltantes"]),
+            hide_index=True,
+        )
+        if filtro_prestador:
+            if not repetidos and not abertas:
+                st.success("Nenhum número repetido ou faltante na numeração do prestador.")
+            for numero, ocorrencias in repetidos:
+                st.write(f"NF {numero} recebida {ocorrencias} vezes.")
+            for inicio, fim in abertas:
+                st.write(f"NF {inicio} ainda não recebida." if inicio == fim else f"NFs {inicio} a {fim} ainda não recebidas.")
+            if cancelados:
+                st.caption(f"NFs canceladas: {', '.join(str(numero) for numero in cancelados)}")
 
-            # Botão para visualizar o conteúdo do XML
-            if st.button(f"Visualizar XML ({registro.id})", key=f"visualizar-{registro.id}-{idx}"):
-                st.code(registro.arquivo_xml, language="xml")
+    # Exportação de todos os registros filtrados (não só da página) em um único ZIP
+    st.download_button(
+        label=f"Baixar os {total_registros} XMLs filtrados (ZIP)",
+        data=functools.partial(
+            gerar_zip_xmls,
+            competencias=[filtro_competencia.strip()] if filtro_competencia else None,
+            prestador_cnpj="".join(filter(str.isdigit, filtro_prestador)) or None,
+            tomador_cnpj="".join(filter(str.isdigit, filtro_tomador)) or None,
+        ),
+        file_name="nfse_xmls.zip",
+        mime="application/zip",
+        key="baixar-zip-filtrados",
+    )
 
-            # Botão para download do XML
+    col_tamanho, col_pagina = st.columns(2)
+    with col_tamanho:
+        tamanho_pagina = st.selectbox("Registros por página:", TAMANHOS_PAGINA, index=0)
+    total_paginas = (total_registros - 1) // tamanho_pagina + 1
+    with col_pagina:
+        pagina = st.number_input("Página:", min_value=1, max_value=total_paginas, value=1, step=1)
+    st.caption(f"{total_registros} registros - página {pagina} de {total_paginas}")
+
+    # Busca só a página atual (LIMIT/OFFSET pela chave primária), sem carregar o XML
+    with session_scope() as session:
+        registros = (
+            filtrar_registros(session.query(NFSe.id, NFSe.cliente, NFSe.data_envio),
+                              filtro_prestador, filtro_tomador, filtro_competencia)
+            .order_by(NFSe.id.desc())
+            .limit(tamanho_pagina)
+            .offset((pagina - 1) * tamanho_pagina)
+            .all()
+        )
+
+    for registro in registros:
+        st.subheader(f"NFS-e ID: {registro.id} - Cliente: {registro.cliente}")
+        st.text(f"Data de Envio: {registro.data_envio}")
+
+        col_visualizar, col_baixar = st.columns(2)
+
+        # Botão para visualizar o conteúdo do XML (lido do banco apenas ao clicar)
+        with col_visualizar:
+            visualizar = st.button("Visualizar XML", key=f"visualizar-{registro.id}")
+
+        # Download sob demanda: o XML só é lido do banco quando o usuário clica em baixar
+        with col_baixar:
             st.download_button(
                 label="Baixar XML",
-                data=registro.arquivo_xml.encode("utf-8"),
+                data=functools.partial(xml_para_download, registro.id),
                 file_name=f"{registro.cliente}_nfse_{registro.id}.xml",
                 mime="application/xml",
-                key=f"baixar-{registro.id}-{idx}"  # Chave única
+                key=f"baixar-{registro.id}"  # Chave única
             )
 
+        if visualizar:
+            st.code(carregar_xml(registro.id), language="xml")
+
+
+# Função: Exportar os XMLs de clientes/competências em um único ZIP
+def exportar_xmls():
+    """Exporta os XMLs armazenados dos clientes e competências escolhidos em um ZIP gerado sob demanda."""
+    st.subheader("Exportar XMLs")
+    with session_scope() as session:
+        clientes = listar_clientes(session)
+        competencias = [c for (c,) in session.query(NFSeCampos.competencia).filter(NFSeCampos.competencia.isnot(None)).distinct().order_by(NFSeCampos.competencia.desc())]
+    if not clientes:
+        st.info("Nenhuma NFS-e armazenada.")
+        return
+
+    clientes_escolhidos = st.multiselect("Clientes (vazio = todos):", clientes, key="exportar-clientes")
+    competencias_escolhidas = st.multiselect("Competências (vazio = todas):", competencias, key="exportar-competencias")
+
+    with session_scope() as session:
+        query = session.query(func.count(NFSe.id))
+        if clientes_escolhidos:
+            query = query.filter(NFSe.cliente.in_(clientes_escolhidos))
+        if competencias_escolhidas:
+            query = query.join(NFSeCampos, NFSeCampos.nfse_id == NFSe.id).filter(NFSeCampos.competencia.in_(competencias_escolhidas))
+        quantidade = query.scalar()
+
+    st.caption(f"{quantidade} XMLs selecionados. O ZIP é gerado quando você clica em baixar.")
+    st.download_button(
+        label="Baixar ZIP",
+        data=functools.partial(gerar_zip_xmls, clientes=clientes_escolhidos or None, competencias=competencias_escolhidas or None),
+        file_name="nfse_xmls.zip",
+        mime="application/zip",
+        disabled=not quantidade,
+        key="baixar-zip-exportacao",
+    )
+
+
+# Função: Busca textual nas NFS-e armazenadas (índice FTS5)
+def buscar_registros():
+    """Busca NFS-e por palavras da descrição do serviço, razão social, código de verificação ou Id."""
+    st.subheader("Buscar NFS-e")
+    termo = st.text_input("Palavras da descrição, tomador/prestador, código de verificação ou Id:", key="termo-busca")
+    if not termo.strip():
+        return
+
+    with session_scope() as session:
+        resultados = buscar_notas(session, termo, limite=LIMITE_RESULTADOS_BUSCA)
+
+    if not resultados:
+        st.info("Nenhuma NFS-e encontrada para a busca.")
+        return
+
+    st.caption(f"{len(resultados)} resultados (máximo {LIMITE_RESULTADOS_BUSCA}), ordenados por relevância")
+    df_resultados = pd.DataFrame(resultados, columns=[
+        "ID", "Número da NF", "Competência", "Prestador", "Tomador", "Código Verificação", "Valor dos Serviços", "Trecho"
+    ])
+    st.dataframe(df_resultados, hide_index=True, width='stretch')
+
+    st.download_button(
+        label="Baixar os XMLs dos resultados (ZIP)",
+        data=functools.partial(gerar_zip_xmls, nfse_ids=df_resultados["ID"].tolist()),
+        file_name="nfse_busca.zip",
+        mime="application/zip",
+        key="baixar-zip-busca",
+    )
+
+    registro_id = st.selectbox("Visualizar o XML do registro:", [None] + df_resultados["ID"].tolist())
+    if registro_id is not None:
+        st.code(carregar_xml(registro_id), language="xml")
+
 
 # ====== INTERFACE DO USUÁRIO ======
 st.title("Gerenciador de NFS-e")
@@ -84,10 +329,39 @@ st.sidebar.title("Menu")
 # Menu lateral com as opções
 menu = st.sidebar.selectbox(
     "Escolha uma opção", 
-    ["Enviar XML", "Listar Registros"]
+    ["Enviar XMLs", "Lotes interrompidos", "Listar Registros", "Buscar NFS-e", "Exportar XMLs"]
 )
 
-if menu == "Enviar XML":
+# Registros gravados antes da tabela nfse_campos ainda não têm os campos extraídos
+with session_scope() as session:
+    pendentes = contar_sem_campos(session)
+if pendentes:
+    st.sidebar.warning(f"{pendentes} registros sem campos extraídos.")
+    if st.sidebar.button("Extrair campos pendentes"):
+        with st.spinner("Extraindo campos dos XMLs já gravados..."), session_scope() as session:
+            processados = preencher_campos_pendentes(session)
+        st.sidebar.success(f"Campos extraídos de {processados} registros.")
+
+# Arquivamento anual: move anos fechados para partições somente leitura, fora do banco principal
+with session_scope() as session:
+    anos_para_arquivar = anos_arquivaveis(session)
+if anos_para_arquivar:
+    with st.sidebar.expander("Arquivar ano fechado"):
+        ano_arquivo = st.selectbox("Ano:", anos_para_arquivar, key="ano-arquivo")
+        if st.button("Arquivar", key="arquivar-ano"):
+            with st.spinner(f"Movendo as NFS-e de {ano_arquivo} para a partição anual..."):
+                movidas = arquivar_ano(ano_arquivo)
+            st.success(f"{movidas} NFS-e de {ano_arquivo} arquivadas.")
+if anos_arquivados():
+    st.sidebar.caption("Anos arquivados (somente leitura): " + ", ".join(str(ano) for ano in anos_arquivados()))
+
+if menu == "Enviar XMLs":
     upload_xml()
+elif menu == "Lotes interrompidos":
+    lotes_interrompidos()
 elif menu == "Listar Registros":
     listar_registros()
+elif menu == "Buscar NFS-e":
+    buscar_registros()
+elif menu == "Exportar XMLs":
+    exportar_xmls()
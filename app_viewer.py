@@ -18,7 +18,10 @@ import streamlit as st
 import pandas as pd
 import os
 import tempfile
+import time
+import hashlib
 import numpy as np
+import contextlib
 import io # Importado para manipulação de bytes para download de Excel
 import json # Para gerar o JSON do Plotly
 
@@ -44,113 +47,56 @@ st.info("Utilize a barra lateral à esquerda para navegar entre as seções da a
 
 # Importa a função de extração do seu nfse_parser
 from nfse_parser import extract_nfse_data
+from nfse_validacao import validar_e_extrair_lote
+
+# Importa as regras de conferência, análise de sequência e exportação
+from nfse_conferencia import (
+    detect_sequence_issues,
+    colunas_ausentes_sequencia,
+    format_dataframe_for_display,
+    format_currency_columns,
+    currency_cols_for_display,
+    base_conferencia,
+    atualizar_conferencia,
+    carregar_versoes_regras,
+    salvar_versao_regras,
+    DESCRICAO_REGRAS,
+    remove_duplicate_notes,
+    indexar_competencias,
+    filter_by_competence,
+    unformat_currency_columns,
+    compute_tax_panel,
+    build_csv_export,
+    build_excel_export,
+)
+
+# Acesso às NFS-e já armazenadas pelo app.py (carga direta do banco, sem reenvio dos XMLs)
+from nfse_db import (
+    session_scope, sessao_particao, anos_arquivados, listar_clientes, listar_competencias, iterar_notas_extraidas,
+    assinatura_notas,
+)
+
+# Armazenamento analítico opcional (Parquet): só a competência exibida fica em memória
+from nfse_analitico import gravar_conjunto, apagar_conjunto, conjunto_disponivel, listar_competencias as listar_competencias_conjunto, carregar_competencia, resumo_competencias, carregar_colunas
+
+# Pacote de relatórios do fechamento (planilhas por competência e prestador, geradas em paralelo)
+from nfse_relatorios import partes_do_dataframe, partes_do_conjunto, contar_partes_do_conjunto, gerar_pacote_relatorios
+
+# Conciliação dos recebimentos (extrato bancário / contas a receber do ERP) com as notas
+from nfse_conciliacao import (
+    carregar_lancamentos, conciliar, resumo_conciliacao, exportar_conciliacao,
+    COLUNAS_NOTAS as COLUNAS_NOTAS_CONCILIACAO, TOLERANCIA_VALOR_PADRAO, DIAS_ANTES_PADRAO, DIAS_DEPOIS_PADRAO,
+)
+
+# Modo de medição (profiling): tempo por etapa e captura opcional de cProfile/tracemalloc
+from nfse_perfil import PERFIL_POR_PADRAO, medir_etapa, iniciar_cronometro, marco, tabela_etapas, capturar_perfil
+
+# Cache de resultados compartilhado entre as sessões (mesmo conjunto de dados processado uma vez só)
+from nfse_cache import chave_conjunto, obter as obter_do_cache, guardar as guardar_no_cache, estatisticas as estatisticas_cache
+
+# Quantidade de notas lidas do banco por vez ao carregar uma competência
+TAMANHO_LOTE_CARGA_BANCO = 5000
 
-# --- Configurações de Alíquotas e Limites de Retenção ---
-# Para Lucro Presumido - Regime Normal (ajuste conforme a legislação vigente e o tipo de serviço)
-# IMPORTANTE: Estas alíquotas e limites são referenciais e devem ser validadas pela equipe fiscal.
-ALIQUOTA_IRRF = 0.015
-LIMITE_IRRF_SERVICO = 666.67 # Valor do serviço para que haja retenção de IRRF
-
-ALIQUOTA_CSLL = 0.01
-ALIQUOTA_PIS = 0.0065
-ALIQUOTA_COFINS = 0.03
-LIMITE_CSRF_SERVICO = 215.05 # Valor do serviço para que haja retenção combinada (CSLL, PIS, COFINS)
-
-# ISSQN é variável por município. A alíquota padrão abaixo é apenas um exemplo.
-# Para uma conferência precisa de ISSQN, seria necessário uma base de dados de alíquotas por município.
-ALIQUOTA_ISSQN_REFERENCIA = 0.03 # Alíquota de referência para cálculo de ISSQN esperado, se aplicável
-# --- Configurações de Alíquotas para EQUIPARAÇÃO HOSPITALAR ---
-# Baseado em Faturamento Bruto (Valor dos Serviços)
-ALIQUOTA_IRPJ_EQ_HOSP = 0.012   # 1.2% do faturamento
-ALIQUOTA_CSLL_EQ_HOSP = 0.0108  # 1.08% do faturamento
-ALIQUOTA_PIS_EQ_HOSP = 0.0065   # 0.65% do faturamento
-ALIQUOTA_COFINS_EQ_HOSP = 0.03  # 3.00% do faturamento
-ALIQUOTA_ISSQN_EQ_HOSP = 0.0201 # 2.01% do faturamento
-# --- Mapeamento de Nomes de Colunas para Exibição Amigável ---
-# Mantenha os nomes originais como chaves para que o rename funcione corretamente.
-column_display_names = {
-    # NFSe Geral
-    'Nfse.Id': 'ID NFSe',
-    'Numero': 'Número da NF',
-    'CodigoVerificacao': 'Código Verificação',
-    'DataEmissao': 'Data Emissão',
-    'NaturezaOperacao': 'Natureza Operação',
-    'RegimeEspecialTributacao': 'Regime Tributação',
-    'OptanteSimplesNacional': 'Simples Nacional',
-    'IncentivadorCultural': 'Incentivador Cultural',
-
-    # Serviço
-    'DescricaoServico': 'Descrição do Serviço',
-    'ItemListaServico': 'Item Lista Serviço',
-    'CodigoTributacaoMunicipio': 'Cód. Tributação Município',
-    'CodigoMunicipioServico': 'Cód. Município Serviço',
-
-    # Valores do Serviço
-    'ValorServicos': 'Valor dos Serviços',
-    'ValorDeducoes': 'Deduções',
-    'ValorPis': 'PIS',
-    'ValorCofins': 'COFINS',
-    'ValorInss': 'INSS',
-    'ValorIr': 'IR',
-    'ValorCsll': 'CSLL',
-    'IssRetido': 'ISS Retido (Cód)',
-    'ValorIss': 'Valor ISS',
-    'ValorIssRetido': 'Valor ISS Retido',
-    'OutrasRetencoes': 'Outras Retenções',
-    'BaseCalculo': 'Base de Cálculo',
-    'Aliquota': 'Alíquota',
-    'ValorLiquidoNfse': 'Valor Líquido NFSe',
-    'DescontoIncondicionado': 'Desconto Incondicionado',
-    'DescontoCondicionado': 'Desconto Condicionado',
-
-    # Prestador
-    'Prestador.CpfCnpj': 'Prestador CNPJ',
-    'Prestador.InscricaoMunicipal': 'Prestador Inscr. Municipal',
-    'Prestador.RazaoSocial': 'Prestador Razão Social',
-    'Prestador.Endereco.Logradouro': 'Prestador Logradouro',
-    'Prestador.Endereco.Numero': 'Prestador Número',
-    'Prestador.Endereco.Complemento': 'Prestador Complemento',
-    'Prestador.Endereco.Bairro': 'Prestador Bairro',
-    'Prestador.Endereco.CodigoMunicipio': 'Prestador Cód. Município',
-    'Prestador.Endereco.Uf': 'Prestador UF',
-    'Prestador.Endereco.Cep': 'Prestador CEP',
-    'Prestador.Contato.Telefone': 'Prestador Telefone',
-    'Prestador.Contato.Email': 'Prestador E-mail',
-
-    # Tomador
-    'TomadorServico.CpfCnpj': 'Tomador CNPJ/CPF',
-    'TomadorServico.RazaoSocial': 'Tomador Razão Social',
-    'TomadorServico.Endereco.Logradouro': 'Tomador Logradouro',
-    'TomadorServico.Endereco.Numero': 'Tomador Número',
-    'TomadorServico.Endereco.Bairro': 'Tomador Bairro',
-    'TomadorServico.Endereco.CodigoMunicipio': 'Tomador Cód. Município',
-    'TomadorServico.Endereco.Uf': 'Tomador UF',
-    'TomadorServico.Endereco.Cep': 'Tomador CEP',
-    'TomadorServico.Contato.Telefone': 'Tomador Telefone',
-
-    # Órgão Gerador
-    'OrgaoGerador.CodigoMunicipio': 'Org. Gerador Cód. Município',
-    'OrgaoGerador.Uf': 'Org. Gerador UF',
-
-    # Novas colunas calculadas/ajustadas para display
-    'Competencia': 'Competência',
-    'Tomador Tipo': 'Tomador Tipo',
-    'Prestador Regime': 'Prestador Regime',
-    'IsCancelled': 'Status Cancelamento',
-
-    # Novas colunas para conferência de retenções (internas, não exibidas por padrão na tabela)
-    'IR Esperado': 'IR Esperado',
-    'CSLL Esperado': 'CSLL Esperado',
-    'PIS Esperado': 'PIS Esperado',
-    'COFINS Esperado': 'COFINS Esperado',
-    'ISSQN Esperado': 'ISSQN Esperado',
-    'Status IR': 'Status IR',
-    'Status CSLL': 'Status CSLL',
-    'Status PIS': 'Status PIS',
-    'Status COFINS': 'Status COFINS',
-    'Status ISS Retido': 'Status ISS Retido',
-    'Status Geral Retenções': 'Status Geral Retenções'
-}
 
 # Colunas padrão a serem exibidas na tabela. As colunas de status e esperados NÃO estão aqui por padrão.
 default_cols_to_show_initial = [
@@ -158,16 +104,6 @@ default_cols_to_show_initial = [
     'Valor dos Serviços', 'IR', 'CSLL', 'PIS', 'COFINS', 'Valor ISS Retido', 'Status Cancelamento'
 ]
 
-# INÍCIO DA CORREÇÃO: Definição GLOBAL da lista de colunas monetárias
-# Linha 95
-currency_cols_for_display = [
-    'Valor dos Serviços', 'Deduções', 'PIS', 'COFINS', 'INSS',
-    'IR', 'CSLL', 'Valor ISS', 'Valor ISS Retido', 'Outras Retenções',
-    'BaseCalculo', 'ValorLiquidoNfse', 'DescontoIncondicionado', 'DescontoCondicionado',
-    'IR Esperado', 'CSLL Esperado', 'PIS Esperado', 'COFINS Esperado', 'ISSQN Esperado'
-]
-# FIM DA CORREÇÃO
-
 
 # --- Configurações Iniciais da Página ---
 st.set_page_config(
@@ -186,17 +122,58 @@ if 'df_processed_viewer' not in st.session_state:
     st.session_state.df_processed_viewer = None
 if 'selected_columns' not in st.session_state:
     st.session_state.selected_columns = default_cols_to_show_initial.copy()
-if 'column_config' not in st.session_state:
-    st.session_state.column_config = {}
 if 'diagnosis_messages' not in st.session_state:
     st.session_state.diagnosis_messages = []
 # NOVO: Inicializa a variável para armazenar os problemas de sequência
 # Linha 120
 if 'sequence_issues' not in st.session_state:
     st.session_state.sequence_issues = pd.DataFrame() # DataFrame vazio inicialmente
+# Regras tributárias em uso na conferência (última versão gravada) e base numérica para re-conferir
+if 'regras_conferencia' not in st.session_state:
+    st.session_state.regras_conferencia = carregar_versoes_regras()[-1]['regras']
+if 'conferencia_base' not in st.session_state:
+    st.session_state.conferencia_base = None
+# Caminho do conjunto Parquet das notas processadas (modo de baixo uso de memória), ou None
+if 'conjunto_analitico' not in st.session_state:
+    st.session_state.conjunto_analitico = None
+# Caminho do ZIP do último pacote de relatórios gerado, ou None
+if 'pacote_relatorios' not in st.session_state:
+    st.session_state.pacote_relatorios = None
+# Resultado da conciliação dos recebimentos: (notas, lançamentos), ou None
+if 'conciliacao' not in st.session_state:
+    st.session_state.conciliacao = None
+# Trechos de cada competência no df_processed_viewer (ordenado por competência): {competência: (início, fim_ativas, fim)}
+if 'faixas_competencia' not in st.session_state:
+    st.session_state.faixas_competencia = {}
+# Tempo por etapa do último processamento (modo de medição)
+if 'perfil_processamento' not in st.session_state:
+    st.session_state.perfil_processamento = []
 # FIM NOVO
 
 
+# --- Modo de Medição (profiling) ---
+# Ligado pela chave abaixo ou por NFSE_PERFIL=1; a tabela de tempos fica no fim da barra lateral
+perfil_ativo = st.sidebar.toggle("Modo de medição (tempo por etapa)", value=PERFIL_POR_PADRAO, key="perfil_viewer")
+capturar_perfil_ativo = perfil_ativo and st.sidebar.checkbox(
+    "Capturar cProfile e tracemalloc do processamento em arquivo",
+    help="Grava um .prof (pstats) e um .txt com as funções mais custosas e as linhas que mais alocaram memória. Deixa o processamento mais lento.",
+    key="perfil_captura_viewer",
+)
+cronometro_rerun = iniciar_cronometro(perfil_ativo)
+
+def etapa(nome):
+    """Cronometra uma etapa do processamento (só com o modo de medição ligado)."""
+    return medir_etapa(st.session_state.perfil_processamento if perfil_ativo else None, nome)
+
+def captura_do_processamento(rotulo):
+    """Captura cProfile/tracemalloc do processamento, se pedida; produz o dicionário com os arquivos gravados."""
+    return capturar_perfil(rotulo) if capturar_perfil_ativo else contextlib.nullcontext({})
+
+def registrar_arquivos_perfil(arquivos_perfil):
+    if arquivos_perfil:
+        log_message_viewer(f"Perfil do processamento gravado em {arquivos_perfil['prof']} (relatório: {arquivos_perfil['txt']}).")
+
+
 # --- Função de Log ---
 def log_message_viewer(message, level="info"):
     """Adiciona uma mensagem ao log na interface do Streamlit para o viewer."""
@@ -219,329 +196,49 @@ def log_message_viewer(message, level="info"):
             pass # log_container_viewer not yet defined
 
 
-# --- Funções Auxiliares para Cálculo de Retenções Esperadas ---
-def calcular_irrf_esperado(valor_servicos):
-    """Calcula o IRRF esperado para Lucro Presumido (Normal)."""
-    if valor_servicos >= LIMITE_IRRF_SERVICO:
-        return valor_servicos * ALIQUOTA_IRRF
-    return 0.0
-
-def calcular_csrf_esperado(valor_servicos):
-    """Calcula CSLL, PIS e COFINS esperados para Lucro Presumido (Normal)."""
-    if valor_servicos >= LIMITE_CSRF_SERVICO:
-        return {
-            'CSLL': valor_servicos * ALIQUOTA_CSLL,
-            'PIS': valor_servicos * ALIQUOTA_PIS,
-            'COFINS': valor_servicos * ALIQUOTA_COFINS
-        }
-    return {'CSLL': 0.0, 'PIS': 0.0, 'COFINS': 0.0}
-
-def calcular_issqn_esperado(base_calculo, aliquota_xml):
-    """
-    Calcula o ISSQN esperado. Se a alíquota do XML for válida, usa-a.
-    Caso contrário, usa uma alíquota de referência definida nas constantes.
-    """
-    if base_calculo is None or base_calculo <= 0:
-        return 0.0
-    # Alíquota do XML vem como porcentagem (ex: 3.00 para 3%), então divide por 100
-    if aliquota_xml is not None and aliquota_xml > 0:
-        return base_calculo * (aliquota_xml / 100)
-    # Se não houver alíquota no XML ou ela for zero/inválida, usa uma alíquota de referência
-    return base_calculo * ALIQUOTA_ISSQN_REFERENCIA
-
-# NOVO: Função para detectar problemas de sequência de NF
-# Linha 194
-def detect_sequence_issues(df_input):
+# --- Preparação dos dados extraídos (upload ou banco) ---
+def reset_processing_state():
+    """Limpa os resultados anteriores antes de um novo processamento ou carga do banco."""
+    st.session_state.log_messages_viewer = []
+    st.session_state.df_processed_viewer = None
+    st.session_state.selected_columns = default_cols_to_show_initial.copy() # Reseta para a ordem padrão
+    st.session_state.diagnosis_messages = [] # Limpa as mensagens de diagnóstico
+    st.session_state.sequence_issues = pd.DataFrame() # Limpa problemas de sequência ao reprocessar
+    st.session_state.conferencia_base = None
+    st.session_state.faixas_competencia = {}
+    apagar_conjunto(st.session_state.conjunto_analitico) # O conjunto Parquet anterior não é mais usado
+    st.session_state.conjunto_analitico = None
+    apagar_pacote_relatorios()
+    st.session_state.conciliacao = None
+    st.session_state.perfil_processamento = []
+
+def apagar_pacote_relatorios():
+    """Remove do disco o pacote de relatórios gerado anteriormente (se houver)."""
+    if st.session_state.pacote_relatorios and os.path.exists(st.session_state.pacote_relatorios):
+        os.remove(st.session_state.pacote_relatorios)
+    st.session_state.pacote_relatorios = None
+
+# Resultados do processamento guardados no cache compartilhado (e restaurados dele)
+CACHED_RESULT_KEYS = ['df_processed_viewer', 'conferencia_base', 'sequence_issues', 'diagnosis_messages', 'faixas_competencia']
+
+def restore_cached_result(cache_key):
+    """Restaura no session_state o resultado já processado por alguma sessão. Retorna True se encontrou."""
+    if cache_key is None or st.session_state.get("usar_parquet_viewer"):
+        return False
+    result = obter_do_cache(cache_key)
+    if result is None:
+        return False
+    for key in CACHED_RESULT_KEYS:
+        st.session_state[key] = result[key]
+    log_message_viewer(f"Resultado reaproveitado do cache compartilhado ({len(result['df_processed_viewer'])} NFSe), sem reprocessar.", "success")
+    return True
+
+def build_column_config(df_display):
     """
-    Detecta números de NF duplicados e lacunas na sequência por prestador e competência.
-    Retorna um DataFrame com os problemas encontrados.
-    df_input deve conter as colunas 'Número da NF', 'Prestador CNPJ', 'Competência', 'Status Cancelamento'.
+    column_config do st.dataframe para as colunas do DataFrame formatado (format_dataframe_for_display).
+    Depende só dos nomes das colunas: é montado na exibição, sem ser guardado na sessão.
     """
-    # --- NOVO: Verificação de colunas necessárias ---
-    required_cols = ['Número da NF', 'Prestador CNPJ', 'Competência', 'Status Cancelamento', 'Prestador Razão Social', 'ID NFSe']
-    missing_cols = [col for col in required_cols if col not in df_input.columns]
-    
-    if missing_cols:
-        # Tenta usar log_message_viewer se estiver disponível, senão usa st.warning
-        try:
-            log_message_viewer(f"Não foi possível realizar a análise de sequência de NF. Colunas ausentes no DataFrame: {', '.join(missing_cols)}", "warning")
-        except NameError:
-            st.warning(f"Não foi possível realizar a análise de sequência de NF. Colunas ausentes no DataFrame: {', '.join(missing_cols)}")
-        
-        # Retorna um DataFrame vazio com as colunas esperadas para evitar KeyErrors posteriores
-        return pd.DataFrame(columns=[
-            'Tipo de Problema', 'Prestador CNPJ', 'Prestador Razão Social', 
-            'Competência', 'Número da NF Afetado', 'Detalhes', 'ID NFSe'
-        ])
-    # --- FIM NOVO ---
-
-    issues = []
-
-    # Certifica que o 'Número da NF' é numérico para ordenação e detecção de gaps
-    # Converte para string primeiro para lidar com valores como 'CANCELADA' antes de tentar para numérico
-    df_input['Número da NF_int'] = pd.to_numeric(
-        df_input['Número da NF'].astype(str).str.replace('CANCELADA', '-1'), errors='coerce'
-    ).fillna(-1).astype(int)
-    
-    # Filtra para números válidos e maiores que zero
-    df_filtered = df_input[df_input['Número da NF_int'] > 0].copy()
-
-    # Agrupa por Prestador e Competência
-    grouped = df_filtered.groupby(['Prestador CNPJ', 'Competência'])
-
-    for (prestador_cnpj, competencia), group_df in grouped:
-        # Ordene as NFs para verificar a sequência
-        sorted_nfs = group_df.sort_values(by='Número da NF_int')
-        nf_numbers = sorted_nfs['Número da NF_int'].tolist()
-        
-        if not nf_numbers:
-            continue
-
-        # 1. Detectar Duplicatas
-        duplicated_numbers = sorted_nfs[sorted_nfs.duplicated(subset=['Número da NF_int'], keep=False)]
-        for _, row in duplicated_numbers.iterrows():
-            issues.append({
-                'Tipo de Problema': 'Número Duplicado',
-                'Prestador CNPJ': prestador_cnpj,
-                'Prestador Razão Social': row['Prestador Razão Social'],
-                'Competência': competencia,
-                'Número da NF Afetado': row['Número da NF_int'],
-                'Detalhes': f"A NF {row['Número da NF_int']} aparece mais de uma vez.",
-                'ID NFSe': row['ID NFSe']
-            })
-
-        # 2. Detectar Lacunas (Gaps) na sequência
-        # Pegar apenas os números únicos para verificar lacunas
-        unique_nf_numbers = sorted(list(set(nf_numbers)))
-        
-        if len(unique_nf_numbers) < 2:
-            continue # Não há sequência para verificar
-
-        for i in range(len(unique_nf_numbers) - 1):
-            current_nf = unique_nf_numbers[i]
-            next_nf = unique_nf_numbers[i+1]
-
-            if next_nf - current_nf > 1:
-                # Há um gap entre current_nf e next_nf
-                for missing_num in range(current_nf + 1, next_nf):
-                    # Verificar se o número "faltante" foi cancelado no DF original
-                    # É importante usar df_input aqui para checar as canceladas também
-                    was_cancelled = df_input[(df_input['Prestador CNPJ'] == prestador_cnpj) & 
-                                             (df_input['Competência'] == competencia) &
-                                             (df_input['Número da NF_int'] == missing_num) & 
-                                             (df_input['Status Cancelamento'] == 'Sim')]
-                    
-                    if not was_cancelled.empty:
-                        details = f"A NF {missing_num} está ausente na sequência de NFs ativas, mas foi emitida e CANCELADA."
-                        problem_type = 'Número Faltante (Cancelado)'
-                        nf_id_details = was_cancelled['ID NFSe'].iloc[0] if not was_cancelled['ID NFSe'].isnull().all() else 'N/A'
-                    else:
-                        details = f"A NF {missing_num} está ausente na sequência e não foi encontrada como emitida ou cancelada."
-                        problem_type = 'Número Faltante (Não Emitido)'
-                        nf_id_details = 'N/A'
-
-                    issues.append({
-                        'Tipo de Problema': problem_type,
-                        'Prestador CNPJ': prestador_cnpj,
-                        'Prestador Razão Social': group_df['Prestador Razão Social'].iloc[0], # Pega a razão social do primeiro da lista
-                        'Competência': competencia,
-                        'Número da NF Afetado': missing_num,
-                        'Detalhes': details,
-                        'ID NFSe': nf_id_details
-                    })
-    
-    if not issues:
-        return pd.DataFrame(columns=[
-            'Tipo de Problema', 'Prestador CNPJ', 'Prestador Razão Social', 
-            'Competência', 'Número da NF Afetado', 'Detalhes', 'ID NFSe'
-        ])
-    return pd.DataFrame(issues)
-
-
-# --- Função para converter e formatar o DataFrame ---
-def format_dataframe_for_display(df):
-    # Fazer uma cópia para evitar SettingWithCopyWarning
-    df_formatted = df.copy()
-
-    # 1. Renomear colunas (colunas existentes serão renomeadas antes de serem usadas nos cálculos)
-    # É importante que as chaves de column_display_names (nomes originais) sejam as mesmas do df.
-    df_formatted = df_formatted.rename(columns={k: v for k, v in column_display_names.items() if k in df_formatted.columns})
-
-    # 2. Converter tipos de dados e formatar
-    # Note que 'Aliquota' não está aqui porque é uma porcentagem e é tratada separadamente no column_config.
-    numeric_cols_original_keys_for_conversion = [
-        'ValorServicos', 'ValorDeducoes', 'ValorPis', 'ValorCofins', 'ValorInss',
-        'ValorIr', 'ValorCsll', 'ValorIss', 'ValorIssRetido', 'OutrasRetencoes',
-        'BaseCalculo', 'ValorLiquidoNfse', 'DescontoIncondicionado', 'DescontoCondicionado'
-    ]
-    
-    # Use os nomes já renomeados para o DataFrame
-    numeric_cols_display_for_conversion = [column_display_names[key] for key in numeric_cols_original_keys_for_conversion if key in column_display_names]
-
-    for col_disp_name in numeric_cols_display_for_conversion:
-        if col_disp_name in df_formatted.columns:
-            df_formatted[col_disp_name] = pd.to_numeric(df_formatted[col_disp_name], errors='coerce').fillna(0).astype(float)
-    
-    # Aliquota é numérica mas tratada como porcentagem na exibição, não precisa de R\$
-    if 'Alíquota' in df_formatted.columns:
-        df_formatted['Alíquota'] = pd.to_numeric(df_formatted['Alíquota'], errors='coerce').fillna(0).astype(float)
-
-
-    # Colunas que devem ser datas e cálculo da Competência
-    if 'Data Emissão' in df_formatted.columns:
-        df_formatted['Data Emissão'] = pd.to_datetime(df_formatted['Data Emissão'], errors='coerce')
-        if isinstance(df_formatted['Data Emissão'].dtype, pd.DatetimeTZDtype): # Corrigido: Linha 222 (DeprecationWarning)
-            df_formatted['Data Emissão'] = df_formatted['Data Emissão'].dt.tz_localize(None)
-        df_formatted['Competência'] = df_formatted['Data Emissão'].dt.strftime('%Y-%m')
-
-    # Mapear códigos para textos legíveis para 'Simples Nacional' e 'ISS Retido (Cód)'
-    if 'Simples Nacional' in df_formatted.columns:
-        df_formatted['Simples Nacional'] = df_formatted['Simples Nacional'].astype(str).replace({'1': 'Sim', '2': 'Não', '': np.nan}).fillna('Não Informado')
-    if 'ISS Retido (Cód)' in df_formatted.columns:
-        df_formatted['ISS Retido (Cód)'] = df_formatted['ISS Retido (Cód)'].astype(str).replace({'1': 'Sim', '2': 'Não', '': np.nan}).fillna('Não Informado')
-
-    # Adicionar Prestador Regime
-    if 'Simples Nacional' in df_formatted.columns:
-        df_formatted['Prestador Regime'] = df_formatted['Simples Nacional'].apply(
-            lambda x: 'Simples Nacional' if x == 'Sim' else 'Lucro Presumido' if x == 'Não' else 'Não Informado'
-        )
-
-    # Adicionar Tomador Tipo (Pessoa Física/Jurídica)
-    if 'Tomador CNPJ/CPF' in df_formatted.columns:
-        df_formatted['Tomador Tipo'] = df_formatted['Tomador CNPJ/CPF'].astype(str).str.replace(r'[^0-9]', '', regex=True).apply(
-            lambda x: 'Pessoa Física' if len(x) == 11 else 'Pessoa Jurídica' if len(x) == 14 else 'Não Identificado'
-        )
-    
-    # Garantir que 'Status Cancelamento' existe (deve vir do parser, mas como fallback)
-    if 'Status Cancelamento' not in df_formatted.columns:
-        df_formatted['Status Cancelamento'] = 'Não' # Default para 'Não' se não vier do parser
-
-    # --- 3. Calcular Retenções Esperadas e Status de Conferência ---
-    # Inicializa as novas colunas com valores padrão
-    df_formatted['IR Esperado'] = 0.0
-    df_formatted['CSLL Esperado'] = 0.0
-    df_formatted['PIS Esperado'] = 0.0
-    df_formatted['COFINS Esperado'] = 0.0
-    df_formatted['ISSQN Esperado'] = 0.0
-
-    df_formatted['Status IR'] = 'Não Aplicável'
-    df_formatted['Status CSLL'] = 'Não Aplicável'
-    df_formatted['Status PIS'] = 'Não Aplicável'
-    df_formatted['Status COFINS'] = 'Não Aplicável'
-    df_formatted['Status ISS Retido'] = 'Não Aplicável'
-    df_formatted['Status Geral Retenções'] = 'Não Aplicável'
-
-    # Itera sobre o DataFrame para aplicar a lógica de conferência
-    # Usamos .loc para atribuir valores e evitar SettingWithCopyWarning
-    for index, row in df_formatted.iterrows():
-
-        # Cenário A: Nota Cancelada
-        if row['Status Cancelamento'] == 'Sim':
-            df_formatted.loc[index, ['Status IR', 'Status CSLL', 'Status PIS', 'Status COFINS', 'Status ISS Retido', 'Status Geral Retenções']] = 'Cancelado'
-            continue # Pula para a próxima nota
-
-        # Cenário B: Prestador Simples Nacional ou Tomador Pessoa Física
-        # Nessas condições, não deveria haver retenção. Se houver, é uma retenção indevida.
-        if row['Prestador Regime'] == 'Simples Nacional' or row['Tomador Tipo'] == 'Pessoa Física':
-            is_ir_retido = row['IR'] > 0.01
-            is_csll_retido = row['CSLL'] > 0.01
-            is_pis_retido = row['PIS'] > 0.01
-            is_cofins_retido = row['COFINS'] > 0.01
-            is_iss_retido = row['Valor ISS Retido'] > 0.01
-
-            df_formatted.loc[index, 'Status IR'] = 'Retenção Indevida' if is_ir_retido else 'OK'
-            df_formatted.loc[index, 'Status CSLL'] = 'Retenção Indevida' if is_csll_retido else 'OK'
-            df_formatted.loc[index, 'Status PIS'] = 'Retenção Indevida' if is_pis_retido else 'OK'
-            df_formatted.loc[index, 'Status COFINS'] = 'Retenção Indevida' if is_cofins_retido else 'OK'
-            df_formatted.loc[index, 'Status ISS Retido'] = 'Retenção Indevida' if is_iss_retido else 'OK'
-            
-            if any([is_ir_retido, is_csll_retido, is_pis_retido, is_cofins_retido, is_iss_retido]):
-                df_formatted.loc[index, 'Status Geral Retenções'] = 'INCONSISTÊNCIA (Retenção Indevida)'
-            else:
-                df_formatted.loc[index, 'Status Geral Retenções'] = 'OK'
-            continue
-
-        # Cenário C: Prestador Lucro Presumido e Tomador Pessoa Jurídica (onde retenções são esperadas)
-        if row['Prestador Regime'] == 'Lucro Presumido' and row['Tomador Tipo'] == 'Pessoa Jurídica':
-            valor_servicos = row['Valor dos Serviços'] # Já convertido para float
-            base_calculo = row['Base de Cálculo'] # Já convertido para float
-            aliquota_xml = row['Alíquota'] # Já convertido para float
-
-            # IRPJ
-            ir_esperado = calcular_irrf_esperado(valor_servicos)
-            df_formatted.loc[index, 'IR Esperado'] = ir_esperado
-            if np.isclose(row['IR'], ir_esperado, atol=0.01):
-                df_formatted.loc[index, 'Status IR'] = 'OK'
-            else:
-                df_formatted.loc[index, 'Status IR'] = 'Divergência'
-
-            # CSLL, PIS, COFINS (CSRF)
-            csrf_esperado_valores = calcular_csrf_esperado(valor_servicos)
-            
-            df_formatted.loc[index, 'CSLL Esperado'] = csrf_esperado_valores['CSLL']
-            if np.isclose(row['CSLL'], csrf_esperado_valores['CSLL'], atol=0.01):
-                df_formatted.loc[index, 'Status CSLL'] = 'OK'
-            else:
-                df_formatted.loc[index, 'Status CSLL'] = 'Divergência'
-
-            df_formatted.loc[index, 'PIS Esperado'] = csrf_esperado_valores['PIS']
-            if np.isclose(row['PIS'], csrf_esperado_valores['PIS'], atol=0.01):
-                df_formatted.loc[index, 'Status PIS'] = 'OK'
-            else:
-                df_formatted.loc[index, 'Status PIS'] = 'Divergência'
-
-            df_formatted.loc[index, 'COFINS Esperado'] = csrf_esperado_valores['COFINS']
-            if np.isclose(row['COFINS'], csrf_esperado_valores['COFINS'], atol=0.01):
-                df_formatted.loc[index, 'Status COFINS'] = 'OK'
-            else:
-                df_formatted.loc[index, 'Status COFINS'] = 'Divergência'
-
-            
-            # ISSQN Retido
-            valor_iss_retido_xml = row['Valor ISS Retido']
-            iss_retido_xml_code = row['ISS Retido (Cód)'] # 'Sim' ou 'Não' (do mapeamento)
-            
-            if iss_retido_xml_code == 'Sim': # Se o XML indica que ISS foi retido
-                iss_esperado = calcular_issqn_esperado(base_calculo, aliquota_xml)
-                df_formatted.loc[index, 'ISSQN Esperado'] = iss_esperado
-                if np.isclose(valor_iss_retido_xml, iss_esperado, atol=0.01):
-                    df_formatted.loc[index, 'Status ISS Retido'] = 'OK (Conferir Alíquota)'
-                else:
-                    df_formatted.loc[index, 'Status ISS Retido'] = 'Divergência (ISSQN)'
-            elif iss_retido_xml_code == 'Não' and valor_iss_retido_xml > 0.01:
-                # O XML diz que não reteve, mas há um valor retido. Isso é uma inconsistência.
-                df_formatted.loc[index, 'Status ISS Retido'] = 'Retenção Indevida (ISSQN)'
-                df_formatted.loc[index, 'ISSQN Esperado'] = 0.0 # Nao era pra ter retido, entao esperado é 0
-            else: # Se o XML não indica retenção ou valor é 0, e não é indevida
-                df_formatted.loc[index, 'Status ISS Retido'] = 'Não Retido (OK)'
-                df_formatted.loc[index, 'ISSQN Esperado'] = 0.0 # Não retido = 0 esperado
-
-            # Determinar Status Geral de Retenções para este cenário
-            statuses = [df_formatted.loc[index, 'Status IR'], df_formatted.loc[index, 'Status CSLL'],
-                        df_formatted.loc[index, 'Status PIS'], df_formatted.loc[index, 'Status COFINS'],
-                        df_formatted.loc[index, 'Status ISS Retido']]
-
-            if any(s in ['Divergência', 'Retenção Indevida'] for s in statuses):
-                df_formatted.loc[index, 'Status Geral Retenções'] = 'INCONSISTÊNCIA'
-            elif any(s in ['OK (Conferir Alíquota)', 'Não Retido (OK)'] for s in statuses) and \
-                 not any(s in ['Divergência', 'Retenção Indevida'] for s in statuses):
-                 df_formatted.loc[index, 'Status Geral Retenções'] = 'OK'
-            else: # P. ex., 'Não Aplicável' para todos ou outros casos que podem ser 'OK'
-                df_formatted.loc[index, 'Status Geral Retenções'] = 'OK' # Default para OK se não encontrar inconsistências ou atenção específicas
-    
-    # INÍCIO DA CORREÇÃO: Linha 399 (Formatação para string e uso de TextColumn)
-    for col in currency_cols_for_display:
-        if col in df_formatted.columns:
-            # Formatação para R\$ X.XXX,XX (ponto para milhar, vírgula para decimal)
-            # Verifica se o valor é numérico antes de formatar para evitar erro em None/NaN
-            if pd.api.types.is_numeric_dtype(df_formatted[col]):
-                df_formatted[col] = df_formatted[col].apply(lambda x: f"R$ {x:_.2f}".replace('.', '#').replace('_', '.').replace('#', ',') if pd.notna(x) else None)
-            else: # Se já não for numérico (e.g., 'CANCELADA'), mantém como está
-                pass
-    # FIM DA CORREÇÃO
-
-    # Definição do column_config para o st.dataframe
-    # Reconstruímos o dicionário para ter certeza de que as colunas de moeda estão como TextColumn
+    # As colunas de moeda são TextColumn, pois chegam pré-formatadas como string ("R$ X.XXX,XX")
     config = {
         'Data Emissão': st.column_config.DatetimeColumn(
             "Data Emissão", format="DD/MM/YYYY HH:mm", help="Data e hora de emissão da NFSe"
@@ -554,7 +251,7 @@ def format_dataframe_for_display(df):
         ),
         
         # Colunas de Moeda (agora serão TextColumn pois foram pré-formatadas como string)
-        **{col: st.column_config.TextColumn(col) for col in currency_cols_for_display if col in df_formatted.columns},
+        **{col: st.column_config.TextColumn(col) for col in currency_cols_for_display if col in df_display.columns},
 
         # Outras colunas
         'Alíquota': st.column_config.NumberColumn(
@@ -590,13 +287,64 @@ def format_dataframe_for_display(df):
 
     # Adiciona colunas que podem não estar diretamente na lista de moeda, mas que precisam de config
     # Ex: Prestador CNPJ, Tomador CNPJ/CPF
-    if 'Prestador CNPJ' in df_formatted.columns:
+    if 'Prestador CNPJ' in df_display.columns:
         config['Prestador CNPJ'] = st.column_config.TextColumn('Prestador CNPJ')
-    if 'Tomador CNPJ/CPF' in df_formatted.columns:
+    if 'Tomador CNPJ/CPF' in df_display.columns:
         config['Tomador CNPJ/CPF'] = st.column_config.TextColumn('Tomador CNPJ/CPF')
 
 
-    return df_formatted, config
+    return config
+
+def finalize_extracted_data(all_extracted_data, cache_key=None):
+    """
+    Formata os dados extraídos, detecta problemas de sequência e guarda o resultado no session_state
+    (e no cache compartilhado, na chave informada, para as outras sessões).
+    """
+    # Notas repetidas (mesma nota em arquivos diferentes) saem antes de entrar nos totais
+    with etapa("Remoção de notas repetidas"):
+        all_extracted_data, repeated_notes = remove_duplicate_notes(all_extracted_data)
+    for data in repeated_notes:
+        st.session_state.diagnosis_messages.append(
+            f"⚠️ Atenção: NF **{data.get('Numero')}** (prestador {data.get('Prestador.CpfCnpj')}) recebida mais de uma vez; a cópia foi desconsiderada."
+        )
+    if repeated_notes:
+        log_message_viewer(f"{len(repeated_notes)} NFSe repetidas desconsideradas nos totais.", "warning")
+
+    with etapa("Montagem do DataFrame"):
+        df_nfses = pd.DataFrame(all_extracted_data)
+
+    with etapa("format_dataframe_for_display"):
+        df_formatted = format_dataframe_for_display(
+            df_nfses, format_currency=False, regras=st.session_state.regras_conferencia
+        )
+    # Passa o DataFrame JÁ PROCESSADO e RENOMEADO para a função detect_sequence_issues (que não o altera)
+    colunas_ausentes = colunas_ausentes_sequencia(df_formatted)
+    if colunas_ausentes:
+        log_message_viewer(
+            f"Não foi possível realizar a análise de sequência de NF. Colunas ausentes no DataFrame: {', '.join(colunas_ausentes)}",
+            "warning",
+        )
+    with etapa("detect_sequence_issues"):
+        st.session_state.sequence_issues = detect_sequence_issues(df_formatted)
+
+    if st.session_state.get("usar_parquet_viewer"):
+        # Modo de baixo uso de memória: as notas vão para o disco e cada competência é lida quando exibida
+        with etapa("Gravação do conjunto Parquet"):
+            st.session_state.conjunto_analitico = gravar_conjunto(df_formatted)
+        return
+
+    # Notas agrupadas por competência uma vez só: nos reruns, cada competência é exibida como visão
+    with etapa("indexar_competencias"):
+        df_formatted, st.session_state.faixas_competencia = indexar_competencias(df_formatted)
+    # Base numérica guardada antes da formatação monetária: a re-conferência com outras regras parte dela
+    with etapa("base_conferencia"):
+        st.session_state.conferencia_base = base_conferencia(df_formatted)
+    with etapa("format_currency_columns"):
+        st.session_state.df_processed_viewer = format_currency_columns(df_formatted)
+    if cache_key is not None:
+        with etapa("Cache compartilhado (guardar)"):
+            guardar_no_cache(cache_key, {key: st.session_state[key] for key in CACHED_RESULT_KEYS})
+
 
 # --- Seção de Upload de Arquivos XML ---
 st.header("1. Upload dos Arquivos XML")
@@ -607,132 +355,259 @@ uploaded_files_viewer = st.file_uploader(
     key="xml_uploader_viewer"
 )
 
+validate_xmls = st.checkbox(
+    "Validar os XMLs antes da conferência (campos obrigatórios e esquema XSD, se disponível)",
+    help="XMLs malformados, de layout desconhecido ou fora do esquema são listados no diagnóstico e ficam fora dos totais.",
+    key="validate_xmls_viewer",
+)
+
+st.checkbox(
+    "Modo de baixo uso de memória: manter as notas processadas em disco (Parquet) e carregar só a competência exibida",
+    help="Indicado para um ano inteiro de um cliente grande. Vale também para a carga do banco de dados.",
+    key="usar_parquet_viewer",
+)
+
 # --- Botão de Processamento Principal ---
 st.markdown("---")
 # CORREÇÃO: Linha 550 - Substitui use_container_width=True por width='stretch'
 if st.button("PROCESSAR XMLs para Visualização", type="primary", width='stretch'):
-    st.session_state.log_messages_viewer = []
-    st.session_state.df_processed_viewer = None
-    st.session_state.selected_columns = default_cols_to_show_initial.copy() # Reseta para a ordem padrão
-    st.session_state.column_config = {} # Limpa a config de colunas ao reprocessar
-    st.session_state.diagnosis_messages = [] # Limpa as mensagens de diagnóstico
-    st.session_state.sequence_issues = pd.DataFrame() # Limpa problemas de sequência ao reprocessar
+    reset_processing_state()
+    # Impressão digital do conjunto enviado: conteúdo dos arquivos, validação e regras da conferência
+    upload_cache_key = chave_conjunto(
+        'upload', validate_xmls, st.session_state.regras_conferencia,
+        [(f.name, hashlib.sha256(f.getvalue()).hexdigest()) for f in uploaded_files_viewer or []],
+    )
     
     if not uploaded_files_viewer:
         log_message_viewer("Por favor, faça o upload de pelo menos um arquivo XML.", "error")
+    elif restore_cached_result(upload_cache_key):
+        st.success("Processamento dos XMLs concluído! Visualize os dados abaixo.")
     else:
         log_message_viewer("\n--- INICIANDO PROCESSAMENTO NFSe para Visualização ---")
         log_message_viewer(f"Encontrados {len(uploaded_files_viewer)} arquivos XML carregados.")
 
-        try:
-            all_extracted_data = []
+        with captura_do_processamento("upload") as arquivos_perfil:
+            try:
+                all_extracted_data = []
             
-            progress_bar = st.progress(0)
-            status_text = st.empty()
-            temp_files_to_clean = []
-            
-            for i, uploaded_file in enumerate(uploaded_files_viewer):
-                progress_percent = (i + 1) / len(uploaded_files_viewer)
-                progress_bar.progress(progress_percent)
-                status_text.text(f"Processando arquivo: {uploaded_file.name} ({i+1}/{len(uploaded_files_viewer)})")
+                progress_bar = st.progress(0)
+                status_text = st.empty()
+                temp_files_to_clean = []
+
+                with etapa("Validação e extração dos XMLs" if validate_xmls else "Extração dos XMLs"):
+                    if validate_xmls:
+                        # Validação e extração juntas (mesma árvore), em paralelo; XML inválido fica fora dos totais
+                        def update_progress(done, total):
+                            progress_bar.progress(done / total)
+                            status_text.text(f"Validando e extraindo: {done}/{total}")
+
+                        xml_files = [(uploaded_file.name, uploaded_file.getvalue()) for uploaded_file in uploaded_files_viewer]
+                        invalid_count = 0
+                        for file_name, data, errors in validar_e_extrair_lote(xml_files, progresso=update_progress):
+                            if errors:
+                                invalid_count += 1
+                                st.session_state.diagnosis_messages.append(
+                                    f"❌ XML inválido **{file_name}** (desconsiderado): " + "; ".join(errors)
+                                )
+                            elif data:
+                                all_extracted_data.append(data)
+                        if invalid_count:
+                            log_message_viewer(f"{invalid_count} XMLs reprovados na validação e desconsiderados nos totais.", "warning")
+                    else:
+                        for i, uploaded_file in enumerate(uploaded_files_viewer):
+                            progress_percent = (i + 1) / len(uploaded_files_viewer)
+                            progress_bar.progress(progress_percent)
+                            status_text.text(f"Processando arquivo: {uploaded_file.name} ({i+1}/{len(uploaded_files_viewer)})")
                 
-                with tempfile.NamedTemporaryFile(delete=False, suffix=".xml") as tmp_file:
-                    tmp_file.write(uploaded_file.read())
-                    tmp_file_path = tmp_file.name
-                temp_files_to_clean.append(tmp_file_path)
-
-                data = extract_nfse_data(tmp_file_path)
-                if data:
-                    all_extracted_data.append(data)
-                else:
-                    st.session_state.diagnosis_messages.append(f"⚠️ Atenção: Não foi possível extrair dados completos de **{uploaded_file.name}**.")
-                    log_message_viewer(f"Atenção: Não foi possível extrair dados completos de {uploaded_file.name}.", "warning")
+                            with tempfile.NamedTemporaryFile(delete=False, suffix=".xml") as tmp_file:
+                                tmp_file.write(uploaded_file.read())
+                                tmp_file_path = tmp_file.name
+                            temp_files_to_clean.append(tmp_file_path)
+
+                            data = extract_nfse_data(tmp_file_path)
+                            if data:
+                                all_extracted_data.append(data)
+                            else:
+                                st.session_state.diagnosis_messages.append(f"⚠️ Atenção: Não foi possível extrair dados completos de **{uploaded_file.name}**.")
+                                log_message_viewer(f"Atenção: Não foi possível extrair dados completos de {uploaded_file.name}.", "warning")
             
-            progress_bar.empty()
-            status_text.empty()
+                progress_bar.empty()
+                status_text.empty()
             
-            log_message_viewer(f"Total de NFSe com dados extraídos com sucesso: {len(all_extracted_data)}")
+                log_message_viewer(f"Total de NFSe com dados extraídos com sucesso: {len(all_extracted_data)}")
 
-            if all_extracted_data:
-                df_nfses = pd.DataFrame(all_extracted_data)
-                
-                # A formatação é feita aqui, e o st.session_state.column_config é preenchido
-                st.session_state.df_processed_viewer, st.session_state.column_config = format_dataframe_for_display(df_nfses)
-                
-                # NOVO: Detecta problemas de sequência
-                # Corrigido: Linha 609 - Passa o DataFrame JÁ PROCESSADO e RENOMEADO para a função detect_sequence_issues
-                st.session_state.sequence_issues = detect_sequence_issues(st.session_state.df_processed_viewer.copy())
+                if all_extracted_data:
+                    finalize_extracted_data(all_extracted_data, upload_cache_key)
                 
-                log_message_viewer(f"\nProcessamento dos XMLs concluído para visualização!", "success")
-                st.success(f"Processamento dos XMLs concluído! Visualize os dados abaixo.")
+                    log_message_viewer(f"\nProcessamento dos XMLs concluído para visualização!", "success")
+                    st.success(f"Processamento dos XMLs concluído! Visualize os dados abaixo.")
 
-            else:
-                log_message_viewer("Nenhum dado de NFSe válido foi extraído dos arquivos XML carregados.", "warning")
-                st.warning("Nenhum dado de NFSe válido foi extraído para visualização.")
+                else:
+                    log_message_viewer("Nenhum dado de NFSe válido foi extraído dos arquivos XML carregados.", "warning")
+                    st.warning("Nenhum dado de NFSe válido foi extraído para visualização.")
+
+            except Exception as e:
+                log_message_viewer(f"ERRO CRÍTICO DURANTE O PROCESSAMENTO: {e}", "error")
+                st.error(f"Ocorreu um erro durante o processamento: {e}")
+            finally:
+                for tfp in temp_files_to_clean:
+                    try:
+                        os.remove(tfp)
+                    except OSError as e:
+                        log_message_viewer(f"Erro ao remover arquivo temporário {tfp}: {e}", "error")
+        registrar_arquivos_perfil(arquivos_perfil)
+
+
+# --- Carga Direta do Banco de Dados ---
+# As NFS-e enviadas pelo app.py ficam armazenadas por cliente; aqui elas são lidas em lotes
+# a partir dos campos já extraídos, sem download e reenvio dos XMLs.
+with st.expander("Ou carregar NFS-e já armazenadas no banco de dados", expanded=False):
+    # Anos fechados ficam em partições próprias (somente leitura), anexadas só durante a leitura
+    base_banco = st.selectbox("Base", ["Atual"] + anos_arquivados(), key="base_banco_viewer")
+    abrir_sessao_banco = session_scope if base_banco == "Atual" else (lambda: sessao_particao(base_banco))
+
+    with abrir_sessao_banco() as session:
+        clientes_banco = listar_clientes(session)
+
+    if not clientes_banco:
+        st.info("Nenhuma NFS-e armazenada no banco de dados.")
+    else:
+        cliente_banco = st.selectbox("Cliente", clientes_banco, key="cliente_banco_viewer")
+        with abrir_sessao_banco() as session:
+            competencias_banco = listar_competencias(session, cliente_banco)
 
-        except Exception as e:
-            log_message_viewer(f"ERRO CRÍTICO DURANTE O PROCESSAMENTO: {e}", "error")
-            st.error(f"Ocorreu um erro durante o processamento: {e}")
-        finally:
-            for tfp in temp_files_to_clean:
-                try:
-                    os.remove(tfp)
-                except OSError as e:
-                    log_message_viewer(f"Erro ao remover arquivo temporário {tfp}: {e}", "error")
+        if not competencias_banco:
+            st.info("Nenhuma competência encontrada para este cliente. Preencha os campos pendentes no app de armazenamento.")
+        else:
+            col_inicio, col_fim = st.columns(2)
+            with col_inicio:
+                competencia_inicial = st.selectbox(
+                    "Competência inicial", competencias_banco,
+                    index=len(competencias_banco) - 1, key="competencia_inicial_viewer"
+                )
+            with col_fim:
+                competencia_final = st.selectbox(
+                    "Competência final", competencias_banco,
+                    index=len(competencias_banco) - 1, key="competencia_final_viewer"
+                )
 
+            if st.button("CARREGAR DO BANCO DE DADOS", width='stretch'):
+                reset_processing_state()
+                if competencia_inicial > competencia_final:
+                    log_message_viewer("A competência inicial deve ser anterior ou igual à competência final.", "error")
+                else:
+                    log_message_viewer(f"\n--- CARREGANDO NFSe DO BANCO: {cliente_banco} ({competencia_inicial} a {competencia_final}) ---")
+                    # A assinatura muda quando o conjunto no banco muda (novas notas, campos, cancelamentos)
+                    with abrir_sessao_banco() as session:
+                        db_cache_key = chave_conjunto(
+                            'banco', base_banco, cliente_banco, competencia_inicial, competencia_final,
+                            assinatura_notas(session, cliente_banco, competencia_inicial, competencia_final),
+                            st.session_state.regras_conferencia,
+                        )
+                    with captura_do_processamento("banco") as arquivos_perfil:
+                        try:
+                            if restore_cached_result(db_cache_key):
+                                all_extracted_data = None
+                            else:
+                                with etapa("Leitura do banco"):
+                                    all_extracted_data = []
+                                    status_text = st.empty()
+                                    with abrir_sessao_banco() as session:
+                                        for lote in iterar_notas_extraidas(
+                                            session, cliente_banco, competencia_inicial, competencia_final,
+                                            tamanho_lote=TAMANHO_LOTE_CARGA_BANCO
+                                        ):
+                                            all_extracted_data.extend(lote)
+                                            status_text.text(f"NFS-e lidas do banco: {len(all_extracted_data)}")
+                                    status_text.empty()
+                                    log_message_viewer(f"Total de NFSe carregadas do banco: {len(all_extracted_data)}")
+
+                            if all_extracted_data is None:
+                                log_message_viewer(f"\nCarga do banco concluída para visualização!", "success")
+                            elif all_extracted_data:
+                                finalize_extracted_data(all_extracted_data, db_cache_key)
+                                log_message_viewer(f"\nCarga do banco concluída para visualização!", "success")
+                            else:
+                                log_message_viewer("Nenhuma NFS-e encontrada para o cliente e período selecionados.", "warning")
+                        except Exception as e:
+                            log_message_viewer(f"ERRO CRÍTICO DURANTE A CARGA DO BANCO: {e}", "error")
+                            st.error(f"Ocorreu um erro durante a carga do banco: {e}")
+                    registrar_arquivos_perfil(arquivos_perfil)
+
+
+marco(cronometro_rerun, "Upload, carga do banco e processamento")
 
 # --- Exibição de Resultados e Logs ---
 st.header("2. Conferência de Notas Fiscais e Diagnóstico")
 
-if st.session_state.df_processed_viewer is not None and not st.session_state.df_processed_viewer.empty:
-    df_full = st.session_state.df_processed_viewer.copy()  # Trabalhar com uma cópia
-
-    if 'Competência' in df_full.columns:
-        # Padronizar a coluna Competência
-        df_full['Competência'] = pd.to_datetime(
-            df_full['Competência'], format='%Y-%m', errors='coerce'
-        ).dt.strftime('%Y-%m')  # Formatar no padrão YYYY-MM
-
-        # Remove valores NaN/NaT resultantes da conversão inválida
-        df_full = df_full.dropna(subset=['Competência'])
+cache_stats = estatisticas_cache()
+st.sidebar.caption(
+    f"Cache compartilhado: {cache_stats['conjuntos']} conjunto(s), "
+    f"{cache_stats['memoria_mb']:.0f} de {cache_stats['limite_mb']:.0f} MB"
+)
 
-        # Ordenar as competências únicas de forma decrescente
-        available_competencias = sorted(df_full['Competência'].unique(), reverse=True)
+# --- Regras Tributárias (versionadas) e Re-conferência ---
+# Alterar uma alíquota ou limite recalcula só os valores esperados e os status, a partir da base
+# numérica guardada no processamento (sem reprocessar os XMLs)
+with st.expander("Regras tributárias da conferência", expanded=False):
+    versoes_regras = carregar_versoes_regras()
+    versao_selecionada = st.selectbox(
+        "Partir da versão:",
+        options=versoes_regras[::-1],
+        format_func=lambda v: f"Versão {v['versao']} - {v['descricao'] or 'sem descrição'}" + (f" ({v['criada_em']})" if v['criada_em'] else ""),
+        key="versao_regras",
+    )
+    regras_editadas = {}
+    col_regras_1, col_regras_2 = st.columns(2)
+    for i, (chave, rotulo) in enumerate(DESCRICAO_REGRAS.items()):
+        coluna = col_regras_1 if i % 2 == 0 else col_regras_2
+        regras_editadas[chave] = coluna.number_input(
+            rotulo, value=float(versao_selecionada['regras'][chave]), min_value=0.0,
+            step=0.0001 if chave.startswith('aliquota') else 0.01,
+            format="%.4f" if chave.startswith('aliquota') else "%.2f",
+            key=f"regra-{versao_selecionada['versao']}-{chave}",
+        )
+    if regras_editadas != st.session_state.regras_conferencia:
+        st.caption("As regras acima diferem das usadas na conferência exibida.")
+
+    col_aplicar, col_salvar = st.columns(2)
+    with col_aplicar:
+        if st.button("Aplicar à conferência (simulação)", width='stretch'):
+            st.session_state.regras_conferencia = regras_editadas
+            if st.session_state.conferencia_base is not None:
+                inicio = time.perf_counter()
+                atualizar_conferencia(st.session_state.df_processed_viewer, st.session_state.conferencia_base, regras_editadas)
+                st.success(f"Re-conferência de {len(st.session_state.conferencia_base)} notas em {time.perf_counter() - inicio:.2f} s.")
+            elif st.session_state.conjunto_analitico is not None:
+                st.success("Regras aplicadas: a competência exibida é conferida com elas ao ser carregada.")
+    with col_salvar:
+        descricao_regras = st.text_input("Descrição da nova versão:", key="descricao_regras")
+        if st.button("Salvar como nova versão", width='stretch'):
+            nova_versao = salvar_versao_regras(regras_editadas, descricao_regras)
+            st.success(f"Regras gravadas como versão {nova_versao}.")
+
+marco(cronometro_rerun, "Regras tributárias")
+
+conjunto_analitico = st.session_state.conjunto_analitico
+if conjunto_analitico is not None and not conjunto_disponivel(conjunto_analitico):
+    # Sessão sem uso além do prazo: o conjunto Parquet foi apagado pela limpeza (nfse_analitico)
+    st.warning("As notas processadas desta sessão foram removidas do disco por inatividade. Processe os arquivos novamente.")
+    st.session_state.conjunto_analitico = conjunto_analitico = None
+if conjunto_analitico is not None or (st.session_state.df_processed_viewer is not None and not st.session_state.df_processed_viewer.empty):
+    if conjunto_analitico is not None:
+        # Modo Parquet: competências e totais vêm dos arquivos, sem carregar o conjunto
+        available_competencias = listar_competencias_conjunto(conjunto_analitico)
+        with st.expander("Resumo por competência (todas as notas processadas)", expanded=False):
+            st.dataframe(resumo_competencias(conjunto_analitico), width='stretch', hide_index=True)
     else:
-        st.warning("A coluna 'Competência' não foi encontrada no DataFrame.")
-        available_competencias = []
-
-    # --- Seletor de Competência ---
-if 'Competência' in df_full.columns:
-    # Garantir que a coluna Competência esteja no formato correto (YYYY-MM)
-    df_full['Competência'] = pd.to_datetime(
-        df_full['Competência'], format='%Y-%m', errors='coerce'
-    ).dt.strftime('%Y-%m')  # Formata para ano-mês
+        # As notas já estão agrupadas por competência (AAAA-MM, indexar_competencias no processamento):
+        # nada é copiado nem reconvertido a cada rerun. Notas sem competência ficam fora das faixas.
+        df_full = st.session_state.df_processed_viewer
 
-    # Remove valores inválidos (NaT ou células sem dados)
-    df_full = df_full.dropna(subset=['Competência'])
+        # Ordenar as competências de forma decrescente
+        available_competencias = sorted(st.session_state.faixas_competencia, reverse=True)
 
-    # Ordena as competências de maneira decrescente
-    available_competencias = sorted(df_full['Competência'].unique(), reverse=True)
-else:
-    st.warning("A coluna 'Competência' não foi encontrada no DataFrame.")
-    available_competencias = df_full['Competência'].unique().tolist() if 'Competência' in df_full.columns else []
-    # Garantir que a coluna Competência esteja no formato correto (YYYY-MM)
-    df_full['Competência'] = pd.to_datetime(
-        df_full['Competência'], format='%Y-%m', errors='coerce'
-    ).dt.strftime('%Y-%m')  # Formata para ano-mês
-
-    # Remove valores inválidos (NaT ou células sem dados)
-    df_full = df_full.dropna(subset=['Competência'])
-
-    # Ordena as competências de maneira decrescente
-    if 'Competência' in df_full.columns:
-        available_competencias = df_full['Competência'].unique().tolist()
-        available_competencias = sorted(available_competencias)
-    else:
-        available_competencias = []
-    st.warning("A coluna 'Competência' não foi encontrada no DataFrame.")
-    available_competencias = []
+    # --- Seletor de Competência ---
     if not available_competencias:
         st.warning("Não foi possível extrair competências das NFSe carregadas.")
         selected_competence = None
@@ -743,12 +618,19 @@ else:
             options=available_competencias,
             help="Selecione o mês e ano para o qual você deseja conferir as notas fiscais."
         )
-        # Filtra o DataFrame pela competência selecionada
-        df_competence = df_full[df_full['Competência'] == selected_competence].copy()
+        if conjunto_analitico is not None:
+            # Só a competência selecionada é lida do disco; a conferência usa as regras da sessão
+            df_competence = carregar_competencia(conjunto_analitico, selected_competence)
+            atualizar_conferencia(df_competence, base_conferencia(df_competence), st.session_state.regras_conferencia, format_currency=False)
+            df_competence, df_active_notes = filter_by_competence(format_currency_columns(df_competence), selected_competence)
+        else:
+            # Filtra o DataFrame pela competência selecionada (todas as notas e apenas as ativas,
+            # não canceladas, usadas nos cálculos e diagnósticos)
+            df_competence, df_active_notes = filter_by_competence(df_full, selected_competence, st.session_state.faixas_competencia)
+
+    marco(cronometro_rerun, "Competências e filtro da competência")
 
     if selected_competence and not df_competence.empty:
-        # NOVO: Filtra as notas ativas (não canceladas) para cálculos e diagnósticos
-        df_active_notes = df_competence[df_competence['Status Cancelamento'] == 'Não'].copy()
 
         # --- Informações do Prestador e Painel de Impostos (Baseado na competência e notas ATIVAS) ---
         st.subheader(f"Visão Geral da Competência: {selected_competence}")
@@ -807,80 +689,9 @@ else:
         # Verifica se há notas ativas antes de calcular
         if df_active_notes.empty:
             st.info("Não há notas ativas para calcular o painel de faturamento e impostos.")
-            total_faturamento = 0.0
-            total_ir_retido = 0.0
-            total_csll_retido = 0.0
-            total_pis_retido = 0.0
-            total_cofins_retido = 0.0
-            total_iss_retido = 0.0
-            base_calculo_issqn = 0.0
-            total_liquido_recebido = 0.0
-        else:
-            # Desformata temporariamente para fazer os cálculos, pois os valores estão em string "R\$ X.XXX,XX"
-            # df_active_notes é uma cópia, então não afetará o df_full original que já está formatado para display.
-            # Convertemos para float para somar.
-            temp_df = df_active_notes.copy()
-            for col in currency_cols_for_display:
-                if col in temp_df.columns:
-                    # Remove "R\$", pontos de milhar, e troca vírgula por ponto decimal para converter em float
-                    temp_df[col] = temp_df[col].astype(str).str.replace('R$', '', regex=False).str.replace('.', '', regex=False).str.replace(',', '.', regex=False)
-                    temp_df[col] = pd.to_numeric(temp_df[col], errors='coerce').fillna(0).astype(float)
-
-
-            # Faturamento
-            total_faturamento = temp_df['Valor dos Serviços'].sum()
-
-            # Impostos Retidos
-            total_ir_retido = temp_df['IR'].sum()
-            total_csll_retido = temp_df['CSLL'].sum()
-            total_pis_retido = temp_df['PIS'].sum()
-            total_cofins_retido = temp_df['COFINS'].sum()
-            total_iss_retido = temp_df['Valor ISS Retido'].sum()
-            
-            # Base de Cálculo para ISSQN
-            base_calculo_issqn = temp_df['Base de Cálculo'].sum()
-            total_liquido_recebido = temp_df['Valor Líquido NFSe'].sum()
-
-
-        # --- Cálculos para Lucro Presumido (Normal) ---
-        irpj_a_pagar = 0.0
-        csll_a_pagar = 0.0
-        pis_a_pagar = 0.0
-        cofins_a_pagar = 0.0
-        issqn_a_pagar = 0.0
-
-        if lucro_presumido_tipo_selection == "Normal": # Apenas se o tipo selecionado for "Normal"
-            # IRPJ: Faturamento * 4.8% - IR Retido
-            irpj_a_pagar = (total_faturamento * 0.048) - total_ir_retido
-            # CSLL: Faturamento * 2.88% - CSLL Retida
-            csll_a_pagar = (total_faturamento * 0.0288) - total_csll_retido
-            # PIS: Faturamento * 0.0065 - PIS Retido
-            pis_a_pagar = (total_faturamento * 0.0065) - total_pis_retido
-            # COFINS: Faturamento * 0.03 - COFINS Retida
-            cofins_a_pagar = (total_faturamento * 0.03) - total_cofins_retido
-            # ISSQN: Base de Cálculo * Alíquota de Referência (se não retido) - ISS Retido
-            issqn_a_pagar = (base_calculo_issqn * ALIQUOTA_ISSQN_REFERENCIA) - total_iss_retido
-       
-        # NOVO BLOCO: Cálculos para Lucro Presumido - Equiparação Hospitalar
-        elif lucro_presumido_tipo_selection == "Equiparação Hospitalar":
-            # IRPJ: Faturamento * 1.2% - IR Retido
-            irpj_a_pagar = (total_faturamento * ALIQUOTA_IRPJ_EQ_HOSP) - total_ir_retido
-            # CSLL: Faturamento * 1.08% - CSLL Retida
-            csll_a_pagar = (total_faturamento * ALIQUOTA_CSLL_EQ_HOSP) - total_csll_retido
-            # PIS: Faturamento * 0.65% - PIS Retido
-            pis_a_pagar = (total_faturamento * ALIQUOTA_PIS_EQ_HOSP) - total_pis_retido
-            # COFINS: Faturamento * 3.00% - COFINS Retida
-            cofins_a_pagar = (total_faturamento * ALIQUOTA_COFINS_EQ_HOSP) - total_cofins_retido
-            # ISSQN: Faturamento * 2.01% - ISS Retido (agora com base no faturamento)
-            issqn_a_pagar = (total_faturamento * ALIQUOTA_ISSQN_EQ_HOSP) - total_iss_retido
-        # Garante que os valores a pagar não são negativos (imposto já retido a maior)
-        irpj_a_pagar = max(0, irpj_a_pagar)
-        csll_a_pagar = max(0, csll_a_pagar)
-        pis_a_pagar = max(0, pis_a_pagar)
-        cofins_a_pagar = max(0, cofins_a_pagar)
-        issqn_a_pagar = max(0, issqn_a_pagar)
-
-        total_impostos_a_pagar = irpj_a_pagar + csll_a_pagar + pis_a_pagar + cofins_a_pagar + issqn_a_pagar
+
+        # Totais, retenções e estimativa de impostos a pagar conforme o tipo de Lucro Presumido
+        painel = compute_tax_panel(df_active_notes, lucro_presumido_tipo_selection, st.session_state.regras_conferencia)
 
         # Layout com colunas para o painel
         st.markdown("### Valores Gerais")
@@ -888,39 +699,40 @@ else:
         with col1:
             st.metric("Total de NFSe Ativas Processadas", len(df_active_notes))
         with col2:
-            st.metric("Total Faturamento Bruto", f"R$ {total_faturamento:,.2f}")
+            st.metric("Total Faturamento Bruto", f"R$ {painel['total_faturamento']:,.2f}")
         with col3:
-            st.metric("Valor Líquido Recebido (NFSe)", f"R$ {total_liquido_recebido:,.2f}")
+            st.metric("Valor Líquido Recebido (NFSe)", f"R$ {painel['total_liquido_recebido']:,.2f}")
 
         st.markdown("### Impostos Retidos")
         col_ir_ret, col_csll_ret, col_pis_ret, col_cofins_ret, col_iss_ret = st.columns(5)
         with col_ir_ret:
-            st.metric("IR Retido", f"R$ {total_ir_retido:,.2f}")
+            st.metric("IR Retido", f"R$ {painel['total_ir_retido']:,.2f}")
         with col_csll_ret:
-            st.metric("CSLL Retida", f"R$ {total_csll_retido:,.2f}")
+            st.metric("CSLL Retida", f"R$ {painel['total_csll_retido']:,.2f}")
         with col_pis_ret:
-            st.metric("PIS Retido", f"R$ {total_pis_retido:,.2f}")
+            st.metric("PIS Retido", f"R$ {painel['total_pis_retido']:,.2f}")
         with col_cofins_ret:
-            st.metric("COFINS Retida", f"R$ {total_cofins_retido:,.2f}")
+            st.metric("COFINS Retida", f"R$ {painel['total_cofins_retido']:,.2f}")
         with col_iss_ret:
-            st.metric("ISS Retido", f"R$ {total_iss_retido:,.2f}")
+            st.metric("ISS Retido", f"R$ {painel['total_iss_retido']:,.2f}")
 
         st.markdown("### Impostos a Pagar (Estimativa Lucro Presumido - Normal)")
         col_ir_pagar, col_csll_pagar, col_pis_pagar, col_cofins_pagar, col_iss_pagar, col_total_pagar = st.columns(6)
         with col_ir_pagar:
-            st.metric("IRPJ a Pagar", f"R$ {irpj_a_pagar:,.2f}")
+            st.metric("IRPJ a Pagar", f"R$ {painel['irpj_a_pagar']:,.2f}")
         with col_csll_pagar:
-            st.metric("CSLL a Pagar", f"R$ {csll_a_pagar:,.2f}")
+            st.metric("CSLL a Pagar", f"R$ {painel['csll_a_pagar']:,.2f}")
         with col_pis_pagar:
-            st.metric("PIS a Pagar", f"R$ {pis_a_pagar:,.2f}")
+            st.metric("PIS a Pagar", f"R$ {painel['pis_a_pagar']:,.2f}")
         with col_cofins_pagar:
-            st.metric("COFINS a Pagar", f"R$ {cofins_a_pagar:,.2f}")
+            st.metric("COFINS a Pagar", f"R$ {painel['cofins_a_pagar']:,.2f}")
         with col_iss_pagar:
-            st.metric("ISSQN a Pagar", f"R$ {issqn_a_pagar:,.2f}")
+            st.metric("ISSQN a Pagar", f"R$ {painel['issqn_a_pagar']:,.2f}")
         with col_total_pagar:
-            st.metric("Total Impostos a Pagar", f"R$ {total_impostos_a_pagar:,.2f}")
+            st.metric("Total Impostos a Pagar", f"R$ {painel['total_impostos_a_pagar']:,.2f}")
 
         st.markdown("---") # Separador visual
+        marco(cronometro_rerun, "Prestador e painel de impostos")
 
         # --- NOVA SEÇÃO: Dashboard de Retenções e Validações ---
         st.header("3. Dashboard de Retenções e Validações")
@@ -959,7 +771,9 @@ else:
                 
                 # Agrupa os status diferentes de OK/NA
                 if not filtered_statuses.empty:
-                    counts = filtered_statuses.value_counts().to_dict()
+                    # Colunas categóricas: value_counts lista todas as categorias, inclusive as filtradas acima (contagem 0)
+                    counts = filtered_statuses.value_counts()
+                    counts = counts[counts > 0].to_dict()
                     for status, count in counts.items():
                         # Concatena o nome do imposto com o status para o gráfico
                         key = f"{tax_status_col.replace('Status ', '')} - {status}"
@@ -1040,6 +854,7 @@ else:
 
 
         st.markdown("---") # Separador visual
+        marco(cronometro_rerun, "Dashboard de retenções")
 
         # NOVO: Seção de Análise de Sequência de Notas Fiscais
         # Linha 827
@@ -1109,6 +924,7 @@ else:
             st.info("Carregue e processe os XMLs para analisar a sequência de notas fiscais.")
             
         st.markdown("---") # Separador visual
+        marco(cronometro_rerun, "Análise de sequência")
 
 
         # --- Tabela de Dados (filtrada pela competência, incluindo CANCELADAS) ---
@@ -1117,7 +933,7 @@ else:
         # Selector de colunas
         with st.expander("Gerenciar Colunas", expanded=False):
             # Obtém todas as colunas que estão no DataFrame atual
-            all_available_display_cols = list(df_full.columns)
+            all_available_display_cols = list(df_competence.columns)
             
             # Garante que as colunas padrão que queremos exibir existam no DataFrame
             initial_selection = [col for col in default_cols_to_show_initial if col in all_available_display_cols]
@@ -1144,7 +960,7 @@ else:
             # CORREÇÃO: Linha 960 - Substitui use_container_width=True por width='stretch'
             st.dataframe(
                 df_to_display,
-                column_config=st.session_state.column_config,
+                column_config=build_column_config(df_to_display),
                 width='stretch',
                 hide_index=True
             )
@@ -1155,16 +971,9 @@ else:
 
             # Download CSV
             with col_csv:
-                # INÍCIO DA CORREÇÃO: Desformatação para exportação
-                df_desformatted_for_export = df_to_display.copy()
-                for col in currency_cols_for_display:
-                    if col in df_desformatted_for_export.columns:
-                        # Remove "R\$", pontos de milhar, e troca vírgula por ponto decimal
-                        df_desformatted_for_export[col] = df_desformatted_for_export[col].astype(str).str.replace('R$', '', regex=False).str.replace('.', '', regex=False).str.replace(',', '.', regex=False)
-                        df_desformatted_for_export[col] = pd.to_numeric(df_desformatted_for_export[col], errors='coerce')
-                
-                csv_data = df_desformatted_for_export.to_csv(index=False).encode('utf-8')
-                # FIM DA CORREÇÃO
+                # Colunas monetárias são desformatadas para exportação
+                # Gerado só no clique (data como função), e não a cada rerun
+                csv_data = lambda: build_csv_export(df_to_display)
                 # CORREÇÃO: Linha 985 - Substitui use_container_width=True por width='stretch'
                 st.download_button(
                     label="Baixar como CSV",
@@ -1176,19 +985,7 @@ else:
             
             # Download Excel
             with col_excel:
-                # INÍCIO DA CORREÇÃO: Desformatação para exportação
-                df_desformatted_for_export = df_to_display.copy()
-                for col in currency_cols_for_display:
-                    if col in df_desformatted_for_export.columns:
-                        # Remove "R\$", pontos de milhar, e troca vírgula por ponto decimal
-                        df_desformatted_for_export[col] = df_desformatted_for_export[col].astype(str).str.replace('R$', '', regex=False).str.replace('.', '', regex=False).str.replace(',', '.', regex=False)
-                        df_desformatted_for_export[col] = pd.to_numeric(df_desformatted_for_export[col], errors='coerce')
-
-                excel_buffer = io.BytesIO()
-                with pd.ExcelWriter(excel_buffer, engine='xlsxwriter') as writer:
-                    df_desformatted_for_export.to_excel(writer, index=False, sheet_name=f'NFSe Data {selected_competence}')
-                excel_buffer.seek(0) # Volta para o início do buffer
-                # FIM DA CORREÇÃO
+                excel_buffer = lambda: build_excel_export(df_to_display, f'NFSe Data {selected_competence}')
                 # CORREÇÃO: Linha 1004 - Substitui use_container_width=True por width='stretch'
                 st.download_button(
                     label="Baixar como Excel",
@@ -1197,24 +994,139 @@ else:
                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                     width='stretch'
                 )
-    if available_competencias:
-    selected_competence = st.selectbox(
-        "Selecione a competência para conferência:",
-        options=available_competencias,
-        help="Selecione o mês e ano para o qual você deseja conferir as notas fiscais."
+    else:
+        st.info(f"Nenhuma NFSe encontrada para a competência **{selected_competence}**.")
+
+    marco(cronometro_rerun, "Tabela e downloads")
+    st.markdown("---") # Separador visual
+
+    # --- Pacote de Relatórios (todas as competências, por prestador) ---
+    st.subheader("6. Pacote de Relatórios do Fechamento")
+    st.markdown("Gera um ZIP com uma planilha Excel por competência e prestador (notas, inconsistências, sequência e resumo de impostos).")
+    lucro_presumido_tipo_pacote = st.selectbox(
+        "Tipo de Lucro Presumido para o resumo de impostos:",
+        ["Normal", "Equiparação Hospitalar"],
+        key="lucro_presumido_pacote",
     )
+    if st.button("Gerar pacote de relatórios", width='stretch'):
+        if conjunto_analitico is not None:
+            partes_pacote = partes_do_conjunto(conjunto_analitico, st.session_state.regras_conferencia)
+            total_partes = contar_partes_do_conjunto(conjunto_analitico)
+        else:
+            partes_pacote = partes_do_dataframe(df_full, st.session_state.faixas_competencia)
+            total_partes = len(partes_pacote)
 
-    # Filtra o DataFrame pela competência selecionada
-    df_competence = df_full[df_full['Competência'] == selected_competence].copy()
+        apagar_pacote_relatorios()
+        descritor, caminho_pacote = tempfile.mkstemp(prefix="nfse_relatorios_", suffix=".zip")
+        progress_bar_pacote = st.progress(0.0)
+        status_text_pacote = st.empty()
 
-    if selected_competence and not df_competence.empty:
-        st.info(f"Exibindo dados para a competência: {selected_competence}")
-    else:
-        st.info(f"Nenhuma NFSe encontrada para a competência **{selected_competence}**.")
+        def progresso_pacote(feitos, total):
+            progress_bar_pacote.progress(feitos / total if total else 1.0)
+            status_text_pacote.text(f"Planilhas geradas: {feitos} de {total}")
+
+        inicio = time.perf_counter()
+        try:
+            with os.fdopen(descritor, "wb") as arquivo_pacote:
+                gerados = gerar_pacote_relatorios(
+                    partes_pacote, st.session_state.sequence_issues, arquivo_pacote,
+                    regras=st.session_state.regras_conferencia, lucro_presumido_tipo=lucro_presumido_tipo_pacote,
+                    progresso=progresso_pacote, total=total_partes,
+                )
+            st.session_state.pacote_relatorios = caminho_pacote
+            log_message_viewer(f"Pacote de relatórios gerado: {gerados} planilhas em {time.perf_counter() - inicio:.1f} s.", "success")
+        except Exception as e:
+            os.remove(caminho_pacote)
+            log_message_viewer(f"Erro ao gerar o pacote de relatórios: {e}", "error")
+        finally:
+            progress_bar_pacote.empty()
+            status_text_pacote.empty()
+
+    if st.session_state.pacote_relatorios is not None and os.path.exists(st.session_state.pacote_relatorios):
+        with open(st.session_state.pacote_relatorios, "rb") as arquivo_pacote:
+            st.download_button(
+                label="Baixar pacote de relatórios (ZIP)",
+                data=arquivo_pacote,
+                file_name="nfse_pacote_relatorios.zip",
+                mime="application/zip",
+                width='stretch'
+            )
+    marco(cronometro_rerun, "Pacote de relatórios")
+    st.markdown("---")
+
+    # --- Conciliação dos Recebimentos (todas as competências) ---
+    st.subheader("7. Conciliação de Recebimentos")
+    st.markdown(
+        "Confronta o Valor Líquido NFSe das notas ativas com os créditos de um extrato bancário (OFX ou CSV) "
+        "ou do contas a receber do ERP (CSV com colunas de data e valor e, se houver, CNPJ/CPF do cliente)."
+    )
+    arquivo_lancamentos = st.file_uploader(
+        "Arquivo de lançamentos (OFX ou CSV)", type=["ofx", "csv", "txt"], key="arquivo_lancamentos_conciliacao"
+    )
+    col_tolerancia, col_dias_antes, col_dias_depois = st.columns(3)
+    tolerancia_conciliacao = col_tolerancia.number_input(
+        "Tolerância de valor (R$)", min_value=0.0, max_value=100.0, value=TOLERANCIA_VALOR_PADRAO, step=0.01, format="%.2f",
+        key="tolerancia_conciliacao",
+    )
+    dias_antes_conciliacao = col_dias_antes.number_input(
+        "Dias antes da emissão", min_value=0, max_value=365, value=DIAS_ANTES_PADRAO, step=1, key="dias_antes_conciliacao",
+    )
+    dias_depois_conciliacao = col_dias_depois.number_input(
+        "Dias depois da emissão", min_value=0, max_value=365, value=DIAS_DEPOIS_PADRAO, step=1, key="dias_depois_conciliacao",
+    )
+    if st.button("Conciliar recebimentos", width='stretch', disabled=arquivo_lancamentos is None):
+        inicio = time.perf_counter()
+        try:
+            lancamentos, ignorados = carregar_lancamentos(arquivo_lancamentos)
+            if conjunto_analitico is not None:
+                notas_conciliacao = carregar_colunas(conjunto_analitico, COLUNAS_NOTAS_CONCILIACAO, apenas_ativas=True)
+            else:
+                # Só as colunas usadas, e só o valor líquido é desformatado
+                notas_conciliacao = unformat_currency_columns(
+                    df_full.loc[df_full['Status Cancelamento'] == 'Não', COLUNAS_NOTAS_CONCILIACAO]
+                )
+            st.session_state.conciliacao = conciliar(
+                notas_conciliacao, lancamentos, tolerancia_conciliacao, dias_antes_conciliacao, dias_depois_conciliacao
+            )
+            log_message_viewer(
+                f"Conciliação: {len(notas_conciliacao)} notas ativas x {len(lancamentos)} lançamentos "
+                f"({ignorados} linhas ignoradas: débitos, data ou valor inválidos) em {time.perf_counter() - inicio:.2f} s.",
+                "success",
+            )
+        except Exception as e:
+            st.session_state.conciliacao = None
+            log_message_viewer(f"Erro na conciliação dos recebimentos: {e}", "error")
+            st.error(f"Não foi possível conciliar o arquivo: {e}")
+
+    if st.session_state.conciliacao is not None:
+        notas_conciliadas, lancamentos_conciliados = st.session_state.conciliacao
+        st.markdown("**Resumo por competência**")
+        st.dataframe(resumo_conciliacao(notas_conciliadas, lancamentos_conciliados), width='stretch', hide_index=True)
+        if selected_competence:
+            pendentes_notas = notas_conciliadas[
+                (notas_conciliadas['Competência'].astype(str) == selected_competence)
+                & (notas_conciliadas['Situação Conciliação'] != 'Conciliada')
+            ]
+            pendentes_lancamentos = lancamentos_conciliados[
+                (lancamentos_conciliados['Competência'] == selected_competence)
+                & (lancamentos_conciliados['Situação Conciliação'] != 'Conciliado')
+            ]
+            st.markdown(f"**Notas não conciliadas ou ambíguas em {selected_competence}:** {len(pendentes_notas)}")
+            if not pendentes_notas.empty:
+                st.dataframe(pendentes_notas, width='stretch', hide_index=True)
+            st.markdown(f"**Lançamentos sem nota ou ambíguos em {selected_competence}:** {len(pendentes_lancamentos)}")
+            if not pendentes_lancamentos.empty:
+                st.dataframe(pendentes_lancamentos, width='stretch', hide_index=True)
+        st.download_button(
+            label="Baixar conciliação (Excel)",
+            data=lambda: exportar_conciliacao(notas_conciliadas, lancamentos_conciliados),
+            file_name="nfse_conciliacao_recebimentos.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            width='stretch'
+        )
+    marco(cronometro_rerun, "Conciliação de recebimentos")
 else:
-    st.warning("Não há competências disponíveis para conferência.")
-    else:
-        st.info("Selecione uma competência acima para visualizar os dados.")
+    st.info("Carregue e processe os XMLs para visualizar os dados.")
 st.subheader("Log de Atividades:")
 log_container_viewer = st.container(height=300, border=True)
 for message, level in st.session_state.log_messages_viewer:
@@ -1236,49 +1148,11 @@ st.warning("""
     As regras tributárias podem variar e são complexas. Utilize estes dados apenas como referência e para facilitar a conferência inicial.
 """)
 
-
-
-
-from sqlalchemy import create_engine, Column, Integer, String, Text
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-
-# ====== CONFIGURAÇÕES INICIAIS ======
-# Criar o arquivo do SQLite (salvo como "database.db")
-engine = create_engine("sqlite:///database.db")
-Base = declarative_base()
-
-# ====== CRIAR A TABELA "NFS-e" ======
-class NFSe(Base):
-    __tablename__ = "nfses"
-    id = Column(Integer, primary_key=True)  # ID único para cada registro
-    cliente = Column(String(255), nullable=False)  # Nome do cliente
-    data_envio = Column(String(50), nullable=False)  # Data de upload
-    arquivo_xml = Column(Text, nullable=False)  # Conteúdo do XML salvo como texto
-
-# Criar as tabelas no banco de dados
-Base.metadata.create_all(engine)
-
-# Configurar conexão com o banco e criar uma sessão para adicionar/registros
-Session = sessionmaker(bind=engine)
-session = Session()
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+# --- Painel do Modo de Medição (barra lateral) ---
+if perfil_ativo:
+    marco(cronometro_rerun, "Log de atividades")
+    st.sidebar.subheader("Tempo por etapa")
+    st.sidebar.caption("Último processamento")
+    st.sidebar.dataframe(tabela_etapas(st.session_state.perfil_processamento), hide_index=True, width='stretch')
+    st.sidebar.caption(f"Este rerun: {sum(m['Segundos'] for m in cronometro_rerun['medicoes']):.2f} s")
+    st.sidebar.dataframe(tabela_etapas(cronometro_rerun['medicoes']), hide_index=True, width='stretch')
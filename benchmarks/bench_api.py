@@ -0,0 +1,173 @@
+# bench_api.py - Benchmark de vazão do serviço HTTP local (nfse_api.py)
+#
+# Sobe o serviço em uma thread (uvicorn em 127.0.0.1, porta livre), dispara requisições concorrentes
+# com XMLs sintéticos no layout GISS, usando conexões keep-alive, e mede requisições por segundo e
+# latência (p50/p95/p99) de cada rota. Roda offline, só contra o localhost.
+#
+# Meta de vazão: com --min-rps N, as rotas com um XML por requisição (o caso do ERP) devem atender
+# pelo menos N requisições por segundo; abaixo disso o benchmark termina com código 1. O servidor
+# do benchmark é um processo só: a meta vale por núcleo (nfse_api.py sobe um processo por núcleo).
+#
+# Uso (a partir da raiz do repositório):
+#   python benchmarks/bench_api.py
+#   python benchmarks/bench_api.py --min-rps 200
+#   python benchmarks/bench_api.py --requests 5000 --concurrency 32 --batch 10
+
+import argparse
+import contextlib
+import datetime
+import http.client
+import io
+import json
+import logging
+import os
+import platform
+import socket
+import statistics
+import sys
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import uvicorn
+
+from nfse_api import app
+
+GISS_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<ns2:CompNfse xmlns:ns2="http://www.giss.com.br/tipos-v2_04.xsd">
+<ns2:Nfse versao="2.04"><ns2:InfNfse Id="nfse{numero}"><ns2:Numero>{numero}</ns2:Numero>
+<ns2:CodigoVerificacao>BENCH{numero}</ns2:CodigoVerificacao><ns2:DataEmissao>2026-01-15T10:00:00</ns2:DataEmissao>
+<ns2:ValoresNfse><ns2:BaseCalculo>{valor}</ns2:BaseCalculo><ns2:Aliquota>2.00</ns2:Aliquota><ns2:ValorLiquidoNfse>{valor}</ns2:ValorLiquidoNfse></ns2:ValoresNfse>
+<ns2:PrestadorServico><ns2:RazaoSocial>PRESTADOR BENCH LTDA</ns2:RazaoSocial></ns2:PrestadorServico>
+<ns2:DeclaracaoPrestacaoServico><ns2:InfDeclaracaoPrestacaoServico>
+<ns2:Servico><ns2:Valores><ns2:ValorServicos>{valor}</ns2:ValorServicos><ns2:ValorIr>{ir}</ns2:ValorIr><ns2:Aliquota>2.00</ns2:Aliquota></ns2:Valores>
+<ns2:IssRetido>2</ns2:IssRetido><ns2:ItemListaServico>4.03</ns2:ItemListaServico><ns2:Discriminacao>Servico {numero}</ns2:Discriminacao></ns2:Servico>
+<ns2:Prestador><ns2:CpfCnpj><ns2:Cnpj>11222333000144</ns2:Cnpj></ns2:CpfCnpj></ns2:Prestador>
+<ns2:TomadorServico><ns2:IdentificacaoTomador><ns2:CpfCnpj><ns2:Cnpj>99888777000166</ns2:Cnpj></ns2:CpfCnpj></ns2:IdentificacaoTomador>
+<ns2:RazaoSocial>TOMADOR {numero} SA</ns2:RazaoSocial></ns2:TomadorServico>
+<ns2:OptanteSimplesNacional>2</ns2:OptanteSimplesNacional>
+</ns2:InfDeclaracaoPrestacaoServico></ns2:DeclaracaoPrestacaoServico></ns2:InfNfse></ns2:Nfse>
+</ns2:CompNfse>"""
+
+
+def make_giss_xml(numero):
+    """XML sintético de uma NFS-e GISS (valor acima do limite de IRRF, com IR retido)."""
+    valor = 1000 + numero % 500
+    return GISS_TEMPLATE.format(numero=numero, valor=f"{valor:.2f}", ir=f"{valor * 0.015:.2f}").encode("utf-8")
+
+
+def make_zip(numeros):
+    """ZIP em memória com um XML sintético por número."""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as pacote:
+        for numero in numeros:
+            pacote.writestr(f"nf{numero}.xml", make_giss_xml(numero))
+    return buffer.getvalue()
+
+
+def _free_port():
+    with contextlib.closing(socket.socket()) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server():
+    """Sobe o nfse_api em uma thread e espera até que aceite conexões. Retorna (server, porta)."""
+    porta = _free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=porta, log_level="error"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, porta
+
+
+def run_route(porta, rota, corpos, concurrency, content_type):
+    """Envia cada corpo em 'corpos' para a rota, com 'concurrency' clientes keep-alive. Retorna métricas."""
+    local = threading.local()
+
+    def enviar(corpo):
+        if not hasattr(local, "conexao"):
+            local.conexao = http.client.HTTPConnection("127.0.0.1", porta)
+        inicio = time.perf_counter()
+        local.conexao.request("POST", rota, body=corpo, headers={"Content-Type": content_type})
+        resposta = local.conexao.getresponse()
+        resposta.read()
+        if resposta.status != 200:
+            raise RuntimeError(f"{rota} respondeu {resposta.status}")
+        return time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencias = sorted(executor.map(enviar, corpos))
+    total = time.perf_counter() - inicio
+
+    def percentil(p):
+        return latencias[min(len(latencias) - 1, int(p * len(latencias)))] * 1000
+
+    return {
+        'route': rota,
+        'requests': len(corpos),
+        'seconds': round(total, 4),
+        'requests_per_second': round(len(corpos) / total, 1),
+        'p50_ms': round(statistics.median(latencias) * 1000, 2),
+        'p95_ms': round(percentil(0.95), 2),
+        'p99_ms': round(percentil(0.99), 2),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark de vazão do serviço HTTP local de NFS-e.")
+    parser.add_argument('--requests', type=int, default=2000, help="Requisições por rota.")
+    parser.add_argument('--concurrency', type=int, default=16, help="Clientes simultâneos.")
+    parser.add_argument('--batch', type=int, default=20, help="XMLs por ZIP na rota de lote.")
+    parser.add_argument('--min-rps', type=float, default=None, metavar='N',
+                        help="Falha se alguma rota com um XML por requisição ficar abaixo de N req/s.")
+    parser.add_argument('--output', default='bench_api_results.json', help="Arquivo JSON de saída.")
+    args = parser.parse_args(argv)
+
+    # Os avisos de "missing ScriptRunContext" do Streamlit não interessam fora do app
+    logging.getLogger('streamlit').setLevel(logging.ERROR)
+
+    server, porta = start_server()
+    xmls = [make_giss_xml(numero) for numero in range(1, args.requests + 1)]
+    lotes = [make_zip(range(inicio, inicio + args.batch)) for inicio in range(1, args.requests + 1, args.batch)]
+
+    # O parser imprime o que extrai; fora do terminal isso só custaria tempo de E/S
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        results = [
+            run_route(porta, "/nfse/extrair", xmls, args.concurrency, "application/xml"),
+            run_route(porta, "/nfse/conferir", xmls, args.concurrency, "application/xml"),
+            run_route(porta, "/nfse/conferir", lotes, args.concurrency, "application/zip"),
+        ]
+    for rec in results[:-1]:
+        rec['xmls_per_request'] = 1
+    results[-1]['xmls_per_request'] = args.batch
+    server.should_exit = True
+
+    abaixo_da_meta = []
+    for rec in results:
+        print(f"{rec['route']:<16} {rec['requests']:>6} req  {rec['requests_per_second']:>8} req/s  "
+              f"p50 {rec['p50_ms']} ms  p95 {rec['p95_ms']} ms")
+        if args.min_rps is not None and rec['xmls_per_request'] == 1 and rec['requests_per_second'] < args.min_rps:
+            abaixo_da_meta.append(rec)
+            print(f"  ABAIXO DA META: {rec['route']} com {rec['requests_per_second']} req/s (meta {args.min_rps} req/s)")
+
+    report = {
+        'generated_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'uvicorn': uvicorn.__version__,
+        'concurrency': args.concurrency,
+        'min_rps': args.min_rps,
+        'results': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"Resultados gravados em {args.output}")
+    return 1 if abaixo_da_meta else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
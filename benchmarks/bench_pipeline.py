@@ -0,0 +1,246 @@
+# bench_pipeline.py - Benchmark do pipeline de dados do app_viewer.py
+#
+# Gera DataFrames sintéticos no formato devolvido por extract_nfse_data (1k, 10k, 100k e 1M notas,
+# com mistura de regimes, tomadores PF/PJ, canceladas, lacunas e duplicatas na numeração) e mede
+# tempo e pico de memória de cada etapa:
+#   format_dataframe_for_display, re-conferência com outra alíquota (atualizar_conferencia),
+#   detect_sequence_issues, filtro de competência, painel de impostos, exportações CSV/Excel e
+#   conciliação de recebimentos (contra um extrato sintético).
+#
+# Uso (a partir da raiz do repositório):
+#   python benchmarks/bench_pipeline.py
+#   python benchmarks/bench_pipeline.py --sizes 1000 10000 --output bench_results.json
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nfse_parser import _DEFAULT_NFSE_DATA
+from nfse_conferencia import (
+    detect_sequence_issues,
+    format_dataframe_for_display,
+    base_conferencia,
+    atualizar_conferencia,
+    REGRAS_PADRAO,
+    filter_by_competence,
+    indexar_competencias,
+    compute_tax_panel,
+    build_csv_export,
+    build_excel_export,
+    unformat_currency_columns,
+)
+from nfse_conciliacao import conciliar, COLUNAS_NOTAS as COLUNAS_NOTAS_CONCILIACAO
+
+DEFAULT_SIZES = [1_000, 10_000, 100_000, 1_000_000]
+NOTAS_POR_PRESTADOR = 5_000
+EXPORT_COLS = [
+    'Data Emissão', 'Competência', 'Número da NF', 'Tomador Razão Social',
+    'Valor dos Serviços', 'IR', 'CSLL', 'PIS', 'COFINS', 'Valor ISS Retido', 'Status Cancelamento'
+]
+
+
+def make_synthetic_receipts(notas, seed=42):
+    """
+    Lançamentos (formato de carregar_lancamentos) para ~90% das notas, pagos até 45 dias após a
+    emissão; metade traz o CNPJ do tomador e ~5% vêm com alguns centavos de diferença.
+    """
+    rng = np.random.default_rng(seed)
+    recebidas = notas[rng.random(len(notas)) < 0.9]
+    n = len(recebidas)
+    return pd.DataFrame({
+        'Identificador': np.arange(1, n + 1).astype(str),
+        'Data': recebidas['Data Emissão'].dt.normalize().to_numpy() + pd.to_timedelta(rng.integers(0, 46, n), 'D'),
+        'Valor': recebidas['Valor Líquido NFSe'].to_numpy() + np.where(rng.random(n) < 0.05, rng.integers(-3, 4, n) / 100, 0.0),
+        'CNPJ': np.where(rng.random(n) < 0.5, recebidas['Tomador CNPJ/CPF'].astype(str).to_numpy(), ''),
+        'Descrição': 'CREDITO',
+    })
+
+
+def make_synthetic_nfse_frame(n_notes, seed=42):
+    """
+    Monta um DataFrame com as mesmas colunas (e tipos string) de extract_nfse_data.
+    ~30% dos prestadores são do Simples Nacional, ~15% dos tomadores são PF, ~3% das notas
+    estão canceladas, ~1% dos números foram pulados e ~0,2% aparecem duplicados.
+    """
+    rng = np.random.default_rng(seed)
+    n_prestadores = max(1, n_notes // NOTAS_POR_PRESTADOR)
+
+    prestador_idx = np.sort(rng.integers(0, n_prestadores, n_notes))
+    # Numeração sequencial por prestador, com lacunas (saltos de 2) e duplicatas (saltos de 0)
+    passos = rng.choice([1, 2, 0], size=n_notes, p=[0.988, 0.010, 0.002])
+    inicio_grupo = np.r_[True, prestador_idx[1:] != prestador_idx[:-1]]
+    passos[inicio_grupo] = 1
+    acumulado = np.cumsum(passos)
+    base_grupo = np.maximum.accumulate(np.where(inicio_grupo, acumulado - 1, 0))
+    numeros = acumulado - base_grupo
+
+    # Datas acompanham a numeração dentro do ano (competências de 2026-01 a 2026-12)
+    max_por_grupo = pd.Series(numeros).groupby(prestador_idx).transform('max').to_numpy()
+    dia_do_ano = np.minimum((numeros / np.maximum(max_por_grupo, 1) * 364).astype(int), 364)
+    datas = np.datetime64('2026-01-01T09:00:00') + dia_do_ano.astype('timedelta64[D]')
+
+    regime_prestador = rng.choice(['2', '1', None], size=n_prestadores, p=[0.68, 0.30, 0.02])
+    cnpj_prestador = np.array([f"{10_000_000_000_000 + i * 7919:014d}" for i in range(n_prestadores)], dtype=object)
+
+    tipo_tomador = rng.choice(['PJ', 'PF', 'ND'], size=n_notes, p=[0.80, 0.15, 0.05])
+    tomador_doc = np.where(
+        tipo_tomador == 'PJ', rng.integers(10**13, 10**14, n_notes).astype(str),
+        np.where(tipo_tomador == 'PF', rng.integers(10**10, 10**11, n_notes).astype(str), None)
+    ).astype(object)
+
+    valor_servicos = np.round(rng.lognormal(mean=7.0, sigma=1.0, size=n_notes), 2)
+    pj_presumido = (tipo_tomador == 'PJ') & (regime_prestador[prestador_idx] == '2')
+    retem_ir = pj_presumido & (valor_servicos >= 666.67)
+    retem_csrf = pj_presumido & (valor_servicos >= 215.05)
+    # ~5% das retenções com valor divergente do esperado
+    erro = np.where(rng.random(n_notes) < 0.05, 1.1, 1.0)
+    valor_ir = np.round(np.where(retem_ir, valor_servicos * 0.015 * erro, 0.0), 2)
+    valor_csll = np.round(np.where(retem_csrf, valor_servicos * 0.01, 0.0), 2)
+    valor_pis = np.round(np.where(retem_csrf, valor_servicos * 0.0065, 0.0), 2)
+    valor_cofins = np.round(np.where(retem_csrf, valor_servicos * 0.03, 0.0), 2)
+    iss_retido = np.where(pj_presumido & (rng.random(n_notes) < 0.4), '1', '2')
+    valor_iss = np.round(valor_servicos * 0.02, 2)
+    valor_iss_retido = np.where(iss_retido == '1', valor_iss, 0.0)
+    valor_liquido = np.round(valor_servicos - valor_ir - valor_csll - valor_pis - valor_cofins - valor_iss_retido, 2)
+
+    cancelada = rng.random(n_notes) < 0.03
+
+    def as_str(values):
+        return np.where(cancelada, '0.0', np.asarray(values).astype(str)).astype(object)
+
+    frame = {key: np.full(n_notes, default, dtype=object) for key, default in _DEFAULT_NFSE_DATA.items()}
+    numeros_str = numeros.astype(str).astype(object)
+    frame.update({
+        'Nfse.Id': np.char.add('nfse', numeros.astype(str)).astype(object),
+        'Numero': numeros_str,
+        'CodigoVerificacao': np.char.add('CV', rng.integers(10**7, 10**8, n_notes).astype(str)).astype(object),
+        'DataEmissao': np.datetime_as_string(datas).astype(object),
+        'OptanteSimplesNacional': regime_prestador[prestador_idx],
+        'DescricaoServico': np.where(cancelada, 'NOTA FISCAL CANCELADA', 'Prestação de serviços médicos').astype(object),
+        'ItemListaServico': np.full(n_notes, '4.03', dtype=object),
+        'ValorServicos': as_str(valor_servicos),
+        'ValorPis': as_str(valor_pis),
+        'ValorCofins': as_str(valor_cofins),
+        'ValorIr': as_str(valor_ir),
+        'ValorCsll': as_str(valor_csll),
+        'IssRetido': iss_retido.astype(object),
+        'ValorIss': as_str(valor_iss),
+        'ValorIssRetido': as_str(valor_iss_retido),
+        'BaseCalculo': as_str(valor_servicos),
+        'Aliquota': as_str(np.full(n_notes, 2.0)),
+        'ValorLiquidoNfse': as_str(valor_liquido),
+        'Prestador.CpfCnpj': cnpj_prestador[prestador_idx],
+        'Prestador.RazaoSocial': np.char.add('PRESTADOR ', prestador_idx.astype(str)).astype(object),
+        'TomadorServico.CpfCnpj': np.where(cancelada, None, tomador_doc).astype(object),
+        'TomadorServico.RazaoSocial': np.where(cancelada, 'CANCELADA', 'TOMADOR LTDA').astype(object),
+        'IsCancelled': np.where(cancelada, 'Sim', 'Não').astype(object),
+    })
+    return pd.DataFrame(frame)
+
+
+def _measure(stage, size, func, *args, measure_memory=True):
+    """
+    Executa func(*args) medindo o tempo (perf_counter). Com measure_memory=True, executa de novo
+    sob tracemalloc para obter o pico de memória alocada, sem que o rastreamento distorça o tempo.
+    """
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+
+    peak_mib = None
+    if measure_memory:
+        tracemalloc.start()
+        func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peak_mib = round(peak / 2**20, 3)
+
+    peak_txt = f"{peak_mib:>10.1f} MiB" if peak_mib is not None else "         - MiB"
+    print(f"  {stage:<32} {elapsed:>10.3f} s {peak_txt}")
+    return result, {'size': size, 'stage': stage, 'seconds': round(elapsed, 6), 'peak_mib': peak_mib}
+
+
+def run_pipeline(size, seed=42, measure_memory=True):
+    """Roda todas as etapas para um tamanho de dataset e devolve a lista de medições."""
+    records = []
+    df_raw = make_synthetic_nfse_frame(size, seed)
+    # Tamanho em memória do DataFrame bruto, como referência para os picos das etapas
+    records.append({'size': size, 'stage': 'dataset_raw', 'seconds': 0.0,
+                    'peak_mib': round(df_raw.memory_usage(deep=True).sum() / 2**20, 3)})
+
+    df_processed, rec = _measure('format_dataframe_for_display', size, format_dataframe_for_display, df_raw, measure_memory=measure_memory)
+    records.append(rec)
+    # Simulação de alíquota: só as colunas de esperados e status são recalculadas, a partir da base numérica
+    base = base_conferencia(format_dataframe_for_display(df_raw, format_currency=False))
+    regras_simuladas = {**REGRAS_PADRAO, 'aliquota_irrf': 0.02}
+    _, rec = _measure('atualizar_conferencia', size, atualizar_conferencia, df_processed.copy(), base, regras_simuladas, measure_memory=measure_memory)
+    records.append(rec)
+    _, rec = _measure('detect_sequence_issues', size, detect_sequence_issues, df_processed, measure_memory=measure_memory)
+    records.append(rec)
+    (df_indexado, faixas), rec = _measure('indexar_competencias', size, indexar_competencias, df_processed, measure_memory=measure_memory)
+    records.append(rec)
+
+    competence = sorted(df_processed['Competência'].dropna().unique())[-1]
+    (df_competence, df_active_notes), rec = _measure('filter_by_competence', size, filter_by_competence, df_processed, competence, measure_memory=measure_memory)
+    records.append(rec)
+    _, rec = _measure('filter_by_competence_faixas', size, filter_by_competence, df_indexado, competence, faixas, measure_memory=measure_memory)
+    records.append(rec)
+    _, rec = _measure('compute_tax_panel', size, compute_tax_panel, df_active_notes, "Normal", measure_memory=measure_memory)
+    records.append(rec)
+
+    df_to_export = df_competence[[col for col in EXPORT_COLS if col in df_competence.columns]]
+    _, rec = _measure('build_csv_export', size, build_csv_export, df_to_export, measure_memory=measure_memory)
+    records.append(rec)
+    _, rec = _measure('build_excel_export', size, build_excel_export, df_to_export, f'NFSe Data {competence}', measure_memory=measure_memory)
+    records.append(rec)
+
+    # Conciliação de recebimentos: todas as notas ativas contra um extrato com ~90% delas recebidas
+    notas = unformat_currency_columns(df_processed.loc[df_processed['Status Cancelamento'] == 'Não', COLUNAS_NOTAS_CONCILIACAO])
+    lancamentos = make_synthetic_receipts(notas, seed)
+    _, rec = _measure('conciliar', size, conciliar, notas, lancamentos, measure_memory=measure_memory)
+    records.append(rec)
+    return records
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark do pipeline de dados do NFSe Viewer.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help="Quantidades de notas a simular.")
+    parser.add_argument('--seed', type=int, default=42, help="Semente do gerador sintético.")
+    parser.add_argument('--output', default='bench_results.json', help="Arquivo JSON de saída.")
+    parser.add_argument('--no-memory', action='store_true', help="Mede apenas o tempo (não reexecuta sob tracemalloc).")
+    args = parser.parse_args(argv)
+
+    # Os avisos de "missing ScriptRunContext" do Streamlit não interessam fora do app
+    logging.getLogger('streamlit').setLevel(logging.ERROR)
+
+    results = []
+    for size in args.sizes:
+        print(f"--- {size} notas ---")
+        results.extend(run_pipeline(size, args.seed, measure_memory=not args.no_memory))
+
+    report = {
+        'generated_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'seed': args.seed,
+        'results': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"Resultados gravados em {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+# bench_rerun.py - Benchmark de latência dos reruns do app_viewer.py (streamlit.testing.v1.AppTest)
+#
+# Cada interação com um widget reexecuta o app_viewer.py inteiro. Este benchmark dirige o app sem
+# navegador: carrega no session_state um conjunto sintético já processado (o mesmo que o
+# finalize_extracted_data deixaria, a partir do gerador do bench_pipeline.py), e mede o tempo e a
+# memória de cada interação:
+#   primeira execução, rerun sem alteração, troca de competência, alteração das colunas exibidas
+#   (multiselect do expander "Gerenciar Colunas"), tipo de Lucro Presumido e re-conferência.
+#
+# Observação: no AppTest (e no servidor), o conteúdo dos expanders é executado em todo rerun,
+# abertos ou não; por isso "abrir um expander" não é uma interação separada, e o custo deles está
+# em todas as medições. O que se mede dentro deles são os widgets (colunas, regras).
+#
+# O app usa um banco SQLite temporário (NFSE_DB_PATH), sem tocar no database.db do repositório.
+#
+# Orçamento de memória: com --memory-budget N, o pico rastreado (tracemalloc) de cada interação é
+# comparado com N vezes o tamanho do conjunto carregado (df_processed_viewer, memory_usage deep).
+# Um rerun que copie o DataFrame inteiro estoura o orçamento e o benchmark termina com código 1.
+#
+# Uso (a partir da raiz do repositório):
+#   python benchmarks/bench_rerun.py
+#   python benchmarks/bench_rerun.py --sizes 1000 10000 --repeats 5 --output bench_rerun_results.json
+#   python benchmarks/bench_rerun.py --sizes 10000 --memory-budget 0.5
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Banco vazio e temporário para o app (definido antes de qualquer import do nfse_db)
+_diretorio_banco = tempfile.mkdtemp(prefix="bench_rerun_")
+os.environ.setdefault("NFSE_DB_PATH", os.path.join(_diretorio_banco, "bench.db"))
+
+import pandas as pd
+import streamlit
+from streamlit.testing.v1 import AppTest
+
+from bench_pipeline import make_synthetic_nfse_frame
+from nfse_conferencia import (
+    base_conferencia,
+    detect_sequence_issues,
+    format_currency_columns,
+    format_dataframe_for_display,
+    indexar_competencias,
+)
+
+APP_PATH = os.path.join(RAIZ, "app_viewer.py")
+DEFAULT_SIZES = [1_000, 10_000]
+TIMEOUT_RERUN = 600  # segundos por execução do script
+ROTULO_COMPETENCIA = "Selecione a competência para conferência:"
+ROTULO_LUCRO_PRESUMIDO = "Tipo de Lucro Presumido para o resumo de impostos:"
+ROTULO_APLICAR_REGRAS = "Aplicar à conferência (simulação)"
+
+
+def processed_session_state(size, seed=42):
+    """Estado da sessão após o processamento (como em finalize_extracted_data) para 'size' notas sintéticas."""
+    df_formatted = format_dataframe_for_display(make_synthetic_nfse_frame(size, seed), format_currency=False)
+    sequence_issues = detect_sequence_issues(df_formatted)
+    df_formatted, faixas_competencia = indexar_competencias(df_formatted)
+    conferencia_base = base_conferencia(df_formatted)
+    return {
+        'df_processed_viewer': format_currency_columns(df_formatted),
+        'conferencia_base': conferencia_base,
+        'sequence_issues': sequence_issues,
+        'faixas_competencia': faixas_competencia,
+        'diagnosis_messages': [],
+        'log_messages_viewer': [],
+    }
+
+
+def _rss_pico_mib():
+    """Pico de memória residente do processo (ru_maxrss: KiB no Linux, bytes no macOS)."""
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(pico / (2**20 if sys.platform == "darwin" else 2**10), 1)
+
+
+def _widget(lista, rotulo):
+    return next(w for w in lista if w.label == rotulo)
+
+
+def _interacoes(competencias, colunas_iniciais):
+    """
+    Interações medidas, na ordem: (nome, função que recebe o AppTest e aplica a interação).
+    Cada função dispara exatamente um rerun.
+    """
+    interacoes = [('rerun_sem_alteracao', lambda at: at.run())]
+    for i, competencia in enumerate(competencias[1:3] + competencias[:1]):
+        interacoes.append((
+            f'troca_competencia_{i + 1}',
+            lambda at, c=competencia: _widget(at.selectbox, ROTULO_COMPETENCIA).select(c).run(),
+        ))
+    interacoes += [
+        ('remove_coluna', lambda at: at.multiselect(key="column_selector").unselect(colunas_iniciais[-1]).run()),
+        ('adiciona_coluna', lambda at: at.multiselect(key="column_selector").select(colunas_iniciais[-1]).run()),
+        ('lucro_presumido_eq_hosp', lambda at: _widget(at.selectbox, ROTULO_LUCRO_PRESUMIDO).select("Equiparação Hospitalar").run()),
+        ('lucro_presumido_normal', lambda at: _widget(at.selectbox, ROTULO_LUCRO_PRESUMIDO).select("Normal").run()),
+        ('re_conferencia', lambda at: _widget(at.button, ROTULO_APLICAR_REGRAS).click().run()),
+    ]
+    return interacoes
+
+
+def _medir(nome, size, at, interacao, repeats, measure_memory):
+    """Aplica a interação 'repeats' vezes (tempo) e, com measure_memory, mais uma sob tracemalloc (pico)."""
+    tempos = []
+    for _ in range(repeats):
+        inicio = time.perf_counter()
+        interacao(at)
+        tempos.append(time.perf_counter() - inicio)
+        if at.exception:
+            raise RuntimeError(f"{nome}: {at.exception[0].value}")
+
+    pico_mib = None
+    if measure_memory:
+        tracemalloc.start()
+        interacao(at)
+        _, pico = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        pico_mib = round(pico / 2**20, 3)
+
+    registro = {
+        'size': size, 'interaction': nome, 'repeats': repeats,
+        'median_seconds': round(statistics.median(tempos), 6), 'max_seconds': round(max(tempos), 6),
+        'peak_mib': pico_mib, 'rss_peak_mib': _rss_pico_mib(),
+    }
+    pico_txt = f"{pico_mib:>10.1f} MiB" if pico_mib is not None else "         - MiB"
+    print(f"  {nome:<28} {registro['median_seconds']:>8.3f} s (máx {registro['max_seconds']:.3f} s) {pico_txt}")
+    return registro
+
+
+def run_reruns(size, seed=42, repeats=3, measure_memory=True):
+    """
+    Carrega 'size' notas sintéticas no app e mede cada interação. Devolve (medições, tamanho do
+    conjunto carregado em MiB).
+    """
+    at = AppTest.from_file(APP_PATH, default_timeout=TIMEOUT_RERUN)
+    estado = processed_session_state(size, seed)
+    dataset_mib = round(estado['df_processed_viewer'].memory_usage(deep=True).sum() / 2**20, 3)
+    print(f"  {'conjunto_carregado':<28} {'':>8}   {'':<14} {dataset_mib:>10.1f} MiB")
+    for chave, valor in estado.items():
+        at.session_state[chave] = valor
+
+    inicio = time.perf_counter()
+    at.run()
+    primeira = time.perf_counter() - inicio
+    if at.exception:
+        raise RuntimeError(f"primeira execução: {at.exception[0].value}")
+    print(f"  {'primeira_execucao':<28} {primeira:>8.3f} s")
+    records = [{
+        'size': size, 'interaction': 'primeira_execucao', 'repeats': 1,
+        'median_seconds': round(primeira, 6), 'max_seconds': round(primeira, 6),
+        'peak_mib': None, 'rss_peak_mib': _rss_pico_mib(),
+    }]
+
+    competencias = list(_widget(at.selectbox, ROTULO_COMPETENCIA).options)
+    colunas_iniciais = list(at.multiselect(key="column_selector").value)
+    for nome, interacao in _interacoes(competencias, colunas_iniciais):
+        records.append(_medir(nome, size, at, interacao, repeats, measure_memory))
+    return records, dataset_mib
+
+
+def verificar_orcamento(records, dataset_mib, multiplo):
+    """Interações cujo pico rastreado passou de 'multiplo' vezes o tamanho do conjunto carregado."""
+    limite = multiplo * dataset_mib
+    return [r for r in records if r['peak_mib'] is not None and r['peak_mib'] > limite]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark de latência dos reruns do NFSe Viewer (AppTest).")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help="Quantidades de notas a simular.")
+    parser.add_argument('--seed', type=int, default=42, help="Semente do gerador sintético.")
+    parser.add_argument('--repeats', type=int, default=3, help="Repetições cronometradas de cada interação.")
+    parser.add_argument('--output', default='bench_rerun_results.json', help="Arquivo JSON de saída.")
+    parser.add_argument('--no-memory', action='store_true', help="Mede apenas o tempo (não repete sob tracemalloc).")
+    parser.add_argument('--memory-budget', type=float, default=None, metavar='N',
+                        help="Falha se o pico de alguma interação passar de N vezes o tamanho do conjunto carregado.")
+    args = parser.parse_args(argv)
+    if args.memory_budget is not None and args.no_memory:
+        parser.error("--memory-budget precisa da medição de memória (não use --no-memory).")
+
+    # Os logs de DEBUG do parser e os avisos do Streamlit não interessam no benchmark
+    logging.disable(logging.WARNING)
+
+    results = []
+    estouros = []
+    for size in args.sizes:
+        print(f"--- {size} notas ---")
+        records, dataset_mib = run_reruns(size, args.seed, args.repeats, measure_memory=not args.no_memory)
+        results.extend(records)
+        if args.memory_budget is not None:
+            for registro in verificar_orcamento(records, dataset_mib, args.memory_budget):
+                estouros.append(registro)
+                print(f"  ORÇAMENTO EXCEDIDO: {registro['interaction']} com pico de {registro['peak_mib']:.1f} MiB "
+                      f"(limite {args.memory_budget * dataset_mib:.1f} MiB = {args.memory_budget} x {dataset_mib:.1f} MiB)")
+
+    report = {
+        'generated_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'streamlit': streamlit.__version__,
+        'pandas': pd.__version__,
+        'seed': args.seed,
+        'memory_budget': args.memory_budget,
+        'results': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"Resultados gravados em {args.output}")
+    return 1 if estouros else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,182 @@
+# nfse_analitico.py - Armazenamento analítico (Parquet) das notas processadas no viewer
+#
+# Em vez de manter o DataFrame inteiro no st.session_state (e copiá-lo a cada rerun), as notas já
+# processadas (format_dataframe_for_display, valores numéricos) são gravadas em um conjunto Parquet
+# particionado por prestador e competência:
+#   <DIRETORIO_ANALITICO>/<conjunto>/prestador=<CNPJ>/competencia=<AAAA-MM>/*.parquet
+# A interface lê só a fatia exibida (uma competência) e os resumos por competência são agregados
+# direto nos arquivos, sem materializar o conjunto: com DuckDB, se instalado (opcional), ou com o
+# motor de datasets do pyarrow (que já acompanha o Streamlit).
+#
+# Limpeza: o viewer apaga o conjunto da sessão ao reprocessar, mas uma sessão encerrada (aba fechada)
+# deixaria o seu no disco. Cada leitura marca o uso do conjunto (data de modificação do diretório), e
+# gravar_conjunto apaga antes os conjuntos sem uso há mais de PRAZO_CONJUNTO_HORAS (como uma sessão
+# ativa relê a competência a cada rerun, só conjuntos abandonados passam do prazo).
+
+import os
+import re
+import shutil
+import tempfile
+import time
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+try:
+    import duckdb
+except ImportError:  # DuckDB é opcional: sem ele as agregações usam o pyarrow
+    duckdb = None
+
+# ====== CONFIGURAÇÕES ======
+DIRETORIO_ANALITICO = os.environ.get(
+    "NFSE_ANALITICO_DIR", os.path.join(tempfile.gettempdir(), "nfse_analitico")
+)
+LINHAS_POR_GRUPO = 64 * 1024  # Linhas por row group dos arquivos Parquet
+PRAZO_CONJUNTO_HORAS = 24  # Conjunto sem leitura há mais tempo que isso é considerado abandonado
+
+# Chaves de partição (gravadas no caminho; não ficam dentro dos arquivos)
+PARTICIONAMENTO = ds.partitioning(
+    pa.schema([("prestador", pa.string()), ("competencia", pa.string())]), flavor="hive"
+)
+SEM_PRESTADOR = "nao_informado"
+
+# Colunas somadas no resumo por competência (notas ativas)
+COLUNAS_RESUMO = {
+    'faturamento': 'Valor dos Serviços',
+    'ir_retido': 'IR',
+    'csll_retida': 'CSLL',
+    'pis_retido': 'PIS',
+    'cofins_retida': 'COFINS',
+    'iss_retido': 'Valor ISS Retido',
+}
+
+
+# ====== GRAVAÇÃO ======
+def gravar_conjunto(df_numeric, diretorio=None):
+    """
+    Grava o DataFrame processado (colunas monetárias ainda numéricas) como um novo conjunto Parquet
+    particionado por prestador e competência. Notas sem competência são descartadas, como na interface.
+    Retorna o caminho do conjunto.
+    """
+    apagar_conjuntos_abandonados(diretorio)
+    caminho = os.path.join(diretorio or DIRETORIO_ANALITICO, uuid.uuid4().hex)
+    df = df_numeric[df_numeric['Competência'].notna()]
+    chaves = pd.DataFrame({
+        'prestador': df['Prestador CNPJ'].astype(object).where(df['Prestador CNPJ'].notna(), SEM_PRESTADOR).astype(str),
+        'competencia': df['Competência'].astype(str),
+    }, index=df.index)
+    tabela = pa.Table.from_pandas(pd.concat([df, chaves], axis=1), preserve_index=False)
+    ds.write_dataset(
+        tabela, caminho, format="parquet", partitioning=PARTICIONAMENTO,
+        max_rows_per_group=LINHAS_POR_GRUPO, existing_data_behavior="error",
+    )
+    return caminho
+
+def apagar_conjunto(caminho):
+    """Remove o conjunto do disco (ex.: ao reprocessar ou ao descartar a sessão)."""
+    if caminho and os.path.isdir(caminho):
+        shutil.rmtree(caminho, ignore_errors=True)
+
+def apagar_conjuntos_abandonados(diretorio=None, prazo_horas=PRAZO_CONJUNTO_HORAS):
+    """
+    Remove os conjuntos (diretórios com nome de uuid) sem leitura há mais de 'prazo_horas', deixados
+    por sessões encerradas sem reprocessar. Retorna a quantidade de conjuntos removidos.
+    """
+    diretorio = diretorio or DIRETORIO_ANALITICO
+    if not os.path.isdir(diretorio):
+        return 0
+    limite = time.time() - prazo_horas * 3600
+    removidos = 0
+    for entrada in os.scandir(diretorio):
+        if entrada.is_dir() and re.fullmatch(r"[0-9a-f]{32}", entrada.name) and entrada.stat().st_mtime < limite:
+            apagar_conjunto(entrada.path)
+            removidos += 1
+    return removidos
+
+
+# ====== LEITURA ======
+def conjunto_disponivel(caminho):
+    """Indica se o conjunto ainda está no disco (pode ter sido apagado por apagar_conjuntos_abandonados)."""
+    return bool(caminho) and os.path.isdir(caminho)
+
+def _marcar_uso(caminho):
+    """Atualiza a data de modificação do conjunto: conjuntos em uso não passam do prazo de limpeza."""
+    os.utime(caminho)
+
+def _abrir(caminho):
+    _marcar_uso(caminho)
+    return ds.dataset(caminho, format="parquet", partitioning=PARTICIONAMENTO)
+
+def listar_competencias(caminho):
+    """Competências do conjunto (mais recente primeiro), lidas dos nomes das partições."""
+    _marcar_uso(caminho)
+    competencias = set()
+    for prestador in os.scandir(caminho):
+        if prestador.is_dir():
+            competencias.update(
+                entrada.name.split("=", 1)[1] for entrada in os.scandir(prestador.path)
+                if entrada.is_dir() and entrada.name.startswith("competencia=")
+            )
+    return sorted(competencias, reverse=True)
+
+def carregar_competencia(caminho, competencia, prestador=None):
+    """
+    Materializa só as notas da competência (e do prestador, se informado) como DataFrame pandas,
+    com as mesmas colunas gravadas. As demais partições não são lidas.
+    """
+    filtro = pc.field("competencia") == competencia
+    if prestador is not None:
+        filtro = filtro & (pc.field("prestador") == prestador)
+    conjunto = _abrir(caminho)
+    colunas = [nome for nome in conjunto.schema.names if nome not in ("prestador", "competencia")]
+    return conjunto.to_table(columns=colunas, filter=filtro).to_pandas()
+
+def carregar_colunas(caminho, colunas, apenas_ativas=False):
+    """
+    Materializa só as colunas informadas, de todas as competências (ex.: a conciliação de
+    recebimentos, que precisa de poucas colunas do conjunto inteiro). 'Competência' vem da partição.
+    """
+    filtro = pc.field("Status Cancelamento") == "Não" if apenas_ativas else None
+    lidas = [coluna for coluna in colunas if coluna != "Competência"]
+    tabela = _abrir(caminho).to_table(columns=["competencia", *lidas], filter=filtro)
+    df = tabela.to_pandas().rename(columns={"competencia": "Competência"})
+    return df[[coluna for coluna in colunas if coluna in df.columns]]
+
+def resumo_competencias(caminho):
+    """
+    Totais por competência (notas, notas ativas e somas das notas ativas), agregados direto nos
+    arquivos Parquet. Retorna um DataFrame ordenado da competência mais recente para a mais antiga.
+    """
+    if duckdb is not None:
+        _marcar_uso(caminho)
+        somas = ", ".join(
+            f'sum(CASE WHEN ativa THEN "{coluna}" ELSE 0 END) AS {nome}' for nome, coluna in COLUNAS_RESUMO.items()
+        )
+        padrao = os.path.join(caminho, "**", "*.parquet").replace("'", "''")
+        return duckdb.sql(f"""
+            SELECT competencia, count(*) AS notas, count(*) FILTER (WHERE ativa) AS notas_ativas, {somas}
+            FROM (SELECT *, "Status Cancelamento" = 'Não' AS ativa
+                  FROM read_parquet('{padrao}', hive_partitioning = true, hive_types = {{'prestador': VARCHAR, 'competencia': VARCHAR}}))
+            GROUP BY competencia
+            ORDER BY competencia DESC
+        """).df()
+
+    # Sem DuckDB: só as colunas usadas são lidas, e a agregação roda no motor do pyarrow
+    tabela = _abrir(caminho).to_table(columns=["competencia", "Status Cancelamento", *COLUNAS_RESUMO.values()])
+    ativa = pc.equal(pc.cast(tabela["Status Cancelamento"], pa.string()), "Não")
+    tabela = tabela.append_column("ativa", pc.fill_null(ativa, False))
+    for nome, coluna in COLUNAS_RESUMO.items():
+        tabela = tabela.append_column(nome, pc.if_else(tabela["ativa"], tabela[coluna], 0.0))
+    tabela = tabela.append_column("ativa_int", pc.cast(tabela["ativa"], pa.int64()))
+    agregado = tabela.group_by("competencia").aggregate(
+        [("competencia", "count"), ("ativa_int", "sum")] + [(nome, "sum") for nome in COLUNAS_RESUMO]
+    )
+    resumo = agregado.to_pandas().rename(columns={
+        "competencia_count": "notas", "ativa_int_sum": "notas_ativas",
+        **{f"{nome}_sum": nome for nome in COLUNAS_RESUMO},
+    })
+    colunas = ["competencia", "notas", "notas_ativas", *COLUNAS_RESUMO]
+    return resumo[colunas].sort_values("competencia", ascending=False, ignore_index=True)
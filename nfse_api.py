@@ -0,0 +1,179 @@
+# nfse_api.py - Serviço HTTP local de extração e conferência de NFS-e
+#
+# Permite que o ERP envie os XMLs direto, sem passar pelo uploader do Streamlit. O serviço usa o
+# mesmo extract_nfse_data e as mesmas regras de conferência do app_viewer.py (nfse_conferencia).
+#
+# Rotas:
+#   GET  /saude          -> {"status": "ok"}
+#   POST /nfse/extrair   -> registros extraídos (formato de extract_nfse_data); com ?campos=Numero,DataEmissao
+#                           ou ?campos=sequencia|totais (PROJECOES), só esses campos são extraídos
+#   POST /nfse/conferir  -> registros com os status de retenção e os problemas de sequência
+#
+# XMLs malformados, de layout desconhecido ou reprovados na validação (nfse_validacao) não viram
+# notas: são listados em "erros", com o motivo, e ficam fora da conferência.
+#
+# Corpo aceito nas rotas POST: um XML (application/xml), um ZIP com XMLs (application/zip) ou
+# multipart/form-data com vários arquivos .xml/.zip. As requisições são tratadas de forma assíncrona
+# (Starlette/uvicorn); o parsing roda no pool de threads para não bloquear o loop de eventos.
+#
+# Uso (a partir da raiz do repositório):
+#   python nfse_api.py
+#   python nfse_api.py --host 127.0.0.1 --port 8600 --workers 4
+#
+# Uma nota por requisição (o caso do ERP) é conferida sem DataFrame (conferir_registro); lotes usam a
+# conferência vetorizada do viewer, cujo custo fixo do pandas se dilui entre as notas. O trabalho é
+# limitado pelo GIL: --workers (padrão: um processo por núcleo) multiplica a vazão.
+
+import argparse
+import io
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import uvicorn
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from nfse_parser import PROJECOES, extract_xmls_from_zip
+from nfse_validacao import validar_e_extrair
+from nfse_conferencia import (
+    conferir_registro,
+    detect_sequence_issues,
+    format_dataframe_for_display,
+    remove_duplicate_notes,
+)
+
+# ====== CONFIGURAÇÕES ======
+HOST_PADRAO = "127.0.0.1"  # Só aceita conexões locais por padrão
+PORTA_PADRAO = 8600
+ASSINATURA_ZIP = b"PK\x03\x04"
+
+
+# ====== LEITURA DO CORPO DA REQUISIÇÃO ======
+def ler_conteudo(nome, conteudo):
+    """Retorna (xmls, erros) de um arquivo enviado: ZIP (pela assinatura) ou XML em UTF-8."""
+    if conteudo.startswith(ASSINATURA_ZIP):
+        return extract_xmls_from_zip(io.BytesIO(conteudo), nome)
+    try:
+        return [(nome, conteudo.decode("utf-8"))], []
+    except UnicodeDecodeError as e:
+        return [], [(nome, e)]
+
+async def ler_requisicao(request):
+    """Lê os XMLs enviados no corpo (XML/ZIP direto ou vários arquivos em multipart/form-data)."""
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        xmls, erros = [], []
+        async with request.form() as formulario:
+            for _, arquivo in formulario.multi_items():
+                if isinstance(arquivo, str):
+                    continue
+                xmls_arquivo, erros_arquivo = ler_conteudo(arquivo.filename or "arquivo", await arquivo.read())
+                xmls.extend(xmls_arquivo)
+                erros.extend(erros_arquivo)
+        return xmls, erros
+    return ler_conteudo(request.query_params.get("nome", "requisicao.xml"), await request.body())
+
+
+# ====== PROCESSAMENTO (executado no pool de threads) ======
+def extrair_registros(xmls, campos=None):
+    """
+    Valida e extrai (com a projeção 'campos', se informada) cada XML em memória, como o viewer com a
+    validação ligada (nfse_validacao). Retorna (registros, erros): XMLs malformados, de layout
+    desconhecido ou reprovados na validação ficam em erros, fora dos registros e da conferência.
+    """
+    registros, erros = [], []
+    for nome, xml_content in xmls:
+        _, data, problemas = validar_e_extrair(nome, xml_content, campos)
+        if problemas or data is None:
+            erros.append((nome, "; ".join(problemas) or "XML sem dados extraídos"))
+        else:
+            registros.append({"arquivo": nome, **data})
+    return registros, erros
+
+def campos_da_requisicao(request):
+    """Projeção pedida em ?campos=: nomes separados por vírgula ou o nome de uma projeção pronta. None = todos."""
+    valor = request.query_params.get("campos", "").strip()
+    if not valor:
+        return None
+    if valor in PROJECOES:
+        return list(PROJECOES[valor])
+    return [campo.strip() for campo in valor.split(",") if campo.strip()]
+
+def _dataframe_para_registros(df):
+    """Converte o DataFrame em lista de dicionários serializáveis (datas ISO, NaN -> null)."""
+    return json.loads(df.to_json(orient="records", date_format="iso", force_ascii=False))
+
+def _valor_json(valor):
+    """Valor de conferir_registro no formato de _dataframe_para_registros (datas ISO, NaN -> null)."""
+    if valor is None or (np.isscalar(valor) and pd.isna(valor)):
+        return None
+    if isinstance(valor, pd.Timestamp):
+        return valor.isoformat(timespec="milliseconds")
+    if isinstance(valor, float):
+        return round(valor, 10)  # Mesma precisão de DataFrame.to_json
+    return valor
+
+def conferir_registros(registros):
+    """Descarta notas repetidas, calcula os status de retenção e detecta problemas de sequência."""
+    unicas, repetidas = remove_duplicate_notes(registros)
+    if not unicas:
+        return {"notas": [], "problemas_sequencia": [], "repetidas": [r["arquivo"] for r in repetidas]}
+    if len(unicas) == 1:
+        # Caminho leve: uma nota só dispensa o DataFrame e não tem problema de sequência a apontar
+        nota = {col: _valor_json(valor) for col, valor in conferir_registro(unicas[0]).items()}
+        return {"notas": [nota], "problemas_sequencia": [], "repetidas": [r["arquivo"] for r in repetidas]}
+    # Valores monetários continuam numéricos no JSON (sem a formatação "R$ X.XXX,XX" da interface)
+    df_formatado = format_dataframe_for_display(pd.DataFrame(unicas), format_currency=False)
+    problemas = detect_sequence_issues(df_formatado)
+    return {
+        "notas": _dataframe_para_registros(df_formatado),
+        "problemas_sequencia": _dataframe_para_registros(problemas) if not problemas.empty else [],
+        "repetidas": [r["arquivo"] for r in repetidas],
+    }
+
+def _erros_json(erros):
+    return [{"arquivo": nome, "erro": str(erro)} for nome, erro in erros]
+
+
+# ====== ROTAS ======
+async def saude(request):
+    return JSONResponse({"status": "ok"})
+
+async def extrair(request):
+    xmls, erros = await ler_requisicao(request)
+    if not xmls:
+        return JSONResponse({"erro": "Nenhum XML encontrado no corpo da requisição.", "erros": _erros_json(erros)}, status_code=400)
+    try:
+        registros, erros_extracao = await run_in_threadpool(extrair_registros, xmls, campos_da_requisicao(request))
+    except ValueError as e:  # Projeção com campo desconhecido
+        return JSONResponse({"erro": str(e)}, status_code=400)
+    return JSONResponse({"notas": registros, "erros": _erros_json(erros + erros_extracao)})
+
+async def conferir(request):
+    xmls, erros = await ler_requisicao(request)
+    if not xmls:
+        return JSONResponse({"erro": "Nenhum XML encontrado no corpo da requisição.", "erros": _erros_json(erros)}, status_code=400)
+    registros, erros_extracao = await run_in_threadpool(extrair_registros, xmls)
+    resultado = await run_in_threadpool(conferir_registros, registros)
+    resultado["erros"] = _erros_json(erros + erros_extracao)
+    return JSONResponse(resultado)
+
+
+app = Starlette(routes=[
+    Route("/saude", saude, methods=["GET"]),
+    Route("/nfse/extrair", extrair, methods=["POST"]),
+    Route("/nfse/conferir", conferir, methods=["POST"]),
+])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serviço HTTP local de extração e conferência de NFS-e.")
+    parser.add_argument("--host", default=HOST_PADRAO)
+    parser.add_argument("--port", type=int, default=PORTA_PADRAO)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Processos do servidor (padrão: um por núcleo; a vazão escala com os núcleos).")
+    args = parser.parse_args()
+    uvicorn.run("nfse_api:app", host=args.host, port=args.port, workers=args.workers, log_level="warning")
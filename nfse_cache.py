@@ -0,0 +1,114 @@
+# nfse_cache.py - Cache de resultados compartilhado entre as sessões do Streamlit
+#
+# Cada sessão do viewer processava e guardava o próprio df_processed_viewer: três pessoas conferindo
+# o mesmo cliente extraíam e mantinham os mesmos dados três vezes. Este módulo guarda os resultados
+# processados uma única vez por processo do servidor (o módulo é importado uma vez e vale para todas
+# as sessões), indexados pela impressão digital do conjunto de dados (conteúdo dos XMLs ou assinatura
+# do banco, mais as regras da conferência).
+#
+# - Limite de memória configurável (NFSE_CACHE_MB); ao ultrapassá-lo, os conjuntos usados há mais
+#   tempo são descartados (LRU). Um resultado maior que o limite não é guardado.
+# - Cada sessão recebe uma visão: cópias rasas (copy(deep=False)) dos DataFrames, que compartilham
+#   os dados com o cache. Substituir ou acrescentar colunas (df[col] = ...) só afeta a sessão;
+#   alterações no lugar (df.loc[...] = ...) NÃO devem ser feitas nas visões.
+
+import hashlib
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+# ====== CONFIGURAÇÕES ======
+LIMITE_MEMORIA_MB = float(os.environ.get("NFSE_CACHE_MB", "1024"))
+
+_entradas = OrderedDict()  # chave -> (valor, tamanho em bytes); a mais recente fica no fim
+_trava = threading.Lock()
+_contadores = {'acertos': 0, 'faltas': 0, 'descartes': 0}
+
+
+# ====== CHAVES E TAMANHOS ======
+def chave_conjunto(*partes):
+    """Impressão digital (sha256) das partes que identificam o conjunto: textos, bytes, números, listas, dicionários."""
+    h = hashlib.sha256()
+    for parte in partes:
+        h.update(parte if isinstance(parte, bytes) else json.dumps(parte, sort_keys=True, default=str).encode("utf-8"))
+        h.update(b"\x00")
+    return h.hexdigest()
+
+def tamanho_em_bytes(valor):
+    """Memória ocupada pelo valor (DataFrames e Series pelo memory_usage profundo; dicionários e listas somados)."""
+    if isinstance(valor, pd.DataFrame):
+        return int(valor.memory_usage(deep=True, index=True).sum())
+    if isinstance(valor, pd.Series):
+        return int(valor.memory_usage(deep=True, index=True))
+    if isinstance(valor, dict):
+        return sys.getsizeof(valor) + sum(tamanho_em_bytes(v) for v in valor.values())
+    if isinstance(valor, (list, tuple)):
+        return sys.getsizeof(valor) + sum(tamanho_em_bytes(v) for v in valor)
+    return sys.getsizeof(valor)
+
+def _visao(valor):
+    """Visão do valor guardado para uma sessão: DataFrames/Series em cópia rasa, contêineres recriados."""
+    if isinstance(valor, (pd.DataFrame, pd.Series)):
+        return valor.copy(deep=False)
+    if isinstance(valor, dict):
+        return {chave: _visao(v) for chave, v in valor.items()}
+    if isinstance(valor, list):
+        return [_visao(v) for v in valor]
+    return valor
+
+
+# ====== OPERAÇÕES ======
+def obter(chave):
+    """Visão do resultado guardado na chave (que passa a ser o mais recente), ou None."""
+    with _trava:
+        entrada = _entradas.get(chave)
+        if entrada is None:
+            _contadores['faltas'] += 1
+            return None
+        _entradas.move_to_end(chave)
+        _contadores['acertos'] += 1
+    return _visao(entrada[0])
+
+def guardar(chave, valor, limite_mb=None):
+    """
+    Guarda o resultado na chave e descarta os menos usados até caber no limite. O cache fica com
+    uma visão própria (os dados são compartilhados), e quem guardou pode continuar usando os seus
+    objetos. Retorna False se o resultado sozinho for maior que o limite (não é guardado).
+    """
+    limite = (LIMITE_MEMORIA_MB if limite_mb is None else limite_mb) * 2**20
+    tamanho = tamanho_em_bytes(valor)
+    if tamanho > limite:
+        return False
+    with _trava:
+        _entradas[chave] = (_visao(valor), tamanho)
+        _entradas.move_to_end(chave)
+        total = sum(t for _, t in _entradas.values())
+        while total > limite:
+            _, (_, tamanho_descartado) = _entradas.popitem(last=False)
+            total -= tamanho_descartado
+            _contadores['descartes'] += 1
+    return True
+
+def descartar(chave):
+    """Remove a chave do cache (ex.: dados de origem alterados)."""
+    with _trava:
+        _entradas.pop(chave, None)
+
+def limpar():
+    """Esvazia o cache."""
+    with _trava:
+        _entradas.clear()
+
+def estatisticas():
+    """Conjuntos guardados, memória usada e limite (MB), acertos, faltas e descartes."""
+    with _trava:
+        return {
+            'conjuntos': len(_entradas),
+            'memoria_mb': round(sum(t for _, t in _entradas.values()) / 2**20, 1),
+            'limite_mb': LIMITE_MEMORIA_MB,
+            **_contadores,
+        }
@@ -0,0 +1,336 @@
+# nfse_conciliacao.py - Conciliação dos recebimentos (extrato bancário / contas a receber do ERP)
+#
+# Depois da conferência, o Valor Líquido NFSe de cada nota ativa ainda precisa ser encontrado no
+# extrato do banco ou no relatório de contas a receber do ERP. Este módulo:
+#   - lê o arquivo de lançamentos (CSV exportado pelo banco/ERP ou extrato OFX) e o normaliza nas
+#     colunas Identificador, Data, Valor, CNPJ e Descrição (só créditos: débitos são ignorados);
+#   - casa lançamentos e notas por valor (com tolerância em R$), janela de datas em torno da emissão
+#     e CNPJ/CPF do tomador (quando o lançamento o informa; extratos costumam trazê-lo só no
+#     histórico, de onde é extraído);
+#   - classifica cada nota como Conciliada, Ambígua ou Não conciliada, cada lançamento como
+#     Conciliado, Ambíguo ou Sem nota, e resume o resultado por competência.
+#
+# A junção é feita sobre os lançamentos ordenados por (faixa de valor, data): os candidatos de uma
+# nota formam poucos trechos contíguos, achados com busca binária (np.searchsorted), em
+# O((n + m) log m) para n notas e m lançamentos, sem produto cartesiano entre eles.
+
+import csv
+import io
+import os
+import re
+import unicodedata
+
+import numpy as np
+import pandas as pd
+
+# ====== CONFIGURAÇÕES ======
+TOLERANCIA_VALOR_PADRAO = 0.05  # R$ de diferença aceita entre o lançamento e o Valor Líquido NFSe
+DIAS_ANTES_PADRAO = 5           # Lançamento até N dias antes da emissão (adiantamentos)
+DIAS_DEPOIS_PADRAO = 60         # Lançamento até N dias depois da emissão (prazo de recebimento)
+
+# Colunas das notas usadas na conciliação (notas ativas, Valor Líquido NFSe numérico)
+COLUNAS_NOTAS = [
+    'Competência', 'Número da NF', 'Data Emissão', 'Prestador CNPJ', 'Tomador CNPJ/CPF',
+    'Tomador Razão Social', 'Valor Líquido NFSe',
+]
+COLUNAS_LANCAMENTOS = ['Identificador', 'Data', 'Valor', 'CNPJ', 'Descrição']
+
+# Nomes de coluna reconhecidos no CSV (comparados sem acentos, em minúsculas)
+ALIASES_COLUNAS = {
+    'Data': ['data', 'data lancamento', 'data do lancamento', 'data pagamento', 'data recebimento',
+             'data credito', 'data baixa', 'date', 'dtposted'],
+    'Valor': ['valor', 'valor recebido', 'valor pago', 'valor credito', 'credito', 'valor liquido',
+              'amount', 'trnamt'],
+    'CNPJ': ['cnpj', 'cpf', 'cnpj/cpf', 'cpf/cnpj', 'cnpj cpf', 'cpf cnpj', 'cnpj cliente', 'cnpj tomador',
+             'cnpj do cliente', 'documento cliente'],
+    'Descrição': ['descricao', 'historico', 'memo', 'cliente', 'nome', 'favorecido', 'pagador', 'name'],
+    'Identificador': ['id', 'identificador', 'fitid', 'documento', 'numero documento', 'nosso numero',
+                      'codigo', 'titulo'],
+}
+
+SITUACOES_NOTA = ['Conciliada', 'Ambígua', 'Não conciliada']
+SITUACOES_LANCAMENTO = ['Conciliado', 'Ambíguo', 'Sem nota']
+
+_PADRAO_CNPJ_CPF = re.compile(r'\d{2}\.?\d{3}\.?\d{3}/?\d{4}-?\d{2}|\d{3}\.\d{3}\.\d{3}-\d{2}')
+_PADRAO_TRANSACAO_OFX = re.compile(r'<STMTTRN>(.*?)(?:</STMTTRN>|(?=<STMTTRN>)|(?=</BANKTRANLIST>))', re.IGNORECASE | re.DOTALL)
+_PADRAO_CAMPO_OFX = re.compile(r'<(\w+)>([^<\r\n]*)')
+
+
+# ====== LEITURA DOS LANÇAMENTOS ======
+def _sem_acentos(texto):
+    texto = unicodedata.normalize('NFKD', str(texto)).encode('ascii', 'ignore').decode('ascii')
+    return re.sub(r'\s+', ' ', texto.replace('_', ' ')).strip().lower()
+
+def _decodificar(conteudo):
+    """Bytes do arquivo em texto: UTF-8 (com ou sem BOM) ou, se falhar, Latin-1 (comum nos bancos)."""
+    try:
+        return conteudo.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        return conteudo.decode('latin-1')
+
+def _para_numero(serie):
+    """Valores em texto (R$ 1.234,56 / 1234.56 / -50,00) em float. Valores inválidos viram NaN."""
+    if pd.api.types.is_numeric_dtype(serie):
+        return serie.astype(float)
+    texto = serie.astype(str).str.replace(r'[R$\s]', '', regex=True)
+    decimal_virgula = texto.str.contains(',', regex=False)
+    texto = texto.where(~decimal_virgula, texto.str.replace('.', '', regex=False).str.replace(',', '.', regex=False))
+    return pd.to_numeric(texto, errors='coerce')
+
+def _somente_digitos(serie):
+    return serie.astype(str).str.replace(r'\D', '', regex=True).where(serie.notna(), '')
+
+def _cnpj_do_texto(serie):
+    """Primeiro CNPJ/CPF (formatado ou com 14 dígitos) encontrado em cada texto, só com dígitos."""
+    return _somente_digitos(serie.astype(str).str.extract(f'({_PADRAO_CNPJ_CPF.pattern})', expand=False)).fillna('')
+
+def _ler_csv(texto):
+    """Lê o CSV (separador detectado entre ; , tab e |) e renomeia as colunas reconhecidas."""
+    amostra = texto[:64 * 1024]
+    try:
+        separador = csv.Sniffer().sniff(amostra, delimiters=';,\t|').delimiter
+    except csv.Error:
+        separador = ';'
+    df = pd.read_csv(io.StringIO(texto), sep=separador, dtype=str, skipinitialspace=True)
+    renomear = {}
+    for coluna in df.columns:
+        nome = _sem_acentos(coluna)
+        for destino, aliases in ALIASES_COLUNAS.items():
+            if nome in aliases and destino not in renomear.values():
+                renomear[coluna] = destino
+                break
+    df = df.rename(columns=renomear)
+    faltando = [coluna for coluna in ('Data', 'Valor') if coluna not in df.columns]
+    if faltando:
+        raise ValueError(f"Colunas obrigatórias não encontradas no CSV: {', '.join(faltando)} (colunas lidas: {', '.join(map(str, df.columns))}).")
+    return df
+
+def _ler_ofx(texto):
+    """Lançamentos (<STMTTRN>) de um extrato OFX 1.x (SGML) ou 2.x (XML)."""
+    registros = []
+    for bloco in _PADRAO_TRANSACAO_OFX.findall(texto):
+        campos = {nome.upper(): valor.strip() for nome, valor in _PADRAO_CAMPO_OFX.findall(bloco)}
+        registros.append({
+            'Identificador': campos.get('FITID') or campos.get('CHECKNUM') or campos.get('REFNUM'),
+            'Data': campos.get('DTPOSTED', '')[:8],
+            'Valor': campos.get('TRNAMT'),
+            'Descrição': ' '.join(filter(None, [campos.get('NAME'), campos.get('MEMO')])),
+        })
+    if not registros:
+        raise ValueError("Nenhum lançamento (<STMTTRN>) encontrado no arquivo OFX.")
+    df = pd.DataFrame(registros)
+    df['Data'] = pd.to_datetime(df['Data'], format='%Y%m%d', errors='coerce')
+    return df
+
+def carregar_lancamentos(arquivo, nome_arquivo=None):
+    """
+    Lê o arquivo de lançamentos (caminho, bytes ou arquivo aberto/enviado): OFX, pela extensão ou
+    pelo conteúdo, ou CSV. Retorna (lancamentos, ignorados): lancamentos com as COLUNAS_LANCAMENTOS
+    (Valor > 0, CNPJ só com dígitos ou vazio) e o número de linhas descartadas (débitos, data ou
+    valor inválidos).
+    """
+    if isinstance(arquivo, (str, os.PathLike)):
+        nome_arquivo = nome_arquivo or os.fspath(arquivo)
+        with open(arquivo, 'rb') as f:
+            conteudo = f.read()
+    elif isinstance(arquivo, bytes):
+        conteudo = arquivo
+    else:
+        nome_arquivo = nome_arquivo or getattr(arquivo, 'name', None)
+        conteudo = arquivo.getvalue() if hasattr(arquivo, 'getvalue') else arquivo.read()
+    texto = _decodificar(conteudo)
+
+    eh_ofx = (nome_arquivo or '').lower().endswith('.ofx') or '<ofx>' in texto[:4096].lower()
+    df = _ler_ofx(texto) if eh_ofx else _ler_csv(texto)
+
+    lancamentos = pd.DataFrame(index=df.index)
+    lancamentos['Identificador'] = (
+        df['Identificador'].fillna('').astype(str) if 'Identificador' in df.columns else ''
+    )
+    if pd.api.types.is_datetime64_any_dtype(df['Data']):
+        lancamentos['Data'] = df['Data']
+    else:
+        lancamentos['Data'] = pd.to_datetime(df['Data'], dayfirst=True, format='mixed', errors='coerce')
+    lancamentos['Data'] = lancamentos['Data'].dt.normalize()
+    lancamentos['Valor'] = _para_numero(df['Valor'])
+    lancamentos['Descrição'] = df['Descrição'].fillna('').astype(str) if 'Descrição' in df.columns else ''
+    if 'CNPJ' in df.columns:
+        lancamentos['CNPJ'] = _somente_digitos(df['CNPJ'])
+    else:
+        lancamentos['CNPJ'] = _cnpj_do_texto(lancamentos['Descrição'])
+    # Sem identificador no arquivo, a linha de origem (a partir de 1) identifica o lançamento
+    sem_identificador = lancamentos['Identificador'].str.strip().eq('')
+    lancamentos.loc[sem_identificador, 'Identificador'] = (lancamentos.index[sem_identificador] + 1).astype(str)
+
+    validos = lancamentos['Data'].notna() & lancamentos['Valor'].gt(0)
+    return lancamentos.loc[validos, COLUNAS_LANCAMENTOS].reset_index(drop=True), int((~validos).sum())
+
+
+# ====== JUNÇÃO COM TOLERÂNCIA ======
+def _dias(datas):
+    """Datas em dias desde 1970-01-01 (int64); NaT vira -1."""
+    dias = datas.dt.normalize().to_numpy(dtype='datetime64[D]').astype(np.int64)
+    return np.where(datas.isna().to_numpy(), -1, dias)
+
+def _pares_candidatos(notas, lancamentos, tolerancia, dias_antes, dias_depois):
+    """
+    Pares candidatos (posição da nota, posição do lançamento, nível): valor a até 'tolerancia'
+    centavos, data do lançamento entre emissão - dias_antes e emissão + dias_depois e CNPJ
+    compatível (igual ao do tomador ou ausente no lançamento). O nível ordena a força do par:
+    0 = CNPJ igual e valor exato, 1 = CNPJ igual, 2 = sem CNPJ e valor exato, 3 = sem CNPJ.
+
+    Os valores são agrupados em faixas de (tolerancia + 1) centavos: os candidatos de uma nota estão
+    em no máximo 3 faixas seguidas e, com os lançamentos ordenados por (faixa, dia), a janela de
+    datas de cada faixa é um trecho contíguo. São 3 rodadas de busca binária, qualquer que seja a
+    tolerância; os poucos lançamentos da faixa fora da tolerância são descartados depois.
+    """
+    largura_faixa = tolerancia + 1
+    largura_dias = np.int64(2 ** 20)  # > faixa de dias (datas de 1970 até ~4840)
+    deslocamento_dias = dias_antes + 1  # mantém (dia - dias_antes) positivo dentro da faixa
+
+    centavos_l = np.round(lancamentos['Valor'].to_numpy(dtype=float) * 100).astype(np.int64)
+    chave_l = (centavos_l // largura_faixa) * largura_dias + (_dias(lancamentos['Data']) + deslocamento_dias)
+    ordem_l = np.argsort(chave_l, kind='stable')
+    chave_l = chave_l[ordem_l]
+
+    valor_n = notas['Valor Líquido NFSe'].to_numpy(dtype=float)
+    dias_n = _dias(notas['Data Emissão'])
+    validas = np.flatnonzero(~np.isnan(valor_n) & (dias_n >= 0))
+    centavos_n = np.round(valor_n[validas] * 100).astype(np.int64)
+    dias_n = dias_n[validas] + deslocamento_dias
+    primeira_faixa = (centavos_n - tolerancia) // largura_faixa
+    ultima_faixa = (centavos_n + tolerancia) // largura_faixa
+
+    posicoes_n, posicoes_l = [], []
+    for rodada in range(3):
+        faixa = primeira_faixa + rodada
+        base = faixa * largura_dias + dias_n
+        inicio = np.searchsorted(chave_l, base - dias_antes, side='left')
+        fim = np.searchsorted(chave_l, base + dias_depois, side='right')
+        quantidade = np.where(faixa <= ultima_faixa, fim - inicio, 0)
+        total = int(quantidade.sum())
+        if not total:
+            continue
+        # Expande cada trecho [inicio, fim) em posições individuais, sem laço em Python
+        repeticao = np.repeat(np.arange(len(validas)), quantidade)
+        passo = np.arange(total) - np.repeat(np.cumsum(quantidade) - quantidade, quantidade)
+        posicoes_n.append(repeticao)
+        posicoes_l.append(ordem_l[inicio[repeticao] + passo])
+    if not posicoes_n:
+        vazio = np.empty(0, dtype=np.int64)
+        return vazio, vazio, vazio
+    repeticao, posicoes_l = np.concatenate(posicoes_n), np.concatenate(posicoes_l)
+
+    diferenca = np.abs(centavos_l[posicoes_l] - centavos_n[repeticao])
+    posicoes_n = validas[repeticao]
+    cnpj_l = lancamentos['CNPJ'].to_numpy(dtype=object)[posicoes_l]
+    cnpj_n = _somente_digitos(notas['Tomador CNPJ/CPF']).to_numpy(dtype=object)[posicoes_n]
+    sem_cnpj = cnpj_l == ''
+    mantidos = (diferenca <= tolerancia) & (sem_cnpj | (cnpj_l == cnpj_n))
+    nivel = 2 * sem_cnpj.astype(np.int64) + (diferenca != 0)
+    return posicoes_n[mantidos], posicoes_l[mantidos], nivel[mantidos]
+
+def conciliar(notas, lancamentos, tolerancia_valor=TOLERANCIA_VALOR_PADRAO,
+              dias_antes=DIAS_ANTES_PADRAO, dias_depois=DIAS_DEPOIS_PADRAO):
+    """
+    Concilia as notas ativas (COLUNAS_NOTAS, Valor Líquido NFSe numérico) com os lançamentos de
+    carregar_lancamentos. Os pares candidatos são examinados do nível mais forte para o mais fraco
+    (CNPJ igual antes de lançamento sem CNPJ; valor exato antes de valor na tolerância): em cada
+    nível, nota e lançamento ainda livres são conciliados quando um é o único candidato do outro.
+    O que sobra com candidatos livres fica como ambíguo, para conferência manual.
+    Retorna (notas, lancamentos) com o resultado:
+      notas: + Situação Conciliação, Candidatos, Lançamento, Data Lançamento, Valor Lançamento, Diferença;
+      lancamentos: + Situação Conciliação, Candidatos, Número da NF, Competência (da nota conciliada
+      ou, sem ela, o mês do lançamento).
+    """
+    if tolerancia_valor < 0 or dias_antes < 0 or dias_depois < 0:
+        raise ValueError("Tolerância de valor e janela de dias não podem ser negativas.")
+    notas = notas[COLUNAS_NOTAS].reset_index(drop=True)
+    lancamentos = lancamentos[COLUNAS_LANCAMENTOS].reset_index(drop=True)
+    posicoes_n, posicoes_l, nivel = _pares_candidatos(
+        notas, lancamentos, int(round(tolerancia_valor * 100)), int(dias_antes), int(dias_depois)
+    )
+
+    livre_n = np.ones(len(notas), dtype=bool)
+    livre_l = np.ones(len(lancamentos), dtype=bool)
+    lancamento_da_nota = np.full(len(notas), -1, dtype=np.int64)
+    for nivel_maximo in range(4):
+        considerados = (nivel <= nivel_maximo) & livre_n[posicoes_n] & livre_l[posicoes_l]
+        pares_n, pares_l = posicoes_n[considerados], posicoes_l[considerados]
+        unico = (
+            (np.bincount(pares_n, minlength=len(notas))[pares_n] == 1)
+            & (np.bincount(pares_l, minlength=len(lancamentos))[pares_l] == 1)
+        )
+        lancamento_da_nota[pares_n[unico]] = pares_l[unico]
+        livre_n[pares_n[unico]] = False
+        livre_l[pares_l[unico]] = False
+    nota_conciliada = np.flatnonzero(lancamento_da_nota >= 0)
+    lancamento_conciliado = lancamento_da_nota[nota_conciliada]
+    # Ambíguos: livres que ainda têm candidato livre do outro lado
+    restantes = livre_n[posicoes_n] & livre_l[posicoes_l]
+    ambigua_n = np.bincount(posicoes_n[restantes], minlength=len(notas)) > 0
+    ambiguo_l = np.bincount(posicoes_l[restantes], minlength=len(lancamentos)) > 0
+
+    situacao_n = np.where(ambigua_n, 'Ambígua', 'Não conciliada').astype(object)
+    situacao_n[nota_conciliada] = 'Conciliada'
+    notas = notas.assign(**{
+        'Situação Conciliação': pd.Categorical(situacao_n, categories=SITUACOES_NOTA),
+        'Candidatos': np.bincount(posicoes_n, minlength=len(notas)),
+        'Lançamento': None, 'Data Lançamento': pd.NaT, 'Valor Lançamento': np.nan,
+    })
+    notas.loc[nota_conciliada, 'Lançamento'] = lancamentos['Identificador'].to_numpy()[lancamento_conciliado]
+    notas.loc[nota_conciliada, 'Data Lançamento'] = lancamentos['Data'].to_numpy()[lancamento_conciliado]
+    notas.loc[nota_conciliada, 'Valor Lançamento'] = lancamentos['Valor'].to_numpy()[lancamento_conciliado]
+    notas['Diferença'] = (notas['Valor Lançamento'] - notas['Valor Líquido NFSe']).round(2)
+
+    situacao_l = np.where(ambiguo_l, 'Ambíguo', 'Sem nota').astype(object)
+    situacao_l[lancamento_conciliado] = 'Conciliado'
+    lancamentos = lancamentos.assign(**{
+        'Situação Conciliação': pd.Categorical(situacao_l, categories=SITUACOES_LANCAMENTO),
+        'Candidatos': np.bincount(posicoes_l, minlength=len(lancamentos)),
+        'Número da NF': None,
+        'Competência': lancamentos['Data'].dt.strftime('%Y-%m'),
+    })
+    lancamentos.loc[lancamento_conciliado, 'Número da NF'] = notas['Número da NF'].to_numpy()[nota_conciliada]
+    lancamentos.loc[lancamento_conciliado, 'Competência'] = notas['Competência'].astype(str).to_numpy()[nota_conciliada]
+    return notas, lancamentos
+
+def resumo_conciliacao(notas, lancamentos):
+    """
+    Totais por competência (mais recente primeiro): notas e valores conciliados, ambíguos e não
+    conciliados, e lançamentos sem nota ou ambíguos.
+    """
+    competencia_n = notas['Competência'].astype(str)
+    contagem_n = pd.crosstab(competencia_n, notas['Situação Conciliação'], dropna=False)
+    valores_n = notas.pivot_table(
+        index=competencia_n, columns='Situação Conciliação', values='Valor Líquido NFSe',
+        aggfunc='sum', observed=False, fill_value=0.0,
+    )
+    contagem_l = pd.crosstab(lancamentos['Competência'], lancamentos['Situação Conciliação'], dropna=False)
+    valores_l = lancamentos.pivot_table(
+        index='Competência', columns='Situação Conciliação', values='Valor',
+        aggfunc='sum', observed=False, fill_value=0.0,
+    )
+    resumo = pd.DataFrame({
+        'Notas': contagem_n.sum(axis=1),
+        'Conciliadas': contagem_n.get('Conciliada'),
+        'Ambíguas': contagem_n.get('Ambígua'),
+        'Não conciliadas': contagem_n.get('Não conciliada'),
+        'Valor conciliado': valores_n.get('Conciliada'),
+        'Valor não conciliado': valores_n.get('Não conciliada'),
+        'Lançamentos sem nota': contagem_l.get('Sem nota'),
+        'Valor sem nota': valores_l.get('Sem nota'),
+        'Lançamentos ambíguos': contagem_l.get('Ambíguo'),
+    })
+    resumo = resumo.fillna(0).astype({coluna: int for coluna in resumo.columns if not coluna.startswith('Valor')})
+    resumo = resumo.round({coluna: 2 for coluna in resumo.columns if coluna.startswith('Valor')})
+    return resumo.rename_axis('Competência').sort_index(ascending=False).reset_index()
+
+def exportar_conciliacao(notas, lancamentos):
+    """Planilha Excel (bytes) com as abas Resumo, Notas e Lançamentos."""
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
+        resumo_conciliacao(notas, lancamentos).to_excel(writer, index=False, sheet_name='Resumo')
+        notas.to_excel(writer, index=False, sheet_name='Notas')
+        lancamentos.to_excel(writer, index=False, sheet_name='Lançamentos')
+    return buffer.getvalue()
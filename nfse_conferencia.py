@@ -0,0 +1,846 @@
+# nfse_conferencia.py - Conferência de retenções, análise de sequência de NF e exportações
+# Funções sem estado de interface e sem Streamlit, usadas pelo app_viewer.py, pelo nfse_api.py, pelo
+# pacote de relatórios (também nos processos auxiliares) e pelos benchmarks.
+
+import datetime
+import io
+import json
+import os
+import re
+import numpy as np
+import pandas as pd
+
+from nfse_parser import nfse_fingerprint
+
+# --- Configurações de Alíquotas e Limites de Retenção ---
+# Para Lucro Presumido - Regime Normal (ajuste conforme a legislação vigente e o tipo de serviço)
+# IMPORTANTE: Estas alíquotas e limites são referenciais e devem ser validadas pela equipe fiscal.
+ALIQUOTA_IRRF = 0.015
+LIMITE_IRRF_SERVICO = 666.67 # Valor do serviço para que haja retenção de IRRF
+
+ALIQUOTA_CSLL = 0.01
+ALIQUOTA_PIS = 0.0065
+ALIQUOTA_COFINS = 0.03
+LIMITE_CSRF_SERVICO = 215.05 # Valor do serviço para que haja retenção combinada (CSLL, PIS, COFINS)
+
+# ISSQN é variável por município. A alíquota padrão abaixo é apenas um exemplo.
+# Para uma conferência precisa de ISSQN, seria necessário uma base de dados de alíquotas por município.
+ALIQUOTA_ISSQN_REFERENCIA = 0.03 # Alíquota de referência para cálculo de ISSQN esperado, se aplicável
+# --- Configurações de Alíquotas para EQUIPARAÇÃO HOSPITALAR ---
+# Baseado em Faturamento Bruto (Valor dos Serviços)
+ALIQUOTA_IRPJ_EQ_HOSP = 0.012   # 1.2% do faturamento
+ALIQUOTA_CSLL_EQ_HOSP = 0.0108  # 1.08% do faturamento
+ALIQUOTA_PIS_EQ_HOSP = 0.0065   # 0.65% do faturamento
+ALIQUOTA_COFINS_EQ_HOSP = 0.03  # 3.00% do faturamento
+ALIQUOTA_ISSQN_EQ_HOSP = 0.0201 # 2.01% do faturamento
+# --- Configurações de Alíquotas do Lucro Presumido (Normal) sobre o faturamento ---
+ALIQUOTA_IRPJ_PRESUMIDO = 0.048    # 4.8% do faturamento
+ALIQUOTA_CSLL_PRESUMIDO = 0.0288   # 2.88% do faturamento
+ALIQUOTA_PIS_PRESUMIDO = 0.0065    # 0.65% do faturamento
+ALIQUOTA_COFINS_PRESUMIDO = 0.03   # 3.00% do faturamento
+
+# --- Regras Tributárias Versionadas ---
+# As constantes acima formam a versão padrão (versão 1). Versões editadas na interface são gravadas
+# em ARQUIVO_REGRAS (JSON) e nunca sobrescritas: cada alteração vira uma nova versão.
+ARQUIVO_REGRAS = os.environ.get("NFSE_REGRAS_PATH", "regras_tributarias.json")
+REGRAS_PADRAO = {
+    'aliquota_irrf': ALIQUOTA_IRRF,
+    'limite_irrf_servico': LIMITE_IRRF_SERVICO,
+    'aliquota_csll': ALIQUOTA_CSLL,
+    'aliquota_pis': ALIQUOTA_PIS,
+    'aliquota_cofins': ALIQUOTA_COFINS,
+    'limite_csrf_servico': LIMITE_CSRF_SERVICO,
+    'aliquota_issqn_referencia': ALIQUOTA_ISSQN_REFERENCIA,
+    'aliquota_irpj_presumido': ALIQUOTA_IRPJ_PRESUMIDO,
+    'aliquota_csll_presumido': ALIQUOTA_CSLL_PRESUMIDO,
+    'aliquota_pis_presumido': ALIQUOTA_PIS_PRESUMIDO,
+    'aliquota_cofins_presumido': ALIQUOTA_COFINS_PRESUMIDO,
+    'aliquota_irpj_eq_hosp': ALIQUOTA_IRPJ_EQ_HOSP,
+    'aliquota_csll_eq_hosp': ALIQUOTA_CSLL_EQ_HOSP,
+    'aliquota_pis_eq_hosp': ALIQUOTA_PIS_EQ_HOSP,
+    'aliquota_cofins_eq_hosp': ALIQUOTA_COFINS_EQ_HOSP,
+    'aliquota_issqn_eq_hosp': ALIQUOTA_ISSQN_EQ_HOSP,
+}
+# Rótulos das regras para a edição na interface
+DESCRICAO_REGRAS = {
+    'aliquota_irrf': 'Alíquota IRRF retido',
+    'limite_irrf_servico': 'Valor mínimo do serviço para reter IRRF (R$)',
+    'aliquota_csll': 'Alíquota CSLL retida',
+    'aliquota_pis': 'Alíquota PIS retido',
+    'aliquota_cofins': 'Alíquota COFINS retida',
+    'limite_csrf_servico': 'Valor mínimo do serviço para reter CSLL/PIS/COFINS (R$)',
+    'aliquota_issqn_referencia': 'Alíquota ISSQN de referência',
+    'aliquota_irpj_presumido': 'IRPJ sobre o faturamento (Presumido Normal)',
+    'aliquota_csll_presumido': 'CSLL sobre o faturamento (Presumido Normal)',
+    'aliquota_pis_presumido': 'PIS sobre o faturamento (Presumido Normal)',
+    'aliquota_cofins_presumido': 'COFINS sobre o faturamento (Presumido Normal)',
+    'aliquota_irpj_eq_hosp': 'IRPJ sobre o faturamento (Equiparação Hospitalar)',
+    'aliquota_csll_eq_hosp': 'CSLL sobre o faturamento (Equiparação Hospitalar)',
+    'aliquota_pis_eq_hosp': 'PIS sobre o faturamento (Equiparação Hospitalar)',
+    'aliquota_cofins_eq_hosp': 'COFINS sobre o faturamento (Equiparação Hospitalar)',
+    'aliquota_issqn_eq_hosp': 'ISSQN sobre o faturamento (Equiparação Hospitalar)',
+}
+# --- Mapeamento de Nomes de Colunas para Exibição Amigável ---
+# Mantenha os nomes originais como chaves para que o rename funcione corretamente.
+column_display_names = {
+    # NFSe Geral
+    'Nfse.Id': 'ID NFSe',
+    'Numero': 'Número da NF',
+    'CodigoVerificacao': 'Código Verificação',
+    'DataEmissao': 'Data Emissão',
+    'NaturezaOperacao': 'Natureza Operação',
+    'RegimeEspecialTributacao': 'Regime Tributação',
+    'OptanteSimplesNacional': 'Simples Nacional',
+    'IncentivadorCultural': 'Incentivador Cultural',
+
+    # Serviço
+    'DescricaoServico': 'Descrição do Serviço',
+    'ItemListaServico': 'Item Lista Serviço',
+    'CodigoTributacaoMunicipio': 'Cód. Tributação Município',
+    'CodigoMunicipioServico': 'Cód. Município Serviço',
+
+    # Valores do Serviço
+    'ValorServicos': 'Valor dos Serviços',
+    'ValorDeducoes': 'Deduções',
+    'ValorPis': 'PIS',
+    'ValorCofins': 'COFINS',
+    'ValorInss': 'INSS',
+    'ValorIr': 'IR',
+    'ValorCsll': 'CSLL',
+    'IssRetido': 'ISS Retido (Cód)',
+    'ValorIss': 'Valor ISS',
+    'ValorIssRetido': 'Valor ISS Retido',
+    'OutrasRetencoes': 'Outras Retenções',
+    'BaseCalculo': 'Base de Cálculo',
+    'Aliquota': 'Alíquota',
+    'ValorLiquidoNfse': 'Valor Líquido NFSe',
+    'DescontoIncondicionado': 'Desconto Incondicionado',
+    'DescontoCondicionado': 'Desconto Condicionado',
+
+    # Prestador
+    'Prestador.CpfCnpj': 'Prestador CNPJ',
+    'Prestador.InscricaoMunicipal': 'Prestador Inscr. Municipal',
+    'Prestador.RazaoSocial': 'Prestador Razão Social',
+    'Prestador.Endereco.Logradouro': 'Prestador Logradouro',
+    'Prestador.Endereco.Numero': 'Prestador Número',
+    'Prestador.Endereco.Complemento': 'Prestador Complemento',
+    'Prestador.Endereco.Bairro': 'Prestador Bairro',
+    'Prestador.Endereco.CodigoMunicipio': 'Prestador Cód. Município',
+    'Prestador.Endereco.Uf': 'Prestador UF',
+    'Prestador.Endereco.Cep': 'Prestador CEP',
+    'Prestador.Contato.Telefone': 'Prestador Telefone',
+    'Prestador.Contato.Email': 'Prestador E-mail',
+
+    # Tomador
+    'TomadorServico.CpfCnpj': 'Tomador CNPJ/CPF',
+    'TomadorServico.RazaoSocial': 'Tomador Razão Social',
+    'TomadorServico.Endereco.Logradouro': 'Tomador Logradouro',
+    'TomadorServico.Endereco.Numero': 'Tomador Número',
+    'TomadorServico.Endereco.Bairro': 'Tomador Bairro',
+    'TomadorServico.Endereco.CodigoMunicipio': 'Tomador Cód. Município',
+    'TomadorServico.Endereco.Uf': 'Tomador UF',
+    'TomadorServico.Endereco.Cep': 'Tomador CEP',
+    'TomadorServico.Contato.Telefone': 'Tomador Telefone',
+
+    # Órgão Gerador
+    'OrgaoGerador.CodigoMunicipio': 'Org. Gerador Cód. Município',
+    'OrgaoGerador.Uf': 'Org. Gerador UF',
+
+    # Novas colunas calculadas/ajustadas para display
+    'Competencia': 'Competência',
+    'Tomador Tipo': 'Tomador Tipo',
+    'Prestador Regime': 'Prestador Regime',
+    'IsCancelled': 'Status Cancelamento',
+
+    # Novas colunas para conferência de retenções (internas, não exibidas por padrão na tabela)
+    'IR Esperado': 'IR Esperado',
+    'CSLL Esperado': 'CSLL Esperado',
+    'PIS Esperado': 'PIS Esperado',
+    'COFINS Esperado': 'COFINS Esperado',
+    'ISSQN Esperado': 'ISSQN Esperado',
+    'Status IR': 'Status IR',
+    'Status CSLL': 'Status CSLL',
+    'Status PIS': 'Status PIS',
+    'Status COFINS': 'Status COFINS',
+    'Status ISS Retido': 'Status ISS Retido',
+    'Status Geral Retenções': 'Status Geral Retenções'
+}
+
+# INÍCIO DA CORREÇÃO: Definição GLOBAL da lista de colunas monetárias
+# Linha 95
+currency_cols_for_display = [
+    'Valor dos Serviços', 'Deduções', 'PIS', 'COFINS', 'INSS',
+    'IR', 'CSLL', 'Valor ISS', 'Valor ISS Retido', 'Outras Retenções',
+    'BaseCalculo', 'ValorLiquidoNfse', 'DescontoIncondicionado', 'DescontoCondicionado',
+    'IR Esperado', 'CSLL Esperado', 'PIS Esperado', 'COFINS Esperado', 'ISSQN Esperado'
+]
+# FIM DA CORREÇÃO
+
+# --- Categorias fixas das colunas de texto repetitivo ---
+# Essas colunas são armazenadas como pd.Categorical: cada valor vira um código inteiro,
+# o que reduz a memória das cópias do DataFrame e acelera os filtros (isin/str.contains).
+# Todo valor atribuído a essas colunas DEVE constar da lista correspondente.
+STATUS_IMPOSTO_CATEGORIAS = [
+    'Não Aplicável', 'OK', 'Divergência', 'Retenção Indevida', 'Cancelado',
+    'OK (Conferir Alíquota)', 'Divergência (ISSQN)', 'Retenção Indevida (ISSQN)', 'Não Retido (OK)'
+]
+STATUS_GERAL_CATEGORIAS = [
+    'Não Aplicável', 'OK', 'INCONSISTÊNCIA', 'INCONSISTÊNCIA (Retenção Indevida)', 'ATENÇÃO', 'Cancelado'
+]
+categorical_cols_fixed = {
+    'Status IR': STATUS_IMPOSTO_CATEGORIAS,
+    'Status CSLL': STATUS_IMPOSTO_CATEGORIAS,
+    'Status PIS': STATUS_IMPOSTO_CATEGORIAS,
+    'Status COFINS': STATUS_IMPOSTO_CATEGORIAS,
+    'Status ISS Retido': STATUS_IMPOSTO_CATEGORIAS,
+    'Status Geral Retenções': STATUS_GERAL_CATEGORIAS,
+    'Prestador Regime': ['Simples Nacional', 'Lucro Presumido', 'Não Informado'],
+    'Tomador Tipo': ['Pessoa Física', 'Pessoa Jurídica', 'Não Identificado'],
+    'Status Cancelamento': ['Não', 'Sim'],
+}
+# Colunas categóricas cujas categorias dependem dos dados carregados
+categorical_cols_from_data = ['Competência', 'Prestador Razão Social']
+
+
+# --- Versões das Regras Tributárias ---
+def carregar_versoes_regras(caminho=None):
+    """
+    Lista as versões das regras (mais antiga primeiro): dicionários com 'versao', 'criada_em',
+    'descricao' e 'regras'. Sem arquivo, só existe a versão padrão.
+    """
+    caminho = caminho or ARQUIVO_REGRAS
+    versoes = [{'versao': 1, 'criada_em': None, 'descricao': 'Padrão', 'regras': dict(REGRAS_PADRAO)}]
+    if os.path.exists(caminho):
+        with open(caminho, encoding='utf-8') as f:
+            versoes = json.load(f)['versoes']
+    # Regras criadas depois da versão gravada assumem o valor padrão
+    return [{**versao, 'regras': {**REGRAS_PADRAO, **versao['regras']}} for versao in versoes]
+
+def regras_tributarias(versao=None, caminho=None):
+    """Regras da versão informada (ou da mais recente)."""
+    versoes = carregar_versoes_regras(caminho)
+    if versao is None:
+        return versoes[-1]['regras']
+    for item in versoes:
+        if item['versao'] == versao:
+            return item['regras']
+    raise KeyError(f"Versão {versao} das regras tributárias não encontrada.")
+
+def salvar_versao_regras(regras, descricao="", caminho=None):
+    """Grava as regras como uma nova versão (as anteriores são mantidas). Retorna o número da versão."""
+    caminho = caminho or ARQUIVO_REGRAS
+    versoes = carregar_versoes_regras(caminho)
+    nova = {
+        'versao': versoes[-1]['versao'] + 1,
+        'criada_em': datetime.datetime.now().isoformat(timespec='seconds'),
+        'descricao': descricao,
+        'regras': {chave: float(regras[chave]) for chave in REGRAS_PADRAO},
+    }
+    temporario = caminho + '.tmp'
+    with open(temporario, 'w', encoding='utf-8') as f:
+        json.dump({'versoes': versoes + [nova]}, f, indent=2, ensure_ascii=False)
+    os.replace(temporario, caminho)  # Troca atômica: o arquivo nunca fica pela metade
+    return nova['versao']
+
+
+# --- Funções Auxiliares para Cálculo de Retenções Esperadas ---
+def calcular_irrf_esperado(valor_servicos, regras=REGRAS_PADRAO):
+    """Calcula o IRRF esperado para Lucro Presumido (Normal)."""
+    if valor_servicos >= regras['limite_irrf_servico']:
+        return valor_servicos * regras['aliquota_irrf']
+    return 0.0
+
+def calcular_csrf_esperado(valor_servicos, regras=REGRAS_PADRAO):
+    """Calcula CSLL, PIS e COFINS esperados para Lucro Presumido (Normal)."""
+    if valor_servicos >= regras['limite_csrf_servico']:
+        return {
+            'CSLL': valor_servicos * regras['aliquota_csll'],
+            'PIS': valor_servicos * regras['aliquota_pis'],
+            'COFINS': valor_servicos * regras['aliquota_cofins']
+        }
+    return {'CSLL': 0.0, 'PIS': 0.0, 'COFINS': 0.0}
+
+def calcular_issqn_esperado(base_calculo, aliquota_xml, regras=REGRAS_PADRAO):
+    """
+    Calcula o ISSQN esperado. Se a alíquota do XML for válida, usa-a.
+    Caso contrário, usa uma alíquota de referência definida nas regras.
+    """
+    if base_calculo is None or base_calculo <= 0:
+        return 0.0
+    # Alíquota do XML vem como porcentagem (ex: 3.00 para 3%), então divide por 100
+    if aliquota_xml is not None and aliquota_xml > 0:
+        return base_calculo * (aliquota_xml / 100)
+    # Se não houver alíquota no XML ou ela for zero/inválida, usa uma alíquota de referência
+    return base_calculo * regras['aliquota_issqn_referencia']
+
+
+# --- Conferência Vetorizada (valores esperados e status de retenção) ---
+# Colunas numéricas de que a conferência precisa (nomes de exibição)
+COLUNAS_BASE_CONFERENCIA = [
+    'Valor dos Serviços', 'Base de Cálculo', 'Alíquota', 'IR', 'CSLL', 'PIS', 'COFINS', 'Valor ISS Retido'
+]
+# Colunas produzidas pela conferência, na ordem em que aparecem no DataFrame
+COLUNAS_CONFERENCIA = [
+    'IR Esperado', 'CSLL Esperado', 'PIS Esperado', 'COFINS Esperado', 'ISSQN Esperado',
+    'Status IR', 'Status CSLL', 'Status PIS', 'Status COFINS', 'Status ISS Retido', 'Status Geral Retenções',
+]
+
+def _cenarios(cancelada, regime, tomador):
+    """Cenário de cada nota (arrays numpy: cancelada bool, regime e tipo do tomador como texto)."""
+    sem_retencao = ~cancelada & ((regime == 'Simples Nacional') | (tomador == 'Pessoa Física'))
+    com_retencao = ~cancelada & ~sem_retencao & (regime == 'Lucro Presumido') & (tomador == 'Pessoa Jurídica')
+    return np.select([cancelada, sem_retencao, com_retencao], ['cancelada', 'sem_retencao', 'com_retencao'], 'outros')
+
+def base_conferencia(df_formatted):
+    """
+    Quadro numérico enxuto com o que a conferência usa: os valores (float) e o cenário de cada nota
+    ('cancelada', 'sem_retencao' para Simples Nacional/Pessoa Física, 'com_retencao' para Lucro
+    Presumido com tomador PJ, 'outros'). Deve ser montado antes da formatação das colunas monetárias;
+    guardado, permite re-conferir com outras regras sem reprocessar os XMLs.
+    """
+    base = pd.DataFrame(
+        {col: pd.to_numeric(df_formatted[col], errors='coerce').fillna(0).astype(float) for col in COLUNAS_BASE_CONFERENCIA},
+        index=df_formatted.index,
+    )
+    base['Cenário'] = pd.Categorical(
+        _cenarios(
+            df_formatted['Status Cancelamento'].astype(str).eq('Sim').to_numpy(),
+            df_formatted['Prestador Regime'].astype(str).to_numpy(),
+            df_formatted['Tomador Tipo'].astype(str).to_numpy(),
+        ),
+        categories=['cancelada', 'sem_retencao', 'com_retencao', 'outros'],
+    )
+    base['ISS Retido (Cód)'] = df_formatted['ISS Retido (Cód)'].astype(str)
+    return base
+
+def _calcular_conferencia_arrays(cenario, valores, iss_retido_cod, regras):
+    """
+    Núcleo da conferência sobre arrays numpy (um elemento por nota): o cenário (ver _cenarios), os
+    valores das COLUNAS_BASE_CONFERENCIA (coluna -> array float) e o 'ISS Retido (Cód)' como texto.
+    Retorna {coluna: array} com as COLUNAS_CONFERENCIA (status como texto).
+    """
+    cancelada = cenario == 'cancelada'
+    sem_retencao = cenario == 'sem_retencao'
+    com_retencao = cenario == 'com_retencao'
+    valor_servicos = valores['Valor dos Serviços']
+
+    # Valores esperados (só há retenção esperada no cenário com retenção)
+    retem_irrf = com_retencao & (valor_servicos >= regras['limite_irrf_servico'])
+    retem_csrf = com_retencao & (valor_servicos >= regras['limite_csrf_servico'])
+    esperados = {
+        'IR': np.where(retem_irrf, valor_servicos * regras['aliquota_irrf'], 0.0),
+        'CSLL': np.where(retem_csrf, valor_servicos * regras['aliquota_csll'], 0.0),
+        'PIS': np.where(retem_csrf, valor_servicos * regras['aliquota_pis'], 0.0),
+        'COFINS': np.where(retem_csrf, valor_servicos * regras['aliquota_cofins'], 0.0),
+    }
+
+    resultado = {}
+    status = {}
+    retencao_indevida = np.zeros(len(cenario), dtype=bool)
+    divergencia = np.zeros(len(cenario), dtype=bool)
+    for imposto, esperado in esperados.items():
+        retido = valores[imposto]
+        confere = np.isclose(retido, esperado, atol=0.01)
+        indevida = retido > 0.01
+        resultado[f'{imposto} Esperado'] = esperado
+        status[f'Status {imposto}'] = np.select(
+            [cancelada, sem_retencao & indevida, sem_retencao, com_retencao & confere, com_retencao],
+            ['Cancelado', 'Retenção Indevida', 'OK', 'OK', 'Divergência'],
+            'Não Aplicável',
+        )
+        retencao_indevida |= sem_retencao & indevida
+        divergencia |= com_retencao & ~confere
+
+    # ISSQN Retido: conferido pela alíquota do XML (ou a de referência) quando o XML indica retenção
+    iss_retido = valores['Valor ISS Retido']
+    base_calculo = valores['Base de Cálculo']
+    aliquota_xml = valores['Alíquota']
+    iss_calculado = np.where(
+        base_calculo <= 0, 0.0,
+        np.where(aliquota_xml > 0, base_calculo * (aliquota_xml / 100), base_calculo * regras['aliquota_issqn_referencia'])
+    )
+    iss_declarado = com_retencao & (iss_retido_cod == 'Sim')
+    iss_indevido = iss_retido > 0.01
+    resultado['ISSQN Esperado'] = np.where(iss_declarado, iss_calculado, 0.0)
+    status['Status ISS Retido'] = np.select(
+        [cancelada, sem_retencao & iss_indevido, sem_retencao,
+         iss_declarado & np.isclose(iss_retido, iss_calculado, atol=0.01), iss_declarado,
+         com_retencao & (iss_retido_cod == 'Não') & iss_indevido, com_retencao],
+        ['Cancelado', 'Retenção Indevida', 'OK',
+         'OK (Conferir Alíquota)', 'Divergência (ISSQN)',
+         'Retenção Indevida (ISSQN)', 'Não Retido (OK)'],
+        'Não Aplicável',
+    )
+    retencao_indevida |= sem_retencao & iss_indevido
+
+    # Status geral: no cenário com retenção, só as divergências de IR/CSLL/PIS/COFINS tornam a nota inconsistente
+    status['Status Geral Retenções'] = np.select(
+        [cancelada, sem_retencao & retencao_indevida, sem_retencao, com_retencao & divergencia, com_retencao],
+        ['Cancelado', 'INCONSISTÊNCIA (Retenção Indevida)', 'OK', 'INCONSISTÊNCIA', 'OK'],
+        'Não Aplicável',
+    )
+    resultado.update(status)
+    return resultado
+
+def calcular_conferencia(base, regras=None):
+    """
+    Calcula, de forma vetorizada, os valores esperados e os status de retenção de todas as notas
+    da base (ver base_conferencia) com as regras informadas (padrão: REGRAS_PADRAO).
+    Retorna um DataFrame com as COLUNAS_CONFERENCIA, no mesmo índice da base.
+    """
+    resultado = _calcular_conferencia_arrays(
+        base['Cenário'].to_numpy(),
+        {col: base[col].to_numpy() for col in COLUNAS_BASE_CONFERENCIA},
+        base['ISS Retido (Cód)'].to_numpy(),
+        {**REGRAS_PADRAO, **(regras or {})},
+    )
+    for col in COLUNAS_CONFERENCIA:
+        if col in categorical_cols_fixed:
+            resultado[col] = pd.Categorical(resultado[col], categories=categorical_cols_fixed[col])
+    return pd.DataFrame(resultado, index=base.index)[COLUNAS_CONFERENCIA]
+
+def atualizar_conferencia(df_display, base, regras, format_currency=True):
+    """
+    Re-conferência: recalcula só os valores esperados e os status com outras regras (ex.: simulação
+    de alíquota), a partir da base numérica guardada, e atualiza essas colunas no DataFrame exibido.
+    O restante do DataFrame não é recalculado. Retorna o próprio df_display.
+    """
+    conferencia = calcular_conferencia(base, regras)
+    if format_currency:
+        format_currency_columns(conferencia)
+    for col in COLUNAS_CONFERENCIA:
+        df_display[col] = conferencia[col]
+    return df_display
+
+def remove_duplicate_notes(extracted_data):
+    """
+    Descarta, antes de qualquer soma, as notas repetidas no lote (mesma impressão digital em arquivos
+    diferentes), mantendo a primeira ocorrência. Uma cópia cancelada marca a nota mantida como cancelada.
+    Retorna (notas_unicas, notas_repetidas).
+    """
+    unicas, repetidas, posicoes = [], [], {}
+    for data in extracted_data:
+        impressao = nfse_fingerprint(data)
+        if impressao is None or impressao not in posicoes:
+            if impressao is not None:
+                posicoes[impressao] = len(unicas)
+            unicas.append(data)
+            continue
+        repetidas.append(data)
+        if data.get('IsCancelled') == 'Sim':
+            unicas[posicoes[impressao]] = {**unicas[posicoes[impressao]], 'IsCancelled': 'Sim'}
+    return unicas, repetidas
+
+# NOVO: Função para detectar problemas de sequência de NF
+# Linha 194
+# Colunas sem as quais a análise de sequência não é feita
+COLUNAS_SEQUENCIA = ['Número da NF', 'Prestador CNPJ', 'Competência', 'Status Cancelamento', 'Prestador Razão Social', 'ID NFSe']
+
+def colunas_ausentes_sequencia(df_input):
+    """Colunas de COLUNAS_SEQUENCIA que faltam no DataFrame (lista vazia: a análise de sequência pode ser feita)."""
+    return [col for col in COLUNAS_SEQUENCIA if col not in df_input.columns]
+
+def detect_sequence_issues(df_input):
+    """
+    Detecta números de NF duplicados e lacunas na sequência por prestador e competência.
+    Retorna um DataFrame com os problemas encontrados.
+    df_input deve conter as COLUNAS_SEQUENCIA; se faltar alguma, o resultado é vazio (a interface
+    avisa o usuário a partir de colunas_ausentes_sequencia).
+    O df_input não é alterado (não é preciso passar uma cópia).
+    """
+    if colunas_ausentes_sequencia(df_input):
+        # Retorna um DataFrame vazio com as colunas esperadas para evitar KeyErrors posteriores
+        return pd.DataFrame(columns=[
+            'Tipo de Problema', 'Prestador CNPJ', 'Prestador Razão Social', 
+            'Competência', 'Número da NF Afetado', 'Detalhes', 'ID NFSe'
+        ])
+
+    issues = []
+
+    # Certifica que o 'Número da NF' é numérico para ordenação e detecção de gaps
+    # Converte para string primeiro para lidar com valores como 'CANCELADA' antes de tentar para numérico
+    numeros_nf = pd.to_numeric(
+        df_input['Número da NF'].astype(str).str.replace('CANCELADA', '-1'), errors='coerce'
+    ).fillna(-1).astype(int)
+    
+    # Filtra para números válidos e maiores que zero (só as colunas usadas, sem copiar o DataFrame inteiro)
+    validos = numeros_nf > 0
+    df_filtered = df_input.loc[validos, ['Prestador CNPJ', 'Competência', 'Prestador Razão Social', 'ID NFSe']].assign(
+        **{'Número da NF_int': numeros_nf[validos]}
+    )
+
+    # NFs canceladas por (prestador, competência, número) -> IDs, na ordem do df_input: as lacunas são
+    # conferidas neste dicionário em vez de filtrar o df_input inteiro a cada número faltante
+    canceladas = validos & (df_input['Status Cancelamento'] == 'Sim')
+    ids_cancelados = {}
+    for chave_cancelada, id_nfse in zip(
+        zip(df_input.loc[canceladas, 'Prestador CNPJ'], df_input.loc[canceladas, 'Competência'], numeros_nf[canceladas]),
+        df_input.loc[canceladas, 'ID NFSe'],
+    ):
+        ids_cancelados.setdefault(chave_cancelada, []).append(id_nfse)
+
+    # Agrupa por Prestador e Competência (observed=True ignora categorias sem notas)
+    grouped = df_filtered.groupby(['Prestador CNPJ', 'Competência'], observed=True)
+
+    for (prestador_cnpj, competencia), group_df in grouped:
+        # Ordene as NFs para verificar a sequência
+        sorted_nfs = group_df.sort_values(by='Número da NF_int')
+        nf_numbers = sorted_nfs['Número da NF_int'].tolist()
+        
+        if not nf_numbers:
+            continue
+
+        # 1. Detectar Duplicatas
+        duplicated_numbers = sorted_nfs[sorted_nfs.duplicated(subset=['Número da NF_int'], keep=False)]
+        for _, row in duplicated_numbers.iterrows():
+            issues.append({
+                'Tipo de Problema': 'Número Duplicado',
+                'Prestador CNPJ': prestador_cnpj,
+                'Prestador Razão Social': row['Prestador Razão Social'],
+                'Competência': competencia,
+                'Número da NF Afetado': row['Número da NF_int'],
+                'Detalhes': f"A NF {row['Número da NF_int']} aparece mais de uma vez.",
+                'ID NFSe': row['ID NFSe']
+            })
+
+        # 2. Detectar Lacunas (Gaps) na sequência
+        # Pegar apenas os números únicos para verificar lacunas
+        unique_nf_numbers = sorted(list(set(nf_numbers)))
+        
+        if len(unique_nf_numbers) < 2:
+            continue # Não há sequência para verificar
+
+        for i in range(len(unique_nf_numbers) - 1):
+            current_nf = unique_nf_numbers[i]
+            next_nf = unique_nf_numbers[i+1]
+
+            if next_nf - current_nf > 1:
+                # Há um gap entre current_nf e next_nf
+                for missing_num in range(current_nf + 1, next_nf):
+                    # Verificar se o número "faltante" foi cancelado no DF original
+                    # É importante usar df_input aqui (ids_cancelados) para checar as canceladas também
+                    was_cancelled = ids_cancelados.get((prestador_cnpj, competencia, missing_num))
+                    
+                    if was_cancelled:
+                        details = f"A NF {missing_num} está ausente na sequência de NFs ativas, mas foi emitida e CANCELADA."
+                        problem_type = 'Número Faltante (Cancelado)'
+                        nf_id_details = was_cancelled[0] if not pd.isnull(was_cancelled).all() else 'N/A'
+                    else:
+                        details = f"A NF {missing_num} está ausente na sequência e não foi encontrada como emitida ou cancelada."
+                        problem_type = 'Número Faltante (Não Emitido)'
+                        nf_id_details = 'N/A'
+
+                    issues.append({
+                        'Tipo de Problema': problem_type,
+                        'Prestador CNPJ': prestador_cnpj,
+                        'Prestador Razão Social': group_df['Prestador Razão Social'].iloc[0], # Pega a razão social do primeiro da lista
+                        'Competência': competencia,
+                        'Número da NF Afetado': missing_num,
+                        'Detalhes': details,
+                        'ID NFSe': nf_id_details
+                    })
+    
+    if not issues:
+        return pd.DataFrame(columns=[
+            'Tipo de Problema', 'Prestador CNPJ', 'Prestador Razão Social', 
+            'Competência', 'Número da NF Afetado', 'Detalhes', 'ID NFSe'
+        ])
+    return pd.DataFrame(issues)
+
+
+# --- Função para converter e formatar o DataFrame ---
+# Colunas convertidas para float na formatação (nomes de exibição).
+# Note que 'Aliquota' não está aqui porque é uma porcentagem e é tratada separadamente no column_config.
+numeric_cols_original_keys_for_conversion = [
+    'ValorServicos', 'ValorDeducoes', 'ValorPis', 'ValorCofins', 'ValorInss',
+    'ValorIr', 'ValorCsll', 'ValorIss', 'ValorIssRetido', 'OutrasRetencoes',
+    'BaseCalculo', 'ValorLiquidoNfse', 'DescontoIncondicionado', 'DescontoCondicionado'
+]
+numeric_cols_display_for_conversion = [column_display_names[key] for key in numeric_cols_original_keys_for_conversion if key in column_display_names]
+
+def format_dataframe_for_display(df, format_currency=True, regras=None):
+    # format_currency=False mantém as colunas monetárias como float (uso fora da interface, ex.: nfse_api)
+    # regras: regras tributárias da conferência (padrão: REGRAS_PADRAO; ver regras_tributarias)
+    # Fazer uma cópia para evitar SettingWithCopyWarning
+    df_formatted = df.copy()
+
+    # 1. Renomear colunas (colunas existentes serão renomeadas antes de serem usadas nos cálculos)
+    # É importante que as chaves de column_display_names (nomes originais) sejam as mesmas do df.
+    df_formatted = df_formatted.rename(columns={k: v for k, v in column_display_names.items() if k in df_formatted.columns})
+
+    # 2. Converter tipos de dados e formatar (ver numeric_cols_display_for_conversion)
+    for col_disp_name in numeric_cols_display_for_conversion:
+        if col_disp_name in df_formatted.columns:
+            df_formatted[col_disp_name] = pd.to_numeric(df_formatted[col_disp_name], errors='coerce').fillna(0).astype(float)
+    
+    # Aliquota é numérica mas tratada como porcentagem na exibição, não precisa de R\$
+    if 'Alíquota' in df_formatted.columns:
+        df_formatted['Alíquota'] = pd.to_numeric(df_formatted['Alíquota'], errors='coerce').fillna(0).astype(float)
+
+
+    # Colunas que devem ser datas e cálculo da Competência
+    if 'Data Emissão' in df_formatted.columns:
+        df_formatted['Data Emissão'] = pd.to_datetime(df_formatted['Data Emissão'], errors='coerce')
+        if isinstance(df_formatted['Data Emissão'].dtype, pd.DatetimeTZDtype): # Corrigido: Linha 222 (DeprecationWarning)
+            df_formatted['Data Emissão'] = df_formatted['Data Emissão'].dt.tz_localize(None)
+        df_formatted['Competência'] = df_formatted['Data Emissão'].dt.strftime('%Y-%m')
+
+    # Mapear códigos para textos legíveis para 'Simples Nacional' e 'ISS Retido (Cód)'
+    if 'Simples Nacional' in df_formatted.columns:
+        df_formatted['Simples Nacional'] = df_formatted['Simples Nacional'].astype(str).replace({'1': 'Sim', '2': 'Não', '': np.nan}).fillna('Não Informado')
+    if 'ISS Retido (Cód)' in df_formatted.columns:
+        df_formatted['ISS Retido (Cód)'] = df_formatted['ISS Retido (Cód)'].astype(str).replace({'1': 'Sim', '2': 'Não', '': np.nan}).fillna('Não Informado')
+
+    # Adicionar Prestador Regime
+    if 'Simples Nacional' in df_formatted.columns:
+        df_formatted['Prestador Regime'] = df_formatted['Simples Nacional'].apply(
+            lambda x: 'Simples Nacional' if x == 'Sim' else 'Lucro Presumido' if x == 'Não' else 'Não Informado'
+        )
+
+    # Adicionar Tomador Tipo (Pessoa Física/Jurídica)
+    if 'Tomador CNPJ/CPF' in df_formatted.columns:
+        df_formatted['Tomador Tipo'] = df_formatted['Tomador CNPJ/CPF'].astype(str).str.replace(r'[^0-9]', '', regex=True).apply(
+            lambda x: 'Pessoa Física' if len(x) == 11 else 'Pessoa Jurídica' if len(x) == 14 else 'Não Identificado'
+        )
+    
+    # Garantir que 'Status Cancelamento' existe (deve vir do parser, mas como fallback)
+    if 'Status Cancelamento' not in df_formatted.columns:
+        df_formatted['Status Cancelamento'] = 'Não' # Default para 'Não' se não vier do parser
+
+    # --- 3. Calcular Retenções Esperadas e Status de Conferência (vetorizado, ver calcular_conferencia) ---
+    conferencia = calcular_conferencia(base_conferencia(df_formatted), regras)
+    for col in COLUNAS_CONFERENCIA:
+        df_formatted[col] = conferencia[col]
+
+    # Converte as colunas de texto repetitivo para categóricas (ver categorical_cols_fixed)
+    for col, categorias in categorical_cols_fixed.items():
+        if col in df_formatted.columns:
+            df_formatted[col] = pd.Categorical(df_formatted[col], categories=categorias)
+    for col in categorical_cols_from_data:
+        if col in df_formatted.columns:
+            df_formatted[col] = df_formatted[col].astype('category')
+
+    if format_currency:
+        format_currency_columns(df_formatted)
+
+    return df_formatted
+
+
+# --- Conferência de uma nota só (sem DataFrame) ---
+def _numero(valor):
+    """Equivalente escalar de pd.to_numeric(errors='coerce').fillna(0).astype(float)."""
+    try:
+        numero = float(valor)
+    except (TypeError, ValueError):
+        return 0.0
+    return 0.0 if np.isnan(numero) else numero
+
+def _sim_nao(valor):
+    """Equivalente escalar do mapeamento de códigos 1/2 para 'Sim'/'Não' de format_dataframe_for_display."""
+    texto = str(valor)
+    return {'1': 'Sim', '2': 'Não'}.get(texto, texto or 'Não Informado')
+
+def conferir_registro(registro, regras=None):
+    """
+    Formata e confere uma nota só (um registro de extract_nfse_data), sem montar DataFrame: para uma
+    nota, o custo fixo do pandas em format_dataframe_for_display é dezenas de vezes o da conferência.
+    Retorna um dicionário com as mesmas colunas, na mesma ordem e com os mesmos valores da linha de
+    format_dataframe_for_display(pd.DataFrame([registro]), format_currency=False, regras=regras).
+    """
+    nota = {column_display_names.get(chave, chave): valor for chave, valor in registro.items()}
+    for col in numeric_cols_display_for_conversion + ['Alíquota']:
+        if col in nota:
+            nota[col] = _numero(nota[col])
+
+    if 'Data Emissão' in nota:
+        data_emissao = pd.to_datetime(nota['Data Emissão'], errors='coerce')
+        if data_emissao is not pd.NaT and data_emissao.tzinfo is not None:
+            data_emissao = data_emissao.tz_localize(None)
+        nota['Data Emissão'] = data_emissao
+        nota['Competência'] = None if data_emissao is pd.NaT else data_emissao.strftime('%Y-%m')
+
+    if 'Simples Nacional' in nota:
+        nota['Simples Nacional'] = _sim_nao(nota['Simples Nacional'])
+    if 'ISS Retido (Cód)' in nota:
+        nota['ISS Retido (Cód)'] = _sim_nao(nota['ISS Retido (Cód)'])
+    if 'Simples Nacional' in nota:
+        nota['Prestador Regime'] = {'Sim': 'Simples Nacional', 'Não': 'Lucro Presumido'}.get(nota['Simples Nacional'], 'Não Informado')
+    if 'Tomador CNPJ/CPF' in nota:
+        digitos = re.sub(r'[^0-9]', '', str(nota['Tomador CNPJ/CPF']))
+        nota['Tomador Tipo'] = {11: 'Pessoa Física', 14: 'Pessoa Jurídica'}.get(len(digitos), 'Não Identificado')
+    nota.setdefault('Status Cancelamento', 'Não')
+
+    # Mesmo núcleo da conferência vetorizada, com arrays de um elemento
+    cenario = _cenarios(
+        np.array([str(nota['Status Cancelamento']) == 'Sim']),
+        np.array([str(nota['Prestador Regime'])], dtype=object),
+        np.array([str(nota['Tomador Tipo'])], dtype=object),
+    )
+    conferencia = _calcular_conferencia_arrays(
+        cenario,
+        {col: np.array([_numero(nota[col])]) for col in COLUNAS_BASE_CONFERENCIA},
+        np.array([str(nota['ISS Retido (Cód)'])], dtype=object),
+        {**REGRAS_PADRAO, **(regras or {})},
+    )
+    for col in COLUNAS_CONFERENCIA:
+        nota[col] = conferencia[col][0].item()
+
+    # Valores fora das categorias fixas viram nulos, como em pd.Categorical
+    for col, categorias in categorical_cols_fixed.items():
+        if col in nota and nota[col] not in categorias:
+            nota[col] = None
+    return nota
+
+
+# --- Formatação das colunas monetárias (float -> "R$ X.XXX,XX") ---
+def format_currency_columns(df):
+    """Formata para exibição as colunas monetárias numéricas do DataFrame (alterado no lugar). Retorna o df."""
+    for col in currency_cols_for_display:
+        # Se a coluna já não for numérica (e.g., 'CANCELADA'), mantém como está
+        if col in df.columns and pd.api.types.is_numeric_dtype(df[col]):
+            # Formata cada valor distinto uma vez só (zeros e valores repetidos são comuns); NaN vira None
+            codigos, valores = pd.factorize(df[col])
+            # Formatação para R$ X.XXX,XX (ponto para milhar, vírgula para decimal)
+            textos = [f"R$ {x:_.2f}".replace('.', '#').replace('_', '.').replace('#', ',') for x in valores.tolist()]
+            df[col] = pd.Series(np.array(textos + [None], dtype=object)[codigos], index=df.index)
+    return df
+
+
+# --- Índice de Competências ---
+def indexar_competencias(df_formatted):
+    """
+    Ordena as notas por competência e, dentro dela, as ativas antes das canceladas (ordenação estável:
+    a ordem original é mantida em cada trecho). Retorna (df_ordenado, faixas), com
+    faixas = {competência: (início, fim_ativas, fim)} em posições de linha. Cada competência (e as
+    suas notas ativas) fica em um trecho contíguo, que filter_by_competence devolve como visão
+    (df.iloc[início:fim]), sem cópia. Notas sem competência ficam no fim, fora das faixas.
+    """
+    competencias = df_formatted['Competência'].astype(object)
+    codigos, valores = pd.factorize(competencias, sort=True)  # NaN -> -1
+    codigos = np.where(codigos < 0, len(valores), codigos)
+    cancelada = (df_formatted['Status Cancelamento'] != 'Não').to_numpy()
+    ordem = np.lexsort((cancelada, codigos))  # lexsort é estável; a última chave é a principal
+    if not (ordem == np.arange(len(ordem))).all():
+        df_formatted = df_formatted.take(ordem)
+        codigos, cancelada = codigos[ordem], cancelada[ordem]
+
+    inicios = np.searchsorted(codigos, np.arange(len(valores)), side='left')
+    fins = np.searchsorted(codigos, np.arange(len(valores)), side='right')
+    faixas = {
+        str(competencia): (int(inicio), int(inicio + np.count_nonzero(~cancelada[inicio:fim])), int(fim))
+        for competencia, inicio, fim in zip(valores, inicios, fins)
+    }
+    return df_formatted, faixas
+
+
+# --- Filtro de Competência ---
+def filter_by_competence(df_full, competence, faixas=None):
+    """
+    Retorna as notas da competência informada (todas) e apenas as notas ativas (não canceladas).
+    Com as faixas de indexar_competencias (df_full ordenado por ela), as duas são visões do df_full,
+    sem cópia; sem faixas, são filtradas por máscara. Não altere os resultados no lugar.
+    """
+    if faixas is not None:
+        inicio, fim_ativas, fim = faixas.get(str(competence), (0, 0, 0))
+        return df_full.iloc[inicio:fim], df_full.iloc[inicio:fim_ativas]
+    df_competence = df_full[df_full['Competência'] == competence]
+    df_active_notes = df_competence[df_competence['Status Cancelamento'] == 'Não']
+    return df_competence, df_active_notes
+
+
+# --- Desformatação das colunas monetárias ("R$ X.XXX,XX" -> float) ---
+def unformat_currency_columns(df, fill_zero=False):
+    """
+    Converte as colunas monetárias pré-formatadas para exibição de volta em float.
+    Com fill_zero=True, valores inválidos viram 0.0 (usado nos somatórios do painel).
+    As demais colunas não são copiadas (cópia rasa): só as monetárias são substituídas.
+    """
+    df_numeric = df.copy(deep=False)
+    for col in currency_cols_for_display:
+        if col in df_numeric.columns:
+            # Remove "R\$", pontos de milhar, e troca vírgula por ponto decimal
+            df_numeric[col] = df_numeric[col].astype(str).str.replace('R$', '', regex=False).str.replace('.', '', regex=False).str.replace(',', '.', regex=False)
+            df_numeric[col] = pd.to_numeric(df_numeric[col], errors='coerce')
+            if fill_zero:
+                df_numeric[col] = df_numeric[col].fillna(0).astype(float)
+    return df_numeric
+
+
+# --- Painel de Faturamento e Impostos ---
+# Colunas somadas no painel (só elas são desformatadas)
+COLUNAS_PAINEL = ['Valor dos Serviços', 'IR', 'CSLL', 'PIS', 'COFINS', 'Valor ISS Retido', 'Base de Cálculo', 'Valor Líquido NFSe']
+
+def compute_tax_panel(df_active_notes, lucro_presumido_tipo="Normal", regras=None):
+    """
+    Soma faturamento e retenções das notas ativas e estima os impostos a pagar
+    no Lucro Presumido ("Normal" ou "Equiparação Hospitalar"), com as alíquotas das regras
+    informadas (padrão: REGRAS_PADRAO).
+    Retorna um dicionário com os totais usados no painel do viewer.
+    """
+    painel = {
+        'total_faturamento': 0.0,
+        'total_ir_retido': 0.0,
+        'total_csll_retido': 0.0,
+        'total_pis_retido': 0.0,
+        'total_cofins_retido': 0.0,
+        'total_iss_retido': 0.0,
+        'base_calculo_issqn': 0.0,
+        'total_liquido_recebido': 0.0,
+    }
+
+    if not df_active_notes.empty:
+        # Desformata temporariamente para fazer os cálculos, pois os valores estão em string "R\$ X.XXX,XX"
+        temp_df = unformat_currency_columns(df_active_notes[COLUNAS_PAINEL], fill_zero=True)
+
+        painel['total_faturamento'] = temp_df['Valor dos Serviços'].sum()
+        painel['total_ir_retido'] = temp_df['IR'].sum()
+        painel['total_csll_retido'] = temp_df['CSLL'].sum()
+        painel['total_pis_retido'] = temp_df['PIS'].sum()
+        painel['total_cofins_retido'] = temp_df['COFINS'].sum()
+        painel['total_iss_retido'] = temp_df['Valor ISS Retido'].sum()
+        painel['base_calculo_issqn'] = temp_df['Base de Cálculo'].sum()
+        painel['total_liquido_recebido'] = temp_df['Valor Líquido NFSe'].sum()
+
+    regras = {**REGRAS_PADRAO, **(regras or {})}
+    total_faturamento = painel['total_faturamento']
+    irpj_a_pagar = csll_a_pagar = pis_a_pagar = cofins_a_pagar = issqn_a_pagar = 0.0
+
+    if lucro_presumido_tipo == "Normal":
+        # IRPJ: Faturamento * 4.8%; CSLL: 2.88%; PIS: 0.65%; COFINS: 3% (menos os valores retidos)
+        irpj_a_pagar = (total_faturamento * regras['aliquota_irpj_presumido']) - painel['total_ir_retido']
+        csll_a_pagar = (total_faturamento * regras['aliquota_csll_presumido']) - painel['total_csll_retido']
+        pis_a_pagar = (total_faturamento * regras['aliquota_pis_presumido']) - painel['total_pis_retido']
+        cofins_a_pagar = (total_faturamento * regras['aliquota_cofins_presumido']) - painel['total_cofins_retido']
+        # ISSQN: Base de Cálculo * Alíquota de Referência - ISS Retido
+        issqn_a_pagar = (painel['base_calculo_issqn'] * regras['aliquota_issqn_referencia']) - painel['total_iss_retido']
+    elif lucro_presumido_tipo == "Equiparação Hospitalar":
+        irpj_a_pagar = (total_faturamento * regras['aliquota_irpj_eq_hosp']) - painel['total_ir_retido']
+        csll_a_pagar = (total_faturamento * regras['aliquota_csll_eq_hosp']) - painel['total_csll_retido']
+        pis_a_pagar = (total_faturamento * regras['aliquota_pis_eq_hosp']) - painel['total_pis_retido']
+        cofins_a_pagar = (total_faturamento * regras['aliquota_cofins_eq_hosp']) - painel['total_cofins_retido']
+        # ISSQN: Faturamento * 2.01% - ISS Retido (com base no faturamento)
+        issqn_a_pagar = (total_faturamento * regras['aliquota_issqn_eq_hosp']) - painel['total_iss_retido']
+
+    # Garante que os valores a pagar não são negativos (imposto já retido a maior)
+    painel['irpj_a_pagar'] = max(0, irpj_a_pagar)
+    painel['csll_a_pagar'] = max(0, csll_a_pagar)
+    painel['pis_a_pagar'] = max(0, pis_a_pagar)
+    painel['cofins_a_pagar'] = max(0, cofins_a_pagar)
+    painel['issqn_a_pagar'] = max(0, issqn_a_pagar)
+    painel['total_impostos_a_pagar'] = (painel['irpj_a_pagar'] + painel['csll_a_pagar'] + painel['pis_a_pagar']
+                                        + painel['cofins_a_pagar'] + painel['issqn_a_pagar'])
+    return painel
+
+
+# --- Exportações ---
+def build_csv_export(df_to_export):
+    """Gera o CSV (bytes UTF-8) da tabela exibida, com as colunas monetárias desformatadas."""
+    return unformat_currency_columns(df_to_export).to_csv(index=False).encode('utf-8')
+
+def build_excel_export(df_to_export, sheet_name):
+    """Gera o Excel (BytesIO posicionado no início) da tabela exibida, com as colunas monetárias desformatadas."""
+    excel_buffer = io.BytesIO()
+    with pd.ExcelWriter(excel_buffer, engine='xlsxwriter') as writer:
+        unformat_currency_columns(df_to_export).to_excel(writer, index=False, sheet_name=sheet_name)
+    excel_buffer.seek(0) # Volta para o início do buffer
+    return excel_buffer
@@ -0,0 +1,1296 @@
+# nfse_db.py - Modelos e acesso ao banco de dados SQLite das NFS-e
+#
+# A tabela "nfses" guarda o XML original enviado pelo usuário. A tabela "nfse_campos" guarda os
+# campos extraídos por extract_nfse_data (uma linha por NFS-e), já tipados e indexados, para que
+# filtros por CNPJ, competência e número e a análise de sequência sejam feitos direto em SQL,
+# sem reprocessar os XMLs.
+#
+# As tabelas "numeracao_*" formam o índice de numeração por prestador (maior número emitido, números
+# emitidos e cancelados e lacunas em aberto), atualizado a cada inserção: a análise de sequência
+# considera todos os envios e competências sem recalcular nada a partir do zero.
+#
+# Particionamento por ano: NFS-e de anos já fechados podem ser movidas para arquivos SQLite próprios
+# (particoes/nfse_<ano>.db), somente leitura, anexados com ATTACH apenas quando consultados. O banco
+# principal fica com o ano corrente e o índice de numeração (que continua cobrindo todos os anos).
+#
+# O XML é gravado comprimido (zlib) e identificado pelo SHA-256 do conteúdo original: o índice
+# único em nfses.xml_hash impede que o mesmo arquivo seja armazenado duas vezes. A mesma nota em
+# arquivos diferentes (reexportação do portal, lotes sobrepostos) é reconhecida pelo hash do XML
+# canônico (C14N) e pela impressão digital da nota (nfse_fingerprint), ambos indexados e
+# verificados na inserção.
+#
+# Acesso concorrente: o engine é criado uma única vez por processo (get_engine) com o SQLite em
+# modo WAL, e cada operação usa uma sessão própria e curta (session_scope), nunca uma sessão global
+# compartilhada entre usuários e reruns do Streamlit.
+
+import os
+
+import io
+import re
+import zlib
+import zipfile
+import hashlib
+import xml.etree.ElementTree as ET
+import pathlib
+import datetime
+import functools
+from contextlib import contextmanager
+from sqlalchemy import (
+    create_engine, event, func, case, select, text, bindparam, inspect, insert, Column, Integer, String, Text, Float, Boolean, LargeBinary,
+    ForeignKey, Index
+)
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker, relationship
+
+from nfse_parser import extract_nfse_data, nfse_fingerprint
+
+# ====== CONFIGURAÇÕES INICIAIS ======
+db_path = os.environ.get("NFSE_DB_PATH", "database.db")
+NIVEL_COMPRESSAO_XML = 9  # zlib: os XMLs de NFS-e são repetitivos e comprimem em torno de 10:1
+TIMEOUT_BLOQUEIO_SEGUNDOS = 30  # Tempo de espera por um lock de escrita antes de "database is locked"
+DIRETORIO_PARTICOES = os.environ.get(
+    "NFSE_PARTICOES_DIR", os.path.join(os.path.dirname(os.path.abspath(db_path)), "particoes")
+)
+
+# PRAGMAs aplicados a cada nova conexão SQLite
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",  # Leitores não bloqueiam o escritor (e vice-versa)
+    "synchronous": "NORMAL",  # Seguro em WAL e bem mais rápido que FULL
+    "busy_timeout": TIMEOUT_BLOQUEIO_SEGUNDOS * 1000,
+    "cache_size": -64000,  # ~64 MB de cache de páginas por conexão
+    "temp_store": "MEMORY",
+    "mmap_size": 268435456,  # 256 MB lidos via mmap
+}
+
+
+def _aplicar_pragmas(dbapi_connection, connection_record):
+    """Listener de 'connect': configura WAL e demais PRAGMAs em cada conexão nova."""
+    cursor = dbapi_connection.cursor()
+    for pragma, valor in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {pragma}={valor}")
+    cursor.close()
+
+
+@functools.lru_cache(maxsize=None)
+def get_engine(caminho=None):
+    """Engine SQLite (com pool de conexões) criado uma única vez por caminho de banco e reaproveitado por todo o processo."""
+    novo_engine = create_engine(
+        f"sqlite:///{caminho or db_path}",
+        # uri=True permite anexar partições com "file:...?mode=ro" (somente leitura)
+        connect_args={"timeout": TIMEOUT_BLOQUEIO_SEGUNDOS, "check_same_thread": False, "uri": True},
+    )
+    event.listen(novo_engine, "connect", _aplicar_pragmas)
+    return novo_engine
+
+
+engine = get_engine()
+Base = declarative_base()
+
+
+# Modelo/Table: NFSe (XML original, comprimido e endereçado pelo hash do conteúdo)
+class NFSe(Base):
+    __tablename__ = "nfses"
+    id = Column(Integer, primary_key=True)
+    cliente = Column(String(255), nullable=False)
+    data_envio = Column(String(50), nullable=False)
+    xml_hash = Column(String(64), nullable=False)  # SHA-256 (hex) do XML original em UTF-8
+    xml_comprimido = Column(LargeBinary, nullable=False)  # XML comprimido com zlib
+    xml_hash_canonico = Column(String(64))  # SHA-256 do XML canônico (C14N, sem espaços entre tags)
+
+    campos = relationship("NFSeCampos", back_populates="nfse", uselist=False, cascade="all, delete-orphan")
+
+    __table_args__ = (
+        Index("ix_nfses_xml_hash", "xml_hash", unique=True),
+        Index("ix_nfses_xml_hash_canonico", "xml_hash_canonico"),
+    )
+
+    @property
+    def arquivo_xml(self):
+        """Conteúdo XML original (texto), descomprimido sob demanda."""
+        return descomprimir_xml(self.xml_comprimido)
+
+
+# Modelo/Table: NFSeCampos (campos de _DEFAULT_NFSE_DATA extraídos no momento da inserção)
+class NFSeCampos(Base):
+    __tablename__ = "nfse_campos"
+    id = Column(Integer, primary_key=True)
+    nfse_id = Column(Integer, ForeignKey("nfses.id", ondelete="CASCADE"), nullable=False, unique=True)
+
+    # NFSe Geral
+    nfse_id_xml = Column(String(100))  # Atributo Id de InfNfse
+    numero = Column(Integer)
+    codigo_verificacao = Column(String(100))
+    data_emissao = Column(String(30))  # ISO 8601, como vem no XML
+    competencia = Column(String(7))  # YYYY-MM, derivada da data de emissão
+    natureza_operacao = Column(String(10))
+    regime_especial_tributacao = Column(String(10))
+    optante_simples_nacional = Column(String(10))
+    incentivador_cultural = Column(String(10))
+
+    # Serviço
+    descricao_servico = Column(Text)
+    item_lista_servico = Column(String(20))
+    codigo_tributacao_municipio = Column(String(50))
+    codigo_municipio_servico = Column(String(20))
+
+    # Valores do Serviço
+    valor_servicos = Column(Float)
+    valor_deducoes = Column(Float)
+    valor_pis = Column(Float)
+    valor_cofins = Column(Float)
+    valor_inss = Column(Float)
+    valor_ir = Column(Float)
+    valor_csll = Column(Float)
+    iss_retido = Column(String(10))  # Código: 1=Sim, 2=Não
+    valor_iss = Column(Float)
+    valor_iss_retido = Column(Float)
+    outras_retencoes = Column(Float)
+    base_calculo = Column(Float)
+    aliquota = Column(Float)
+    valor_liquido_nfse = Column(Float)
+    desconto_incondicionado = Column(Float)
+    desconto_condicionado = Column(Float)
+
+    # Prestador
+    prestador_cpf_cnpj = Column(String(14))
+    prestador_inscricao_municipal = Column(String(50))
+    prestador_razao_social = Column(String(255))
+    prestador_endereco_logradouro = Column(String(255))
+    prestador_endereco_numero = Column(String(20))
+    prestador_endereco_complemento = Column(String(255))
+    prestador_endereco_bairro = Column(String(100))
+    prestador_endereco_codigo_municipio = Column(String(20))
+    prestador_endereco_uf = Column(String(2))
+    prestador_endereco_cep = Column(String(10))
+    prestador_contato_telefone = Column(String(30))
+    prestador_contato_email = Column(String(255))
+
+    # Tomador
+    tomador_cpf_cnpj = Column(String(14))
+    tomador_razao_social = Column(String(255))
+    tomador_endereco_logradouro = Column(String(255))
+    tomador_endereco_numero = Column(String(20))
+    tomador_endereco_bairro = Column(String(100))
+    tomador_endereco_codigo_municipio = Column(String(20))
+    tomador_endereco_uf = Column(String(2))
+    tomador_endereco_cep = Column(String(10))
+    tomador_contato_telefone = Column(String(30))
+
+    # Órgão Gerador
+    orgao_gerador_codigo_municipio = Column(String(20))
+    orgao_gerador_uf = Column(String(2))
+
+    cancelada = Column(Boolean, nullable=False, default=False)
+    impressao_digital = Column(String(160))  # nfse_fingerprint: identifica a nota em XMLs diferentes
+
+    nfse = relationship("NFSe", back_populates="campos")
+
+    __table_args__ = (
+        Index("ix_nfse_campos_prestador_competencia_numero", "prestador_cpf_cnpj", "competencia", "numero"),
+        Index("ix_nfse_campos_tomador", "tomador_cpf_cnpj"),
+        Index("ix_nfse_campos_competencia", "competencia"),
+        Index("ix_nfse_campos_numero", "numero"),
+        Index("ix_nfse_campos_impressao_digital", "impressao_digital"),
+    )
+
+
+class NumeracaoPrestador(Base):
+    """Faixa de numeração conhecida de um prestador (menor e maior número de NF já armazenados)."""
+    __tablename__ = "numeracao_prestador"
+
+    prestador_cpf_cnpj = Column(String(14), primary_key=True)
+    menor_numero = Column(Integer, nullable=False)
+    maior_numero = Column(Integer, nullable=False)  # "High-water mark" da numeração
+    atualizado_em = Column(String(20))
+
+
+class NumeroEmitido(Base):
+    """Número de NF já armazenado para o prestador; ocorrencias > 1 indica número repetido."""
+    __tablename__ = "numeracao_emitidos"
+
+    prestador_cpf_cnpj = Column(String(14), primary_key=True)
+    numero = Column(Integer, primary_key=True)
+    ocorrencias = Column(Integer, nullable=False, default=1)
+    cancelada = Column(Boolean, nullable=False, default=False)
+
+
+class LacunaNumeracao(Base):
+    """Faixa de números (inicio a fim, inclusive) ainda não recebida entre o menor e o maior número do prestador."""
+    __tablename__ = "numeracao_lacunas"
+
+    id = Column(Integer, primary_key=True)
+    prestador_cpf_cnpj = Column(String(14), nullable=False)
+    inicio = Column(Integer, nullable=False)
+    fim = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        Index("ix_numeracao_lacunas_prestador_inicio", "prestador_cpf_cnpj", "inicio"),
+    )
+
+
+# Mapeamento: chave de _DEFAULT_NFSE_DATA -> coluna de NFSeCampos
+CAMPOS_NFSE = {
+    'Nfse.Id': 'nfse_id_xml',
+    'Numero': 'numero',
+    'CodigoVerificacao': 'codigo_verificacao',
+    'DataEmissao': 'data_emissao',
+    'NaturezaOperacao': 'natureza_operacao',
+    'RegimeEspecialTributacao': 'regime_especial_tributacao',
+    'OptanteSimplesNacional': 'optante_simples_nacional',
+    'IncentivadorCultural': 'incentivador_cultural',
+    'DescricaoServico': 'descricao_servico',
+    'ItemListaServico': 'item_lista_servico',
+    'CodigoTributacaoMunicipio': 'codigo_tributacao_municipio',
+    'CodigoMunicipioServico': 'codigo_municipio_servico',
+    'ValorServicos': 'valor_servicos',
+    'ValorDeducoes': 'valor_deducoes',
+    'ValorPis': 'valor_pis',
+    'ValorCofins': 'valor_cofins',
+    'ValorInss': 'valor_inss',
+    'ValorIr': 'valor_ir',
+    'ValorCsll': 'valor_csll',
+    'IssRetido': 'iss_retido',
+    'ValorIss': 'valor_iss',
+    'ValorIssRetido': 'valor_iss_retido',
+    'OutrasRetencoes': 'outras_retencoes',
+    'BaseCalculo': 'base_calculo',
+    'Aliquota': 'aliquota',
+    'ValorLiquidoNfse': 'valor_liquido_nfse',
+    'DescontoIncondicionado': 'desconto_incondicionado',
+    'DescontoCondicionado': 'desconto_condicionado',
+    'Prestador.CpfCnpj': 'prestador_cpf_cnpj',
+    'Prestador.InscricaoMunicipal': 'prestador_inscricao_municipal',
+    'Prestador.RazaoSocial': 'prestador_razao_social',
+    'Prestador.Endereco.Logradouro': 'prestador_endereco_logradouro',
+    'Prestador.Endereco.Numero': 'prestador_endereco_numero',
+    'Prestador.Endereco.Complemento': 'prestador_endereco_complemento',
+    'Prestador.Endereco.Bairro': 'prestador_endereco_bairro',
+    'Prestador.Endereco.CodigoMunicipio': 'prestador_endereco_codigo_municipio',
+    'Prestador.Endereco.Uf': 'prestador_endereco_uf',
+    'Prestador.Endereco.Cep': 'prestador_endereco_cep',
+    'Prestador.Contato.Telefone': 'prestador_contato_telefone',
+    'Prestador.Contato.Email': 'prestador_contato_email',
+    'TomadorServico.CpfCnpj': 'tomador_cpf_cnpj',
+    'TomadorServico.RazaoSocial': 'tomador_razao_social',
+    'TomadorServico.Endereco.Logradouro': 'tomador_endereco_logradouro',
+    'TomadorServico.Endereco.Numero': 'tomador_endereco_numero',
+    'TomadorServico.Endereco.Bairro': 'tomador_endereco_bairro',
+    'TomadorServico.Endereco.CodigoMunicipio': 'tomador_endereco_codigo_municipio',
+    'TomadorServico.Endereco.Uf': 'tomador_endereco_uf',
+    'TomadorServico.Endereco.Cep': 'tomador_endereco_cep',
+    'TomadorServico.Contato.Telefone': 'tomador_contato_telefone',
+    'OrgaoGerador.CodigoMunicipio': 'orgao_gerador_codigo_municipio',
+    'OrgaoGerador.Uf': 'orgao_gerador_uf',
+}
+
+def dados_extraidos_from_campos(campos):
+    """Converte uma linha de NFSeCampos de volta ao dicionário no formato de extract_nfse_data."""
+    data = {chave: getattr(campos, coluna) for chave, coluna in CAMPOS_NFSE.items()}
+    # O parser devolve o número como texto; mantém o mesmo formato para o viewer
+    if data.get('Numero') is not None:
+        data['Numero'] = str(data['Numero'])
+    data['IsCancelled'] = 'Sim' if campos.cancelada else 'Não'
+    return data
+
+
+# ====== COMPRESSÃO DO XML ======
+def hash_xml(xml_content):
+    """SHA-256 (hex) do XML em UTF-8: a chave de deduplicação do armazenamento."""
+    return hashlib.sha256(xml_content.encode("utf-8")).hexdigest()
+
+def hash_xml_canonico(xml_content):
+    """
+    SHA-256 (hex) da forma canônica do XML (C14N 2.0, sem espaços entre tags): iguala arquivos
+    da mesma nota que só diferem na formatação, na ordem dos atributos ou na declaração XML.
+    Retorna None se o XML não puder ser lido.
+    """
+    try:
+        canonico = ET.canonicalize(xml_data=re.sub(r'^\s*<\?xml[^>]*\?>', '', xml_content), strip_text=True)
+    except ET.ParseError:
+        return None
+    return hashlib.sha256(canonico.encode("utf-8")).hexdigest()
+
+def comprimir_xml(xml_content):
+    """Comprime o XML (texto) para gravação em nfses.xml_comprimido."""
+    return zlib.compress(xml_content.encode("utf-8"), NIVEL_COMPRESSAO_XML)
+
+def descomprimir_xml(xml_comprimido):
+    """Devolve o texto do XML gravado em nfses.xml_comprimido."""
+    return zlib.decompress(xml_comprimido).decode("utf-8")
+
+
+# ====== MIGRAÇÃO: arquivo_xml (texto) -> xml_hash + xml_comprimido ======
+def migrar_xml_comprimido(engine, lote=500):
+    """
+    Converte bancos antigos, em que nfses.arquivo_xml guardava o XML como texto puro.
+    Como o SQLite não altera restrições de colunas, a tabela é recriada (nfses_nova -> nfses)
+    preservando os ids. XMLs repetidos mantêm apenas o primeiro registro; os campos extraídos
+    dos demais são removidos. Ao final, o VACUUM devolve ao disco o espaço liberado.
+    Retorna a quantidade de registros duplicados descartados (None se não havia o que migrar).
+    """
+    inspetor = inspect(engine)
+    if "nfses" not in inspetor.get_table_names():
+        return None
+    if "arquivo_xml" not in [coluna["name"] for coluna in inspetor.get_columns("nfses")]:
+        return None
+
+    descartados = 0
+    with engine.begin() as conn:
+        conn.execute(text("""
+            CREATE TABLE nfses_nova (
+                id INTEGER NOT NULL PRIMARY KEY,
+                cliente VARCHAR(255) NOT NULL,
+                data_envio VARCHAR(50) NOT NULL,
+                xml_hash VARCHAR(64) NOT NULL,
+                xml_comprimido BLOB NOT NULL,
+                xml_hash_canonico VARCHAR(64)
+            )
+        """))
+        hashes_vistos = set()
+        ultimo_id = 0
+        while True:
+            linhas = conn.execute(
+                text("SELECT id, cliente, data_envio, arquivo_xml FROM nfses WHERE id > :ultimo ORDER BY id LIMIT :lote"),
+                {"ultimo": ultimo_id, "lote": lote},
+            ).fetchall()
+            if not linhas:
+                break
+            novas, duplicadas = [], []
+            for registro_id, cliente, data_envio, xml_content in linhas:
+                xml_hash = hash_xml(xml_content)
+                if xml_hash in hashes_vistos:
+                    duplicadas.append({"id": registro_id})
+                    continue
+                hashes_vistos.add(xml_hash)
+                novas.append({"id": registro_id, "cliente": cliente, "data_envio": data_envio,
+                              "xml_hash": xml_hash, "xml_comprimido": comprimir_xml(xml_content)})
+            if novas:
+                conn.execute(text(
+                    "INSERT INTO nfses_nova (id, cliente, data_envio, xml_hash, xml_comprimido) "
+                    "VALUES (:id, :cliente, :data_envio, :xml_hash, :xml_comprimido)"
+                ), novas)
+            if duplicadas and "nfse_campos" in inspetor.get_table_names():
+                conn.execute(text("DELETE FROM nfse_campos WHERE nfse_id = :id"), duplicadas)
+            descartados += len(duplicadas)
+            ultimo_id = linhas[-1][0]
+        conn.execute(text("DROP TABLE nfses"))
+        conn.execute(text("ALTER TABLE nfses_nova RENAME TO nfses"))
+        for indice in NFSe.__table__.indexes:
+            indice.create(conn)
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("VACUUM"))
+    return descartados
+
+
+# ====== MIGRAÇÃO: hash canônico e impressão digital da nota ======
+COLUNAS_IMPRESSAO_DIGITAL = [(NFSe.__table__, "xml_hash_canonico"), (NFSeCampos.__table__, "impressao_digital")]
+
+def adicionar_colunas_impressao_digital(conn, esquema="main"):
+    """Acrescenta (ALTER TABLE) as colunas xml_hash_canonico e impressao_digital, e seus índices, se faltarem."""
+    adicionadas = False
+    for tabela, coluna in COLUNAS_IMPRESSAO_DIGITAL:
+        existentes = [linha[1] for linha in conn.execute(text(f"PRAGMA {esquema}.table_info({tabela.name})"))]
+        if existentes and coluna not in existentes:
+            tipo = tabela.c[coluna].type.compile(dialect=conn.dialect)
+            conn.execute(text(f"ALTER TABLE {esquema}.{tabela.name} ADD COLUMN {coluna} {tipo}"))
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS {esquema}.ix_{tabela.name}_{coluna} ON {tabela.name} ({coluna})"))
+            adicionadas = True
+    return adicionadas
+
+def migrar_impressao_digital(engine, lote=500):
+    """
+    Prepara bancos anteriores à detecção de notas repetidas: cria as colunas e preenche, em lotes,
+    a impressão digital (a partir dos campos já extraídos) e o hash canônico (a partir do XML).
+    Retorna a quantidade de registros preenchidos.
+    """
+    with engine.begin() as conn:
+        adicionar_colunas_impressao_digital(conn)
+
+    preenchidos = 0
+    with engine.begin() as conn:
+        ultimo_id = 0
+        while True:
+            linhas = conn.execute(
+                select(NFSeCampos.__table__).where(NFSeCampos.id > ultimo_id, NFSeCampos.impressao_digital.is_(None))
+                .order_by(NFSeCampos.id).limit(lote)
+            ).fetchall()
+            if not linhas:
+                break
+            conn.execute(
+                NFSeCampos.__table__.update().where(NFSeCampos.id == bindparam("campos_id")),
+                [{"campos_id": linha.id, "impressao_digital": nfse_fingerprint(dados_extraidos_from_campos(linha))}
+                 for linha in linhas],
+            )
+            ultimo_id = linhas[-1].id
+        ultimo_id = 0
+        while True:
+            linhas = conn.execute(
+                select(NFSe.id, NFSe.xml_comprimido).where(NFSe.id > ultimo_id, NFSe.xml_hash_canonico.is_(None))
+                .order_by(NFSe.id).limit(lote)
+            ).fetchall()
+            if not linhas:
+                break
+            conn.execute(
+                NFSe.__table__.update().where(NFSe.id == bindparam("registro_id")),
+                [{"registro_id": registro_id, "xml_hash_canonico": hash_xml_canonico(descomprimir_xml(xml_comprimido))}
+                 for registro_id, xml_comprimido in linhas],
+            )
+            preenchidos += len(linhas)
+            ultimo_id = linhas[-1].id
+    return preenchidos
+
+
+# ====== BUSCA TEXTUAL (SQLite FTS5) ======
+# Índice FTS5 "external content" sobre nfse_campos: o texto não é duplicado, e os gatilhos abaixo
+# mantêm o índice sincronizado em toda inserção, atualização ou exclusão (inclusive em massa).
+COLUNAS_BUSCA = ["descricao_servico", "tomador_razao_social", "prestador_razao_social", "codigo_verificacao", "nfse_id_xml"]
+
+def criar_indice_busca(engine):
+    """Cria a tabela virtual nfse_busca e seus gatilhos; reconstrói o índice ao criá-lo em um banco já populado."""
+    colunas = ", ".join(COLUNAS_BUSCA)
+    novos = ", ".join(f"new.{coluna}" for coluna in COLUNAS_BUSCA)
+    antigos = ", ".join(f"old.{coluna}" for coluna in COLUNAS_BUSCA)
+    with engine.begin() as conn:
+        existia = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'nfse_busca'")).first() is not None
+        conn.execute(text(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS nfse_busca USING fts5({colunas}, "
+            "content='nfse_campos', content_rowid='id', tokenize='unicode61 remove_diacritics 2')"
+        ))
+        conn.execute(text(
+            "CREATE TRIGGER IF NOT EXISTS nfse_busca_ai AFTER INSERT ON nfse_campos BEGIN "
+            f"INSERT INTO nfse_busca(rowid, {colunas}) VALUES (new.id, {novos}); END"
+        ))
+        conn.execute(text(
+            "CREATE TRIGGER IF NOT EXISTS nfse_busca_ad AFTER DELETE ON nfse_campos BEGIN "
+            f"INSERT INTO nfse_busca(nfse_busca, rowid, {colunas}) VALUES ('delete', old.id, {antigos}); END"
+        ))
+        conn.execute(text(
+            "CREATE TRIGGER IF NOT EXISTS nfse_busca_au AFTER UPDATE ON nfse_campos BEGIN "
+            f"INSERT INTO nfse_busca(nfse_busca, rowid, {colunas}) VALUES ('delete', old.id, {antigos}); "
+            f"INSERT INTO nfse_busca(rowid, {colunas}) VALUES (new.id, {novos}); END"
+        ))
+        if not existia:
+            conn.execute(text("INSERT INTO nfse_busca(nfse_busca) VALUES ('rebuild')"))
+
+
+# ====== ÍNDICE DE NUMERAÇÃO POR PRESTADOR ======
+def reconstruir_indice_numeracao(conn):
+    """Recalcula todo o índice de numeração a partir de nfse_campos (em SQL; usado na criação do índice)."""
+    agora = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    conn.execute(text("DELETE FROM numeracao_lacunas"))
+    conn.execute(text("DELETE FROM numeracao_emitidos"))
+    conn.execute(text("DELETE FROM numeracao_prestador"))
+    conn.execute(text("""
+        INSERT INTO numeracao_emitidos (prestador_cpf_cnpj, numero, ocorrencias, cancelada)
+        SELECT prestador_cpf_cnpj, numero, COUNT(*), MAX(cancelada) FROM nfse_campos
+        WHERE prestador_cpf_cnpj IS NOT NULL AND numero > 0
+        GROUP BY prestador_cpf_cnpj, numero
+    """))
+    conn.execute(text("""
+        INSERT INTO numeracao_prestador (prestador_cpf_cnpj, menor_numero, maior_numero, atualizado_em)
+        SELECT prestador_cpf_cnpj, MIN(numero), MAX(numero), :agora FROM numeracao_emitidos
+        GROUP BY prestador_cpf_cnpj
+    """), {"agora": agora})
+    conn.execute(text("""
+        INSERT INTO numeracao_lacunas (prestador_cpf_cnpj, inicio, fim)
+        SELECT prestador_cpf_cnpj, anterior + 1, numero - 1
+        FROM (
+            SELECT prestador_cpf_cnpj, numero,
+                   LAG(numero) OVER (PARTITION BY prestador_cpf_cnpj ORDER BY numero) AS anterior
+            FROM numeracao_emitidos
+        )
+        WHERE anterior IS NOT NULL AND numero - anterior > 1
+    """))
+
+def criar_indice_numeracao(engine):
+    """Popula o índice de numeração em bancos que já tinham NFS-e antes dele existir."""
+    with engine.begin() as conn:
+        vazio = conn.execute(text("SELECT 1 FROM numeracao_prestador LIMIT 1")).first() is None
+        com_numeros = conn.execute(
+            text("SELECT 1 FROM nfse_campos WHERE prestador_cpf_cnpj IS NOT NULL AND numero > 0 LIMIT 1")
+        ).first() is not None
+        if vazio and com_numeros:
+            reconstruir_indice_numeracao(conn)
+
+
+# Converte bancos no formato antigo e cria as tabelas que ainda não existem
+# (inclusive em bancos criados antes da tabela nfse_campos e dos índices de busca e numeração)
+migrar_xml_comprimido(engine)
+Base.metadata.create_all(engine)
+migrar_impressao_digital(engine)
+criar_indice_busca(engine)
+criar_indice_numeracao(engine)
+
+Session = sessionmaker(bind=engine)
+
+
+@contextmanager
+def session_scope():
+    """
+    Sessão curta para uma operação: commit ao final, rollback em caso de erro e sempre fechada.
+    Uso: with session_scope() as session: ...
+    """
+    session = Session()
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+# ====== CONVERSÃO DOS CAMPOS EXTRAÍDOS ======
+def _to_float(valor):
+    """Converte o texto do XML em float, ou None se vazio/inválido."""
+    try:
+        return float(valor) if valor not in (None, '') else None
+    except (TypeError, ValueError):
+        return None
+
+def _to_int(valor):
+    """Converte o texto do XML em int, ou None se vazio/inválido."""
+    try:
+        return int(str(valor).strip()) if valor not in (None, '') else None
+    except (TypeError, ValueError):
+        return None
+
+def _competencia(data_emissao):
+    """Extrai a competência (YYYY-MM) do início da data de emissão ISO 8601."""
+    if data_emissao and re.match(r'^\d{4}-\d{2}', data_emissao):
+        return data_emissao[:7]
+    return None
+
+def valores_campos(data):
+    """Converte o dicionário devolvido por extract_nfse_data nos valores tipados das colunas de NFSeCampos."""
+    valores = {}
+    for chave, coluna in CAMPOS_NFSE.items():
+        tipo = NFSeCampos.__table__.c[coluna].type
+        if isinstance(tipo, Float):
+            valores[coluna] = _to_float(data.get(chave))
+        elif isinstance(tipo, Integer):
+            valores[coluna] = _to_int(data.get(chave))
+        else:
+            valores[coluna] = data.get(chave)
+    valores['competencia'] = _competencia(data.get('DataEmissao'))
+    valores['cancelada'] = data.get('IsCancelled') == 'Sim'
+    valores['impressao_digital'] = nfse_fingerprint(data)
+    return valores
+
+def campos_from_extracted(data):
+    """Monta um NFSeCampos a partir do dicionário devolvido por extract_nfse_data."""
+    return NFSeCampos(**valores_campos(data))
+
+def extrair_valores_campos(xml_content, nome="<XML em memória>"):
+    """Extrai os campos de um XML (texto) com extract_nfse_data e devolve os valores das colunas de NFSeCampos."""
+    buffer = io.BytesIO(xml_content.encode("utf-8"))
+    buffer.name = nome
+    return valores_campos(extract_nfse_data(buffer))
+
+def extrair_campos(xml_content, nome="<XML em memória>"):
+    """Extrai os campos de um XML (texto) com extract_nfse_data e devolve o NFSeCampos correspondente."""
+    return NFSeCampos(**extrair_valores_campos(xml_content, nome))
+
+
+def _abrir_lacuna(session, prestador_cnpj, inicio, fim):
+    """Registra a faixa de números ainda não recebida (gravada na hora: notas seguintes do lote podem fechá-la)."""
+    session.execute(insert(LacunaNumeracao.__table__), {"prestador_cpf_cnpj": prestador_cnpj, "inicio": inicio, "fim": fim})
+
+def _fechar_numero_na_lacuna(session, prestador_cnpj, numero):
+    """Remove o número da lacuna que o contém (encolhendo ou dividindo a faixa), se houver."""
+    lacunas = LacunaNumeracao.__table__
+    lacuna = session.execute(
+        lacunas.select()
+        .where(lacunas.c.prestador_cpf_cnpj == prestador_cnpj, lacunas.c.inicio <= numero, lacunas.c.fim >= numero)
+        .order_by(lacunas.c.inicio.desc())
+        .limit(1)
+    ).first()
+    if lacuna is None:
+        return
+    session.execute(lacunas.delete().where(lacunas.c.id == lacuna.id))
+    restantes = [(lacuna.inicio, numero - 1), (numero + 1, lacuna.fim)]
+    novas = [{"prestador_cpf_cnpj": prestador_cnpj, "inicio": inicio, "fim": fim} for inicio, fim in restantes if inicio <= fim]
+    if novas:
+        session.execute(insert(lacunas), novas)
+
+def registrar_numeros(session, notas):
+    """
+    Atualiza o índice de numeração com as NFS-e recém-inseridas (custo proporcional às notas novas).
+    notas: valores de NFSeCampos (dicionários de valores_campos) com prestador_cpf_cnpj, numero e cancelada.
+    Número repetido só incrementa 'ocorrencias'; número novo fecha a lacuna que o contém ou, fora da
+    faixa conhecida, estende a faixa e abre a lacuna entre ela e o número recebido.
+    O commit fica a cargo de quem chama.
+    """
+    por_prestador = {}
+    for nota in notas:
+        prestador_cnpj, numero = nota.get("prestador_cpf_cnpj"), nota.get("numero")
+        if prestador_cnpj and numero and numero > 0:
+            por_prestador.setdefault(prestador_cnpj, []).append((numero, bool(nota.get("cancelada"))))
+
+    emitidos = NumeroEmitido.__table__
+    agora = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    for prestador_cnpj, numeros in por_prestador.items():
+        numeros.sort()
+        faixa = session.get(NumeracaoPrestador, prestador_cnpj)
+        conhecidos = {
+            numero: (ocorrencias, cancelada)
+            for numero, ocorrencias, cancelada in session.execute(
+                emitidos.select().with_only_columns(emitidos.c.numero, emitidos.c.ocorrencias, emitidos.c.cancelada)
+                .where(emitidos.c.prestador_cpf_cnpj == prestador_cnpj,
+                       emitidos.c.numero.in_({numero for numero, _ in numeros}))
+            )
+        }
+        novos = {}  # Números ainda não emitidos: gravados abaixo em um único INSERT
+        for numero, cancelada in numeros:
+            if numero in conhecidos or numero in novos:
+                # Repetido (no banco ou no próprio lote): só conta a ocorrência
+                registro = conhecidos if numero in conhecidos else novos
+                ocorrencias, ja_cancelada = registro[numero]
+                registro[numero] = (ocorrencias + 1, ja_cancelada or cancelada)
+                continue
+            novos[numero] = (1, cancelada)
+
+            if faixa is None:
+                faixa = NumeracaoPrestador(prestador_cpf_cnpj=prestador_cnpj, menor_numero=numero, maior_numero=numero)
+                session.add(faixa)
+            elif numero > faixa.maior_numero:
+                if numero > faixa.maior_numero + 1:
+                    _abrir_lacuna(session, prestador_cnpj, faixa.maior_numero + 1, numero - 1)
+                faixa.maior_numero = numero
+            elif numero < faixa.menor_numero:
+                if numero < faixa.menor_numero - 1:
+                    _abrir_lacuna(session, prestador_cnpj, numero + 1, faixa.menor_numero - 1)
+                faixa.menor_numero = numero
+            else:
+                _fechar_numero_na_lacuna(session, prestador_cnpj, numero)
+        faixa.atualizado_em = agora
+
+        if novos:
+            session.execute(insert(emitidos), [
+                {"prestador_cpf_cnpj": prestador_cnpj, "numero": numero, "cancelada": cancelada, "ocorrencias": ocorrencias}
+                for numero, (ocorrencias, cancelada) in novos.items()
+            ])
+        for numero, (ocorrencias, cancelada) in conhecidos.items():
+            session.execute(
+                emitidos.update()
+                .where(emitidos.c.prestador_cpf_cnpj == prestador_cnpj, emitidos.c.numero == numero)
+                .values(ocorrencias=ocorrencias, cancelada=cancelada)
+            )
+
+
+# ====== GRAVAÇÃO ======
+def xml_ja_armazenado(session, xml_hash):
+    """
+    Indica se já existe um registro com esse hash de conteúdo (busca pelo índice único), no banco
+    principal ou em algum ano arquivado.
+    """
+    if session.query(NFSe.id).filter(NFSe.xml_hash == xml_hash).first() is not None:
+        return True
+    return bool(valores_arquivados(NFSe.xml_hash, {xml_hash}))
+
+def valores_armazenados(session, coluna, valores, lote=500):
+    """Subconjunto de 'valores' que já existem na coluna indexada informada (consultas IN em lotes)."""
+    valores = [valor for valor in valores if valor]
+    existentes = set()
+    for inicio in range(0, len(valores), lote):
+        parte = valores[inicio:inicio + lote]
+        existentes.update(v for (v,) in session.query(coluna).filter(coluna.in_(parte)))
+    return existentes
+
+def valores_arquivados(coluna, valores, anos=None, lote=500):
+    """
+    Subconjunto de 'valores' que já existem na coluna informada nas partições dos anos arquivados
+    (todos, ou só os anos informados que tiverem partição), anexadas somente para leitura.
+    """
+    valores = {valor for valor in valores if valor}
+    existentes = set()
+    if not valores:
+        return existentes
+    arquivados = anos_arquivados()
+    if anos is not None:
+        arquivados = [ano for ano in arquivados if ano in {int(a) for a in anos}]
+    for ano in arquivados:
+        with sessao_particao(ano) as session_ano:
+            existentes.update(valores_armazenados(session_ano, coluna, valores, lote))
+    return existentes
+
+def _anos_das_competencias(competencias):
+    """Anos (int) das competências AAAA-MM informadas, ignorando as vazias."""
+    return {int(competencia[:4]) for competencia in competencias if competencia}
+
+def hashes_armazenados(session, hashes, lote=500):
+    """
+    Subconjunto de hashes que já existem em nfses (consultas IN em lotes, pelo índice único), no
+    banco principal ou nas partições dos anos arquivados (o ano do XML só é conhecido depois da extração).
+    """
+    return valores_armazenados(session, NFSe.xml_hash, hashes, lote) | valores_arquivados(NFSe.xml_hash, hashes, lote=lote)
+
+def nota_ja_armazenada(session, xml_hash_canonico, impressao_digital, competencia=None):
+    """
+    Indica se a nota já está armazenada em outro arquivo (mesmo XML canônico ou mesma impressão
+    digital), no banco principal ou na partição do ano da competência, se o ano estiver arquivado.
+    """
+    if xml_hash_canonico and session.query(NFSe.id).filter(NFSe.xml_hash_canonico == xml_hash_canonico).first():
+        return True
+    if impressao_digital and session.query(NFSeCampos.id).filter(NFSeCampos.impressao_digital == impressao_digital).first():
+        return True
+    anos = _anos_das_competencias([competencia])
+    if not anos:
+        return False
+    return bool(valores_arquivados(NFSe.xml_hash_canonico, {xml_hash_canonico}, anos)) or bool(
+        valores_arquivados(NFSeCampos.impressao_digital, {impressao_digital}, anos))
+
+def registrar_cancelamentos(session, impressoes_digitais):
+    """
+    Marca como canceladas as notas armazenadas cujas cópias recebidas depois vieram canceladas
+    (a nota repetida não é gravada, mas o cancelamento não pode se perder), inclusive no índice de numeração.
+    Retorna a quantidade de notas que passaram a constar como canceladas.
+    """
+    campos, emitidos = NFSeCampos.__table__, NumeroEmitido.__table__
+    marcadas = session.execute(
+        campos.update()
+        .where(campos.c.impressao_digital.in_(list(impressoes_digitais)), campos.c.cancelada.is_(False))
+        .values(cancelada=True)
+        .returning(campos.c.prestador_cpf_cnpj, campos.c.numero)
+    ).fetchall()
+    for prestador_cnpj, numero in marcadas:
+        session.execute(
+            emitidos.update()
+            .where(emitidos.c.prestador_cpf_cnpj == prestador_cnpj, emitidos.c.numero == numero)
+            .values(cancelada=True)
+        )
+    return len(marcadas)
+
+def salvar_nfse(session, cliente, xml_content, nome_arquivo="<XML em memória>", data_envio=None):
+    """
+    Cria o registro NFSe com o XML comprimido e os campos extraídos (extração feita uma única vez,
+    na inserção). Se o mesmo XML, ou a mesma nota em outro arquivo, já estiver armazenado, nada é
+    gravado e a função retorna None (uma cópia cancelada ainda marca a nota armazenada como cancelada).
+    O commit fica a cargo de quem chama.
+    """
+    xml_hash = hash_xml(xml_content)
+    if xml_ja_armazenado(session, xml_hash):
+        return None
+    valores = extrair_valores_campos(xml_content, nome_arquivo)
+    xml_hash_canonico = hash_xml_canonico(xml_content)
+    if nota_ja_armazenada(session, xml_hash_canonico, valores['impressao_digital'], valores['competencia']):
+        if valores['cancelada'] and valores['impressao_digital']:
+            registrar_cancelamentos(session, {valores['impressao_digital']})
+        return None
+    if data_envio is None:
+        data_envio = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    registro = NFSe(cliente=cliente, data_envio=data_envio, xml_hash=xml_hash, xml_hash_canonico=xml_hash_canonico,
+                    xml_comprimido=comprimir_xml(xml_content))
+    registro.campos = NFSeCampos(**valores)
+    session.add(registro)
+    registrar_numeros(session, [valores])
+    return registro
+
+def salvar_lote_nfse(session, cliente, arquivos, progresso=None, data_envio=None):
+    """
+    Grava vários XMLs de um cliente com inserções em massa (executemany) na transação da sessão.
+    arquivos: lista de (nome_arquivo, xml_content). São ignorados os XMLs já armazenados e as notas
+    repetidas em outro arquivo (mesmo XML canônico ou mesma impressão digital), no banco (inclusive
+    nas partições dos anos arquivados) ou no próprio lote; cópias canceladas marcam a nota armazenada como cancelada.
+    progresso(processados, total), se informado, é chamado durante a extração.
+    O commit fica a cargo de quem chama.
+    Retorna um dicionário com as listas de nomes 'inseridos', 'duplicados' e 'cancelamentos'
+    (repetidos que trouxeram o cancelamento da nota).
+    """
+    if data_envio is None:
+        data_envio = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    com_hash = [(nome, xml_content, hash_xml(xml_content)) for nome, xml_content in arquivos]
+    ja_armazenados = hashes_armazenados(session, {xml_hash for _, _, xml_hash in com_hash})
+
+    resultado = {'inseridos': [], 'duplicados': [], 'cancelamentos': []}
+    candidatos, vistos = [], set()
+    total = len(com_hash)
+    for i, (nome, xml_content, xml_hash) in enumerate(com_hash):
+        if xml_hash in ja_armazenados or xml_hash in vistos:
+            resultado['duplicados'].append(nome)
+        else:
+            vistos.add(xml_hash)
+            candidatos.append((nome, xml_content, xml_hash, hash_xml_canonico(xml_content),
+                               extrair_valores_campos(xml_content, nome)))
+        if progresso is not None:
+            progresso(i + 1, total)
+
+    # Mesma nota em outro arquivo: conjuntos com o que já está no banco e nas partições dos anos das
+    # notas do lote (anos arquivados), completados com o próprio lote
+    hashes_canonicos = {c[3] for c in candidatos}
+    impressoes_lote = {c[4]['impressao_digital'] for c in candidatos}
+    anos = _anos_das_competencias(c[4]['competencia'] for c in candidatos)
+    canonicos = (valores_armazenados(session, NFSe.xml_hash_canonico, hashes_canonicos)
+                 | valores_arquivados(NFSe.xml_hash_canonico, hashes_canonicos, anos))
+    impressoes = (valores_armazenados(session, NFSeCampos.impressao_digital, impressoes_lote)
+                  | valores_arquivados(NFSeCampos.impressao_digital, impressoes_lote, anos))
+    linhas_nfse, linhas_campos, cancelar = [], [], set()
+    for nome, xml_content, xml_hash, xml_hash_canonico, valores in candidatos:
+        impressao = valores['impressao_digital']
+        if (xml_hash_canonico and xml_hash_canonico in canonicos) or (impressao and impressao in impressoes):
+            resultado['duplicados'].append(nome)
+            if valores['cancelada'] and impressao:
+                cancelar.add(impressao)
+                resultado['cancelamentos'].append(nome)
+            continue
+        canonicos.add(xml_hash_canonico)
+        impressoes.add(impressao)
+        linhas_nfse.append({"cliente": cliente, "data_envio": data_envio, "xml_hash": xml_hash,
+                            "xml_hash_canonico": xml_hash_canonico, "xml_comprimido": comprimir_xml(xml_content)})
+        linhas_campos.append(valores)
+        resultado['inseridos'].append(nome)
+
+    if linhas_nfse:
+        # RETURNING na mesma ordem dos parâmetros para ligar cada linha de nfse_campos ao seu registro
+        ids = session.execute(
+            insert(NFSe.__table__).returning(NFSe.__table__.c.id, sort_by_parameter_order=True),
+            linhas_nfse,
+        ).scalars().all()
+        for nfse_id, campos in zip(ids, linhas_campos):
+            campos["nfse_id"] = nfse_id
+        session.execute(insert(NFSeCampos.__table__), linhas_campos)
+        registrar_numeros(session, linhas_campos)
+    if cancelar:
+        registrar_cancelamentos(session, cancelar)
+    return resultado
+
+def contar_sem_campos(session):
+    """Quantidade de registros antigos (anteriores à tabela nfse_campos) ainda sem campos extraídos."""
+    return (
+        session.query(func.count(NFSe.id))
+        .outerjoin(NFSeCampos, NFSeCampos.nfse_id == NFSe.id)
+        .filter(NFSeCampos.id.is_(None))
+        .scalar()
+    )
+
+def preencher_campos_pendentes(session, lote=500):
+    """Extrai e grava os campos dos registros que ainda não os têm, em lotes. Retorna a quantidade processada."""
+    processados = 0
+    while True:
+        pendentes = (
+            session.query(NFSe.id, NFSe.xml_comprimido)
+            .outerjoin(NFSeCampos, NFSeCampos.nfse_id == NFSe.id)
+            .filter(NFSeCampos.id.is_(None))
+            .limit(lote)
+            .all()
+        )
+        if not pendentes:
+            return processados
+        linhas_campos = []
+        for registro_id, xml_comprimido in pendentes:
+            valores = extrair_valores_campos(descomprimir_xml(xml_comprimido), f"nfse_{registro_id}.xml")
+            valores["nfse_id"] = registro_id
+            linhas_campos.append(valores)
+        session.execute(insert(NFSeCampos.__table__), linhas_campos)
+        registrar_numeros(session, linhas_campos)
+        session.commit()
+        processados += len(pendentes)
+
+
+# ====== CONSULTAS ======
+def consultar_campos(session, cliente=None, prestador_cnpj=None, tomador_cnpj=None, competencia=None, numero=None):
+    """Query de NFSeCampos filtrada pelos índices (CNPJs só com dígitos, competência YYYY-MM)."""
+    query = session.query(NFSeCampos)
+    if cliente:
+        query = query.join(NFSe, NFSe.id == NFSeCampos.nfse_id).filter(NFSe.cliente == cliente)
+    if prestador_cnpj:
+        query = query.filter(NFSeCampos.prestador_cpf_cnpj == prestador_cnpj)
+    if tomador_cnpj:
+        query = query.filter(NFSeCampos.tomador_cpf_cnpj == tomador_cnpj)
+    if competencia:
+        query = query.filter(NFSeCampos.competencia == competencia)
+    if numero is not None:
+        query = query.filter(NFSeCampos.numero == numero)
+    return query
+
+def numeros_duplicados(session, prestador_cnpj, competencia):
+    """Números de NF que aparecem mais de uma vez para o prestador/competência: lista de (numero, quantidade)."""
+    return (
+        session.query(NFSeCampos.numero, func.count(NFSeCampos.id))
+        .filter(NFSeCampos.prestador_cpf_cnpj == prestador_cnpj, NFSeCampos.competencia == competencia,
+                NFSeCampos.numero > 0)
+        .group_by(NFSeCampos.numero)
+        .having(func.count(NFSeCampos.id) > 1)
+        .order_by(NFSeCampos.numero)
+        .all()
+    )
+
+def lacunas_sequencia(session, prestador_cnpj, competencia):
+    """
+    Lacunas na numeração de NF do prestador/competência, calculadas em SQL com LAG().
+    Retorna uma lista de (primeiro_faltante, ultimo_faltante).
+    """
+    sql = text("""
+        SELECT anterior + 1 AS primeiro_faltante, numero - 1 AS ultimo_faltante
+        FROM (
+            SELECT numero, LAG(numero) OVER (ORDER BY numero) AS anterior
+            FROM (
+                SELECT DISTINCT numero FROM nfse_campos
+                WHERE prestador_cpf_cnpj = :prestador AND competencia = :competencia
+                  AND numero > 0
+            )
+        )
+        WHERE anterior IS NOT NULL AND numero - anterior > 1
+        ORDER BY numero
+    """)
+    return session.execute(sql, {"prestador": prestador_cnpj, "competencia": competencia}).fetchall()
+
+def resumo_numeracao(session):
+    """
+    Situação da numeração de cada prestador pelo índice persistido: lista de
+    (prestador, menor_numero, maior_numero, emitidos, cancelados, repetidos, faltantes).
+    """
+    emitidos = (
+        session.query(
+            NumeroEmitido.prestador_cpf_cnpj.label("prestador"),
+            func.count().label("emitidos"),
+            func.sum(case((NumeroEmitido.cancelada, 1), else_=0)).label("cancelados"),
+            func.sum(case((NumeroEmitido.ocorrencias > 1, 1), else_=0)).label("repetidos"),
+        )
+        .group_by(NumeroEmitido.prestador_cpf_cnpj)
+        .subquery()
+    )
+    faltantes = (
+        session.query(
+            LacunaNumeracao.prestador_cpf_cnpj.label("prestador"),
+            func.sum(LacunaNumeracao.fim - LacunaNumeracao.inicio + 1).label("faltantes"),
+        )
+        .group_by(LacunaNumeracao.prestador_cpf_cnpj)
+        .subquery()
+    )
+    return (
+        session.query(
+            NumeracaoPrestador.prestador_cpf_cnpj, NumeracaoPrestador.menor_numero, NumeracaoPrestador.maior_numero,
+            emitidos.c.emitidos, emitidos.c.cancelados, emitidos.c.repetidos,
+            func.coalesce(faltantes.c.faltantes, 0),
+        )
+        .join(emitidos, emitidos.c.prestador == NumeracaoPrestador.prestador_cpf_cnpj)
+        .outerjoin(faltantes, faltantes.c.prestador == NumeracaoPrestador.prestador_cpf_cnpj)
+        .order_by(NumeracaoPrestador.prestador_cpf_cnpj)
+        .all()
+    )
+
+def lacunas_abertas(session, prestador_cnpj):
+    """Lacunas em aberto na numeração do prestador (todos os envios e competências): lista de (inicio, fim)."""
+    return (
+        session.query(LacunaNumeracao.inicio, LacunaNumeracao.fim)
+        .filter(LacunaNumeracao.prestador_cpf_cnpj == prestador_cnpj)
+        .order_by(LacunaNumeracao.inicio)
+        .all()
+    )
+
+def numeros_repetidos(session, prestador_cnpj):
+    """Números do prestador recebidos mais de uma vez (em XMLs diferentes): lista de (numero, ocorrencias)."""
+    return (
+        session.query(NumeroEmitido.numero, NumeroEmitido.ocorrencias)
+        .filter(NumeroEmitido.prestador_cpf_cnpj == prestador_cnpj, NumeroEmitido.ocorrencias > 1)
+        .order_by(NumeroEmitido.numero)
+        .all()
+    )
+
+def numeros_cancelados(session, prestador_cnpj):
+    """Números do prestador já recebidos como cancelados."""
+    return [
+        numero for (numero,) in
+        session.query(NumeroEmitido.numero)
+        .filter(NumeroEmitido.prestador_cpf_cnpj == prestador_cnpj, NumeroEmitido.cancelada.is_(True))
+        .order_by(NumeroEmitido.numero)
+    ]
+
+def _expressao_busca(termo):
+    """Converte o texto digitado em uma consulta FTS5 segura: cada palavra entre aspas, com busca por prefixo."""
+    palavras = [palavra.replace('"', '""') for palavra in termo.split()]
+    return " ".join(f'"{palavra}"*' for palavra in palavras)
+
+def buscar_notas(session, termo, limite=100):
+    """
+    Busca textual (FTS5) na descrição do serviço, razões sociais, código de verificação e Id da NFS-e.
+    Retorna até 'limite' linhas ordenadas por relevância, com um trecho destacado da descrição.
+    """
+    expressao = _expressao_busca(termo)
+    if not expressao:
+        return []
+    sql = text("""
+        SELECT c.nfse_id, c.numero, c.competencia, c.prestador_razao_social, c.tomador_razao_social,
+               c.codigo_verificacao, c.valor_servicos,
+               snippet(nfse_busca, 0, '**', '**', '...', 12) AS trecho
+        FROM nfse_busca
+        JOIN nfse_campos AS c ON c.id = nfse_busca.rowid
+        WHERE nfse_busca MATCH :expressao
+        ORDER BY rank
+        LIMIT :limite
+    """)
+    return session.execute(sql, {"expressao": expressao, "limite": limite}).fetchall()
+
+
+# ====== EXPORTAÇÃO EM LOTE (ZIP) ======
+def iterar_xmls(session, clientes=None, competencias=None, prestador_cnpj=None, tomador_cnpj=None, nfse_ids=None, lote=500):
+    """
+    Gera (id, cliente, competencia, numero, xml_bytes) das NFS-e selecionadas, lendo 'lote' registros
+    por consulta (paginação por chave) e descomprimindo um XML por vez.
+    """
+    ultimo_id = 0
+    while True:
+        query = (
+            session.query(NFSe.id, NFSe.cliente, NFSeCampos.competencia, NFSeCampos.numero, NFSe.xml_comprimido)
+            .outerjoin(NFSeCampos, NFSeCampos.nfse_id == NFSe.id)
+            .filter(NFSe.id > ultimo_id)
+        )
+        if clientes:
+            query = query.filter(NFSe.cliente.in_(clientes))
+        if competencias:
+            query = query.filter(NFSeCampos.competencia.in_(competencias))
+        if prestador_cnpj:
+            query = query.filter(NFSeCampos.prestador_cpf_cnpj == prestador_cnpj)
+        if tomador_cnpj:
+            query = query.filter(NFSeCampos.tomador_cpf_cnpj == tomador_cnpj)
+        if nfse_ids is not None:
+            query = query.filter(NFSe.id.in_(nfse_ids))
+        linhas = query.order_by(NFSe.id).limit(lote).all()
+        if not linhas:
+            return
+        for registro_id, cliente, competencia, numero, xml_comprimido in linhas:
+            yield registro_id, cliente, competencia, numero, zlib.decompress(xml_comprimido)
+        ultimo_id = linhas[-1][0]
+
+def exportar_xmls_zip(session, destino, clientes=None, competencias=None, prestador_cnpj=None, tomador_cnpj=None,
+                      nfse_ids=None, lote=500, progresso=None):
+    """
+    Grava em 'destino' (caminho ou arquivo binário) um ZIP com os XMLs selecionados (mesmos filtros de
+    iterar_xmls; nfse_ids é para seleções pequenas, como resultados de busca), entrada por
+    entrada: só um XML descomprimido fica em memória por vez. Os arquivos são organizados em
+    <cliente>/<competência>/nfse_<número>_<id>.xml. progresso(exportados), se informado, é chamado
+    a cada lote. Retorna a quantidade de XMLs exportados.
+    """
+    exportados = 0
+    with zipfile.ZipFile(destino, "w", compression=zipfile.ZIP_DEFLATED) as arquivo_zip:
+        selecionados = iterar_xmls(session, clientes, competencias, prestador_cnpj, tomador_cnpj, nfse_ids, lote)
+        for registro_id, cliente, competencia, numero, xml_bytes in selecionados:
+            pasta_cliente = re.sub(r'[\\/:*?"<>|]', "_", cliente or "sem_cliente")
+            nome = f"{pasta_cliente}/{competencia or 'sem_competencia'}/nfse_{numero or 'sn'}_{registro_id}.xml"
+            arquivo_zip.writestr(nome, xml_bytes)
+            exportados += 1
+            if progresso is not None and exportados % lote == 0:
+                progresso(exportados)
+    return exportados
+
+
+# ====== PARTIÇÕES ANUAIS (ARQUIVO) ======
+TABELAS_PARTICAO = [NFSe.__table__, NFSeCampos.__table__]
+
+def caminho_particao(ano):
+    """Arquivo SQLite da partição de um ano."""
+    return os.path.join(DIRETORIO_PARTICOES, f"nfse_{int(ano)}.db")
+
+def anos_arquivados():
+    """Anos que já têm partição própria, em ordem decrescente."""
+    if not os.path.isdir(DIRETORIO_PARTICOES):
+        return []
+    anos = [int(m.group(1)) for m in (re.match(r"^nfse_(\d{4})\.db$", nome) for nome in os.listdir(DIRETORIO_PARTICOES)) if m]
+    return sorted(anos, reverse=True)
+
+def anos_arquivaveis(session, ano_corrente=None):
+    """Anos anteriores ao corrente que ainda têm NFS-e no banco principal."""
+    ano_corrente = ano_corrente or datetime.date.today().year
+    anos = (
+        session.query(func.substr(NFSeCampos.competencia, 1, 4))
+        .filter(NFSeCampos.competencia < f"{ano_corrente}-01")
+        .distinct()
+        .all()
+    )
+    return sorted((int(ano) for (ano,) in anos), reverse=True)
+
+def _criar_particao(caminho):
+    """Cria (se preciso) o arquivo da partição com as tabelas de NFS-e e o índice de busca, em journal DELETE."""
+    os.makedirs(os.path.dirname(caminho), exist_ok=True)
+    engine_particao = create_engine(f"sqlite:///{caminho}")
+    try:
+        Base.metadata.create_all(engine_particao, tables=TABELAS_PARTICAO)
+        with engine_particao.begin() as conn:
+            adicionar_colunas_impressao_digital(conn)
+        criar_indice_busca(engine_particao)
+    finally:
+        engine_particao.dispose()
+
+def atualizar_particoes():
+    """Aplica às partições já existentes as colunas acrescentadas depois que elas foram criadas."""
+    for ano in anos_arquivados():
+        caminho = caminho_particao(ano)
+        os.chmod(caminho, 0o644)
+        try:
+            _criar_particao(caminho)
+        finally:
+            os.chmod(caminho, 0o444)
+
+def arquivar_ano(ano, lote=1000, progresso=None):
+    """
+    Move as NFS-e com competência no ano informado do banco principal para a partição do ano
+    (anexada com ATTACH durante a cópia) e marca o arquivo como somente leitura.
+    XMLs que já estão na partição são apenas removidos do banco principal. Os ids são
+    reatribuídos pela partição. progresso(movidas), se informado, é chamado a cada lote.
+    Retorna a quantidade de NFS-e removidas do banco principal.
+    """
+    caminho = caminho_particao(ano)
+    if os.path.exists(caminho):
+        os.chmod(caminho, 0o644)  # Reabre para escrita se o ano já tinha sido arquivado
+    _criar_particao(caminho)
+
+    nfses, campos = NFSe.__table__, NFSeCampos.__table__
+    na_particao = {"schema_translate_map": {None: "particao"}}
+    movidas = 0
+    with engine.connect() as conn:
+        conn.exec_driver_sql("ATTACH DATABASE ? AS particao", (caminho,))
+        conn.commit()
+        try:
+            with conn.begin():
+                while True:
+                    ids = conn.execute(
+                        select(campos.c.nfse_id)
+                        .where(campos.c.competencia >= f"{ano}-01", campos.c.competencia <= f"{ano}-12")
+                        .order_by(campos.c.nfse_id)
+                        .limit(lote)
+                    ).scalars().all()
+                    if not ids:
+                        break
+                    registros = conn.execute(select(nfses).where(nfses.c.id.in_(ids)).order_by(nfses.c.id)).mappings().all()
+                    campos_por_id = {
+                        linha["nfse_id"]: dict(linha)
+                        for linha in conn.execute(select(campos).where(campos.c.nfse_id.in_(ids))).mappings()
+                    }
+                    ja_arquivados = set(conn.execute(
+                        select(nfses.c.xml_hash).where(nfses.c.xml_hash.in_([r["xml_hash"] for r in registros])),
+                        execution_options=na_particao,
+                    ).scalars())
+
+                    novos = [r for r in registros if r["xml_hash"] not in ja_arquivados]
+                    if novos:
+                        novos_ids = conn.execute(
+                            insert(nfses).returning(nfses.c.id, sort_by_parameter_order=True),
+                            [{k: v for k, v in r.items() if k != "id"} for r in novos],
+                            execution_options=na_particao,
+                        ).scalars().all()
+                        linhas_campos = []
+                        for registro, novo_id in zip(novos, novos_ids):
+                            linha = {k: v for k, v in campos_por_id[registro["id"]].items() if k != "id"}
+                            linha["nfse_id"] = novo_id
+                            linhas_campos.append(linha)
+                        conn.execute(insert(campos), linhas_campos, execution_options=na_particao)
+
+                    conn.execute(campos.delete().where(campos.c.nfse_id.in_(ids)))
+                    conn.execute(nfses.delete().where(nfses.c.id.in_(ids)))
+                    movidas += len(ids)
+                    if progresso is not None:
+                        progresso(movidas)
+        finally:
+            conn.exec_driver_sql("DETACH DATABASE particao")
+
+    os.chmod(caminho, 0o444)  # Anos arquivados ficam somente leitura
+    if movidas:
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(text("VACUUM"))
+    return movidas
+
+# Partições criadas por versões anteriores recebem as colunas novas ao iniciar
+atualizar_particoes()
+
+@contextmanager
+def sessao_particao(ano):
+    """
+    Sessão somente leitura sobre a partição de um ano: o arquivo é anexado (ATTACH ... mode=ro) a uma
+    conexão do banco principal só durante o uso, e as tabelas dos modelos são redirecionadas para ele
+    (schema_translate_map). Vale para consultas do ORM; SQL textual continua lendo o banco principal.
+    """
+    esquema = f"ano_{int(ano)}"
+    caminho = caminho_particao(ano)
+    if not os.path.exists(caminho):
+        raise FileNotFoundError(f"Partição do ano {ano} não encontrada: {caminho}")
+    with engine.connect() as conn:
+        uri = pathlib.Path(caminho).resolve().as_uri() + "?mode=ro"
+        conn.exec_driver_sql(f"ATTACH DATABASE ? AS {esquema}", (uri,))
+        session = Session(bind=conn.execution_options(schema_translate_map={None: esquema}))
+        try:
+            yield session
+        finally:
+            session.close()
+            conn.rollback()
+            conn.exec_driver_sql(f"DETACH DATABASE {esquema}")
+
+
+# ====== CARGA PARA O VIEWER ======
+def listar_clientes(session):
+    """Clientes com NFS-e armazenadas, em ordem alfabética."""
+    return [cliente for (cliente,) in session.query(NFSe.cliente).distinct().order_by(NFSe.cliente)]
+
+def listar_competencias(session, cliente):
+    """Competências (YYYY-MM) com NFS-e do cliente, em ordem crescente (pelos campos extraídos)."""
+    return [
+        competencia for (competencia,) in
+        session.query(NFSeCampos.competencia)
+        .join(NFSe, NFSe.id == NFSeCampos.nfse_id)
+        .filter(NFSe.cliente == cliente, NFSeCampos.competencia.isnot(None))
+        .distinct()
+        .order_by(NFSeCampos.competencia)
+    ]
+
+def assinatura_notas(session, cliente, competencia_inicial=None, competencia_final=None):
+    """
+    Assinatura barata do conjunto de NFS-e do cliente no período: quantidade de notas, maior id,
+    notas com campos extraídos e canceladas. Muda quando o conjunto muda (usada como chave de cache).
+    """
+    query = (
+        session.query(
+            func.count(NFSe.id), func.max(NFSe.id), func.count(NFSeCampos.id),
+            func.sum(case((NFSeCampos.cancelada.is_(True), 1), else_=0)),
+        )
+        .outerjoin(NFSeCampos, NFSeCampos.nfse_id == NFSe.id)
+        .filter(NFSe.cliente == cliente)
+    )
+    if competencia_inicial:
+        query = query.filter((NFSeCampos.competencia >= competencia_inicial) | NFSeCampos.id.is_(None))
+    if competencia_final:
+        query = query.filter((NFSeCampos.competencia <= competencia_final) | NFSeCampos.id.is_(None))
+    return tuple(query.one())
+
+def iterar_notas_extraidas(session, cliente, competencia_inicial=None, competencia_final=None, tamanho_lote=5000):
+    """
+    Gera, em lotes de até 'tamanho_lote', as NFS-e do cliente no formato de extract_nfse_data,
+    lidas dos campos já extraídos (paginação por chave: id > último id do lote anterior).
+    Registros antigos sem campos extraídos passam pelo parser a partir do XML armazenado
+    (nesse caso o filtro de competência é aplicado depois da extração).
+    """
+    ultimo_id = 0
+    while True:
+        query = (
+            session.query(NFSe.id, NFSeCampos)
+            .outerjoin(NFSeCampos, NFSeCampos.nfse_id == NFSe.id)
+            .filter(NFSe.cliente == cliente, NFSe.id > ultimo_id)
+        )
+        if competencia_inicial:
+            query = query.filter((NFSeCampos.competencia >= competencia_inicial) | NFSeCampos.id.is_(None))
+        if competencia_final:
+            query = query.filter((NFSeCampos.competencia <= competencia_final) | NFSeCampos.id.is_(None))
+        linhas = query.order_by(NFSe.id).limit(tamanho_lote).all()
+        if not linhas:
+            return
+
+        lote = []
+        for registro_id, campos in linhas:
+            if campos is not None:
+                lote.append(dados_extraidos_from_campos(campos))
+                continue
+            xml_comprimido = session.query(NFSe.xml_comprimido).filter(NFSe.id == registro_id).scalar()
+            buffer = io.BytesIO(zlib.decompress(xml_comprimido))
+            buffer.name = f"nfse_{registro_id}.xml"
+            data = extract_nfse_data(buffer)
+            competencia = _competencia(data.get('DataEmissao'))
+            if competencia_inicial and (competencia is None or competencia < competencia_inicial):
+                continue
+            if competencia_final and (competencia is None or competencia > competencia_final):
+                continue
+            lote.append(data)
+        # Libera os objetos NFSeCampos do lote já convertido
+        session.expunge_all()
+        ultimo_id = linhas[-1][0]
+        yield lote
@@ -0,0 +1,305 @@
+# nfse_fila.py - Fila persistente (SQLite) para o processamento de lotes grandes de XMLs
+#
+# Um lote enviado é gravado inteiro na fila antes de qualquer processamento: os XMLs (comprimidos)
+# ficam em "fila_arquivos", divididos em partes ("fila_partes") de TAMANHO_PARTE arquivos. Cada
+# trabalhador reivindica uma parte por vez (UPDATE ... RETURNING atômico), grava as NFS-e com
+# salvar_lote_nfse e registra o resultado de cada arquivo na mesma transação (checkpoint). Se o
+# navegador fechar ou o processo cair no meio do lote, as partes não concluídas continuam na fila:
+# as pendentes são retomadas e as que estavam em processamento voltam a ser reivindicáveis depois
+# de PRAZO_PARTE_SEGUNDOS.
+#
+# Falhas: XML malformado vai direto para a quarentena; outros erros são tentados de novo, arquivo
+# por arquivo, até MAX_TENTATIVAS vezes antes da quarentena.
+#
+# Uso em linha de comando (a partir da raiz do repositório), para processar a fila fora do Streamlit:
+#   python nfse_fila.py
+#   python nfse_fila.py --processos 4
+
+import argparse
+import datetime
+import multiprocessing
+import os
+import socket
+import time
+import xml.etree.ElementTree as ET
+
+from sqlalchemy import Column, Integer, String, Text, Float, LargeBinary, ForeignKey, Index, func, insert, select, update
+
+from nfse_db import Base, engine, session_scope, salvar_lote_nfse, comprimir_xml, descomprimir_xml
+
+# ====== CONFIGURAÇÕES ======
+TAMANHO_PARTE = 500  # Arquivos por parte (unidade de reivindicação e de checkpoint)
+MAX_TENTATIVAS = 3  # Tentativas por arquivo (e por parte) antes da quarentena
+PRAZO_PARTE_SEGUNDOS = 600  # Parte "em_processamento" há mais tempo que isso é considerada abandonada
+
+# Situações
+PENDENTE, EM_PROCESSAMENTO, CONCLUIDA = "pendente", "em_processamento", "concluida"
+ARQUIVO_OK, ARQUIVO_DUPLICADO, ARQUIVO_QUARENTENA = "ok", "duplicado", "quarentena"
+
+
+# Modelo/Table: lote enviado (um envio do usuário, com todos os seus arquivos)
+class LoteFila(Base):
+    __tablename__ = "fila_lotes"
+    id = Column(Integer, primary_key=True)
+    cliente = Column(String(255), nullable=False)
+    descricao = Column(String(255))
+    criado_em = Column(String(50), nullable=False)
+    total_arquivos = Column(Integer, nullable=False)
+
+
+# Modelo/Table: parte de um lote (reivindicada por um trabalhador de cada vez)
+class ParteFila(Base):
+    __tablename__ = "fila_partes"
+    id = Column(Integer, primary_key=True)
+    lote_id = Column(Integer, ForeignKey("fila_lotes.id", ondelete="CASCADE"), nullable=False)
+    ordem = Column(Integer, nullable=False)
+    situacao = Column(String(20), nullable=False, default=PENDENTE)
+    tentativas = Column(Integer, nullable=False, default=0)
+    trabalhador = Column(String(100))
+    reivindicada_em = Column(Float)  # time.time() da última reivindicação (prazo de abandono)
+
+    __table_args__ = (
+        Index("ix_fila_partes_situacao", "situacao", "lote_id", "ordem"),
+    )
+
+
+# Modelo/Table: arquivo do lote, com o XML até ser processado e o resultado depois
+class ArquivoFila(Base):
+    __tablename__ = "fila_arquivos"
+    id = Column(Integer, primary_key=True)
+    lote_id = Column(Integer, ForeignKey("fila_lotes.id", ondelete="CASCADE"), nullable=False)
+    parte_id = Column(Integer, ForeignKey("fila_partes.id", ondelete="CASCADE"), nullable=False)
+    nome = Column(String(500), nullable=False)
+    xml_comprimido = Column(LargeBinary)  # Removido depois de gravado (fica só na quarentena)
+    situacao = Column(String(20), nullable=False, default=PENDENTE)
+    tentativas = Column(Integer, nullable=False, default=0)
+    erro = Column(Text)
+
+    __table_args__ = (
+        Index("ix_fila_arquivos_parte", "parte_id", "situacao"),
+        Index("ix_fila_arquivos_lote", "lote_id", "situacao"),
+    )
+
+
+Base.metadata.create_all(engine, tables=[LoteFila.__table__, ParteFila.__table__, ArquivoFila.__table__])
+
+
+# ====== ENFILEIRAMENTO ======
+def criar_lote(cliente, arquivos, descricao=None, tamanho_parte=TAMANHO_PARTE):
+    """
+    Grava o lote na fila: arquivos é uma lista de (nome, xml_content). Os XMLs são comprimidos e
+    divididos em partes de 'tamanho_parte'. Retorna o id do lote.
+    """
+    with session_scope() as session:
+        lote = LoteFila(cliente=cliente, descricao=descricao, total_arquivos=len(arquivos),
+                        criado_em=datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        session.add(lote)
+        session.flush()
+        for ordem, inicio in enumerate(range(0, len(arquivos), tamanho_parte)):
+            parte_id = session.execute(
+                insert(ParteFila.__table__).returning(ParteFila.id),
+                {"lote_id": lote.id, "ordem": ordem, "situacao": PENDENTE, "tentativas": 0},
+            ).scalar_one()
+            session.execute(insert(ArquivoFila.__table__), [
+                {"lote_id": lote.id, "parte_id": parte_id, "nome": nome, "xml_comprimido": comprimir_xml(xml_content),
+                 "situacao": PENDENTE, "tentativas": 0}
+                for nome, xml_content in arquivos[inicio:inicio + tamanho_parte]
+            ])
+        return lote.id
+
+
+# ====== REIVINDICAÇÃO E PROCESSAMENTO ======
+def nome_trabalhador():
+    """Identificação do trabalhador (máquina e processo) gravada na parte reivindicada."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def reivindicar_parte(trabalhador=None, lote_id=None, prazo_segundos=PRAZO_PARTE_SEGUNDOS):
+    """
+    Reivindica atomicamente a próxima parte pendente (ou abandonada há mais de 'prazo_segundos'),
+    opcionalmente só do lote informado. Retorna o id da parte, ou None se não houver o que fazer.
+    """
+    agora = time.time()
+    disponivel = (ParteFila.situacao == PENDENTE) | (
+        (ParteFila.situacao == EM_PROCESSAMENTO) & (ParteFila.reivindicada_em < agora - prazo_segundos)
+    )
+    proxima = select(ParteFila.id).where(disponivel)
+    if lote_id is not None:
+        proxima = proxima.where(ParteFila.lote_id == lote_id)
+    proxima = proxima.order_by(ParteFila.lote_id, ParteFila.ordem).limit(1).scalar_subquery()
+    with session_scope() as session:
+        # Um único UPDATE: dois trabalhadores nunca ficam com a mesma parte
+        return session.execute(
+            update(ParteFila.__table__)
+            .where(ParteFila.id == proxima, disponivel)
+            .values(situacao=EM_PROCESSAMENTO, trabalhador=trabalhador or nome_trabalhador(),
+                    reivindicada_em=agora, tentativas=ParteFila.tentativas + 1)
+            .returning(ParteFila.id)
+        ).scalar()
+
+def _validar_xml(xml_content):
+    """Levanta ET.ParseError se o XML estiver malformado (erro definitivo: vai para a quarentena)."""
+    ET.fromstring(xml_content.encode("utf-8"))
+
+def _gravar_arquivos(session, cliente, arquivos):
+    """Grava os arquivos (id, nome, xml_content) com salvar_lote_nfse e registra o resultado de cada um."""
+    chaves = {f"[{arquivo_id}] {nome}": arquivo_id for arquivo_id, nome, _ in arquivos}
+    resultado = salvar_lote_nfse(session, cliente, [(f"[{arquivo_id}] {nome}", xml) for arquivo_id, nome, xml in arquivos])
+    for situacao, nomes in ((ARQUIVO_OK, resultado['inseridos']), (ARQUIVO_DUPLICADO, resultado['duplicados'])):
+        if nomes:
+            session.execute(
+                update(ArquivoFila.__table__)
+                .where(ArquivoFila.id.in_([chaves[nome] for nome in nomes]))
+                .values(situacao=situacao, xml_comprimido=None, erro=None)
+            )
+
+def _registrar_falha(arquivo_id, erro, definitiva=False):
+    """Conta a tentativa do arquivo; na última (ou em erro definitivo) ele vai para a quarentena."""
+    with session_scope() as session:
+        arquivo = session.get(ArquivoFila, arquivo_id)
+        arquivo.tentativas += 1
+        arquivo.erro = f"{type(erro).__name__}: {erro}"
+        if definitiva or arquivo.tentativas >= MAX_TENTATIVAS:
+            arquivo.situacao = ARQUIVO_QUARENTENA
+
+def processar_parte(parte_id):
+    """
+    Processa os arquivos pendentes da parte. Primeiro tenta a parte inteira em uma transação; se ela
+    falhar, cada arquivo é gravado na sua própria transação, e só os que falharem contam tentativa.
+    A parte fica concluída quando não restam arquivos pendentes; senão volta para a fila.
+    Retorna a quantidade de arquivos processados com sucesso (gravados ou duplicados).
+    """
+    with session_scope() as session:
+        parte = session.get(ParteFila, parte_id)
+        cliente = session.get(LoteFila, parte.lote_id).cliente
+        esgotada = parte.tentativas > MAX_TENTATIVAS
+        pendentes = session.execute(
+            select(ArquivoFila.id, ArquivoFila.nome, ArquivoFila.xml_comprimido)
+            .where(ArquivoFila.parte_id == parte_id, ArquivoFila.situacao == PENDENTE)
+            .order_by(ArquivoFila.id)
+        ).all()
+        if esgotada:
+            # A parte derrubou o trabalhador várias vezes: o que resta vai para a quarentena
+            session.execute(
+                update(ArquivoFila.__table__)
+                .where(ArquivoFila.parte_id == parte_id, ArquivoFila.situacao == PENDENTE)
+                .values(situacao=ARQUIVO_QUARENTENA, erro="Parte abandonada após o número máximo de tentativas.")
+            )
+            pendentes = []
+
+    arquivos, processados = [], 0  # XML malformado é erro definitivo; os demais erros contam tentativa
+    for arquivo_id, nome, xml_comprimido in pendentes:
+        xml_content = descomprimir_xml(xml_comprimido)
+        try:
+            _validar_xml(xml_content)
+        except ET.ParseError as e:
+            _registrar_falha(arquivo_id, e, definitiva=True)
+            continue
+        arquivos.append((arquivo_id, nome, xml_content))
+
+    try:
+        with session_scope() as session:
+            _gravar_arquivos(session, cliente, arquivos)
+        processados = len(arquivos)
+    except Exception as e:
+        # Sem o caminho em massa a parte fica bem mais lenta: o motivo precisa aparecer
+        print(f"Parte {parte_id}: gravação em lote falhou ({type(e).__name__}: {e}); gravando arquivo por arquivo.")
+        for arquivo in arquivos:
+            try:
+                with session_scope() as session:
+                    _gravar_arquivos(session, cliente, [arquivo])
+                processados += 1
+            except Exception as e:
+                _registrar_falha(arquivo[0], e)
+
+    with session_scope() as session:
+        restantes = session.query(func.count(ArquivoFila.id)).filter(
+            ArquivoFila.parte_id == parte_id, ArquivoFila.situacao == PENDENTE).scalar()
+        parte = session.get(ParteFila, parte_id)
+        parte.situacao = PENDENTE if restantes else CONCLUIDA
+        parte.reivindicada_em = None
+    return processados
+
+def executar_trabalhador(lote_id=None, trabalhador=None, progresso=None):
+    """
+    Reivindica e processa partes até a fila (ou o lote informado) esvaziar.
+    progresso(lote_id), se informado, é chamado após cada parte. Retorna a quantidade de partes processadas.
+    """
+    partes = 0
+    while True:
+        parte_id = reivindicar_parte(trabalhador, lote_id)
+        if parte_id is None:
+            return partes
+        processar_parte(parte_id)
+        partes += 1
+        if progresso is not None:
+            progresso(lote_id)
+
+
+# ====== CONSULTAS ======
+def situacao_lote(lote_id):
+    """Contagem dos arquivos do lote por situação (pendente, ok, duplicado, quarentena)."""
+    with session_scope() as session:
+        contagem = dict(
+            session.query(ArquivoFila.situacao, func.count(ArquivoFila.id))
+            .filter(ArquivoFila.lote_id == lote_id)
+            .group_by(ArquivoFila.situacao)
+            .all()
+        )
+    return {situacao: contagem.get(situacao, 0) for situacao in (PENDENTE, ARQUIVO_OK, ARQUIVO_DUPLICADO, ARQUIVO_QUARENTENA)}
+
+def lotes_incompletos():
+    """Lotes com arquivos ainda pendentes: lista de (id, cliente, criado_em, total_arquivos, pendentes)."""
+    with session_scope() as session:
+        return (
+            session.query(LoteFila.id, LoteFila.cliente, LoteFila.criado_em, LoteFila.total_arquivos, func.count(ArquivoFila.id))
+            .join(ArquivoFila, ArquivoFila.lote_id == LoteFila.id)
+            .filter(ArquivoFila.situacao == PENDENTE)
+            .group_by(LoteFila.id)
+            .order_by(LoteFila.id)
+            .all()
+        )
+
+def arquivos_em_quarentena(lote_id):
+    """Arquivos do lote em quarentena: lista de (id, nome, tentativas, erro)."""
+    with session_scope() as session:
+        return (
+            session.query(ArquivoFila.id, ArquivoFila.nome, ArquivoFila.tentativas, ArquivoFila.erro)
+            .filter(ArquivoFila.lote_id == lote_id, ArquivoFila.situacao == ARQUIVO_QUARENTENA)
+            .order_by(ArquivoFila.id)
+            .all()
+        )
+
+def reenfileirar_quarentena(lote_id):
+    """Devolve à fila os arquivos em quarentena do lote (ex.: depois de corrigir a causa). Retorna a quantidade."""
+    with session_scope() as session:
+        partes = [parte_id for (parte_id,) in session.query(ArquivoFila.parte_id).filter(
+            ArquivoFila.lote_id == lote_id, ArquivoFila.situacao == ARQUIVO_QUARENTENA).distinct()]
+        quantidade = session.execute(
+            update(ArquivoFila.__table__)
+            .where(ArquivoFila.lote_id == lote_id, ArquivoFila.situacao == ARQUIVO_QUARENTENA, ArquivoFila.xml_comprimido.isnot(None))
+            .values(situacao=PENDENTE, tentativas=0, erro=None)
+        ).rowcount
+        if partes:
+            session.execute(
+                update(ParteFila.__table__).where(ParteFila.id.in_(partes)).values(situacao=PENDENTE, tentativas=0)
+            )
+        return quantidade
+
+
+def _iniciar_processo():
+    """Inicializador dos processos trabalhadores: não reaproveita as conexões herdadas do processo pai."""
+    engine.dispose(close=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Processa a fila de lotes de NFS-e (retoma lotes interrompidos).")
+    parser.add_argument("--processos", type=int, default=1, help="Trabalhadores em paralelo (um processo cada).")
+    parser.add_argument("--lote", type=int, default=None, help="Processa só o lote informado.")
+    args = parser.parse_args()
+
+    if args.processos == 1:
+        partes = executar_trabalhador(args.lote)
+    else:
+        with multiprocessing.Pool(args.processos, initializer=_iniciar_processo) as pool:
+            partes = sum(pool.map(executar_trabalhador, [args.lote] * args.processos))
+    print(f"{partes} partes processadas.")
@@ -4,6 +4,11 @@ import xml.etree.ElementTree as ET
 import re
 import numpy as np
 import os # Importado para usar os.path.basename em mensagens de log
+import zipfile
+
+# Depuração do layout GISS (valores extraídos de cada XML impressos no console). Desligada por padrão
+# para não poluir o serviço (nfse_api) e os lotes; ative com NFSE_DEBUG_PARSER=1.
+DEBUG_GISS = os.environ.get("NFSE_DEBUG_PARSER") == "1"
 
 # A default dictionary to ensure all expected keys are always present
 # This helps maintain a consistent DataFrame structure even if some fields are missing in an XML
@@ -62,6 +67,48 @@ _DEFAULT_NFSE_DATA = {
     'IsCancelled': 'Não' # NOVO CAMPO: Assume não cancelada por padrão
 }
 
+# --- Projeção de campos ---
+# Cada campo pertence a um grupo (uma sub-árvore do XML). Com uma projeção, o parser só percorre
+# os grupos dos campos pedidos e devolve só esses campos.
+_GRUPOS_CAMPOS = {
+    'geral': ['Nfse.Id', 'Numero', 'CodigoVerificacao', 'DataEmissao', 'NaturezaOperacao',
+              'RegimeEspecialTributacao', 'OptanteSimplesNacional', 'IncentivadorCultural'],
+    'servico': ['DescricaoServico', 'ItemListaServico', 'CodigoTributacaoMunicipio', 'CodigoMunicipioServico'],
+    'valores': ['ValorServicos', 'ValorDeducoes', 'ValorPis', 'ValorCofins', 'ValorInss', 'ValorIr', 'ValorCsll',
+                'IssRetido', 'ValorIss', 'ValorIssRetido', 'OutrasRetencoes', 'BaseCalculo', 'Aliquota',
+                'ValorLiquidoNfse', 'DescontoIncondicionado', 'DescontoCondicionado'],
+    'prestador': ['Prestador.CpfCnpj', 'Prestador.InscricaoMunicipal', 'Prestador.RazaoSocial'],
+    'prestador_endereco': [key for key in _DEFAULT_NFSE_DATA if key.startswith('Prestador.Endereco.')],
+    'prestador_contato': [key for key in _DEFAULT_NFSE_DATA if key.startswith('Prestador.Contato.')],
+    'tomador': ['TomadorServico.CpfCnpj', 'TomadorServico.RazaoSocial'],
+    'tomador_endereco': [key for key in _DEFAULT_NFSE_DATA if key.startswith('TomadorServico.Endereco.')],
+    'tomador_contato': [key for key in _DEFAULT_NFSE_DATA if key.startswith('TomadorServico.Contato.')],
+    'orgao_gerador': ['OrgaoGerador.CodigoMunicipio', 'OrgaoGerador.Uf'],
+    'cancelamento': ['IsCancelled'],  # O cancelamento é sempre verificado (zera os valores)
+}
+_GRUPO_DO_CAMPO = {campo: grupo for grupo, campos in _GRUPOS_CAMPOS.items() for campo in campos}
+
+# Projeções prontas para os trabalhos mais comuns
+PROJECOES = {
+    # Análise de sequência (detect_sequence_issues)
+    'sequencia': ('Nfse.Id', 'Numero', 'CodigoVerificacao', 'DataEmissao', 'Prestador.CpfCnpj', 'Prestador.RazaoSocial', 'IsCancelled'),
+    # Totais de faturamento e retenções (painel de impostos)
+    'totais': ('Nfse.Id', 'Numero', 'CodigoVerificacao', 'DataEmissao', 'Prestador.CpfCnpj', 'IsCancelled',
+               *_GRUPOS_CAMPOS['valores']),
+}
+
+def _grupos_da_projecao(campos):
+    """Grupos a percorrer para os campos pedidos (None = todos). Campo desconhecido gera ValueError."""
+    if campos is None:
+        return None
+    desconhecidos = [campo for campo in campos if campo not in _GRUPO_DO_CAMPO]
+    if desconhecidos:
+        raise ValueError(f"Campos desconhecidos na projeção: {', '.join(desconhecidos)}")
+    return {_GRUPO_DO_CAMPO[campo] for campo in campos}
+
+def _projetar(data, campos):
+    return data if campos is None else {campo: data[campo] for campo in campos}
+
 # --- Funções Auxiliares para Extração de XML ---
 def _get_text_or_none(element, xpath, namespaces=None):
     """Extrai o texto de um elemento XML usando XPath, ou None se não encontrado."""
@@ -83,10 +130,20 @@ def _clean_cnpj_cpf(cnpj_cpf_str):
         return re.sub(r'[^0-9]', '', str(cnpj_cpf_str))
     return None
 
+def _source_name(xml_source):
+    """Nome do XML para mensagens de log: o nome do arquivo, ou o atributo 'name' de objetos em memória."""
+    if isinstance(xml_source, (str, bytes, os.PathLike)):
+        return os.path.basename(xml_source)
+    return getattr(xml_source, 'name', None) or '<XML em memória>'
+
 # --- Parser Específico para o Novo Layout GISS ---
-def _parse_giss_nfse(root):
-    """Extrai dados de NFSe no layout GISS (com namespace ns2)."""
+def _parse_giss_nfse(root, grupos=None):
+    """
+    Extrai dados de NFSe no layout GISS (com namespace ns2).
+    grupos: grupos de campos a extrair (ver _GRUPOS_CAMPOS); None extrai todos. Com DEBUG_GISS, imprime os valores extraídos.
+    """
     data = _DEFAULT_NFSE_DATA.copy() # Inicia com todas as chaves padrão
+    precisa = lambda grupo: grupos is None or grupo in grupos
     
     # Define os namespaces para o XML GISS
     ns_giss = {'ns2': 'http://www.giss.com.br/tipos-v2_04.xsd', 'ns3': 'http://www.w3.org/2000/09/xmldsig#'}
@@ -94,143 +151,159 @@ def _parse_giss_nfse(root):
     # Busca pelos elementos principais
     inf_nfse = root.find('.//ns2:InfNfse', ns_giss)
     declaracao_prestacao_servico = root.find('.//ns2:DeclaracaoPrestacaoServico/ns2:InfDeclaracaoPrestacaoServico', ns_giss)
-    servico_values = root.find('.//ns2:DeclaracaoPrestacaoServico/ns2:InfDeclaracaoPrestacaoServico/ns2:Servico/ns2:Valores', ns_giss)
+    servico_values = root.find('.//ns2:DeclaracaoPrestacaoServico/ns2:InfDeclaracaoPrestacaoServico/ns2:Servico/ns2:Valores', ns_giss) if precisa('valores') else None
 
-    print(f"DEBUG GISS: inf_nfse found: {inf_nfse is not None}")
-    print(f"DEBUG GISS: declaracao_prestacao_servico found: {declaracao_prestacao_servico is not None}")
-    print(f"DEBUG GISS: servico_values found: {servico_values is not None}")
+    if DEBUG_GISS:
+        print(f"DEBUG GISS: inf_nfse found: {inf_nfse is not None}")
+        print(f"DEBUG GISS: declaracao_prestacao_servico found: {declaracao_prestacao_servico is not None}")
+        print(f"DEBUG GISS: servico_values found: {servico_values is not None}")
 
     # NFSe Geral
-    data['Nfse.Id'] = _get_attr_or_none(inf_nfse, '.', 'Id', ns_giss)
-    data['Numero'] = _get_text_or_none(inf_nfse, 'ns2:Numero', ns_giss)
-    data['CodigoVerificacao'] = _get_text_or_none(inf_nfse, 'ns2:CodigoVerificacao', ns_giss)
-    data['DataEmissao'] = _get_text_or_none(inf_nfse, 'ns2:DataEmissao', ns_giss)
-    data['OptanteSimplesNacional'] = _get_text_or_none(declaracao_prestacao_servico, 'ns2:OptanteSimplesNacional', ns_giss)
-    data['IncentivadorCultural'] = _get_text_or_none(declaracao_prestacao_servico, 'ns2:IncentivoFiscal', ns_giss)
+    if precisa('geral'):
+        data['Nfse.Id'] = _get_attr_or_none(inf_nfse, '.', 'Id', ns_giss)
+        data['Numero'] = _get_text_or_none(inf_nfse, 'ns2:Numero', ns_giss)
+        data['CodigoVerificacao'] = _get_text_or_none(inf_nfse, 'ns2:CodigoVerificacao', ns_giss)
+        data['DataEmissao'] = _get_text_or_none(inf_nfse, 'ns2:DataEmissao', ns_giss)
+        data['OptanteSimplesNacional'] = _get_text_or_none(declaracao_prestacao_servico, 'ns2:OptanteSimplesNacional', ns_giss)
+        data['IncentivadorCultural'] = _get_text_or_none(declaracao_prestacao_servico, 'ns2:IncentivoFiscal', ns_giss)
 
     # Serviço
-    data['DescricaoServico'] = _get_text_or_none(declaracao_prestacao_servico, 'ns2:Servico/ns2:Discriminacao', ns_giss)
-    data['ItemListaServico'] = _get_text_or_none(declaracao_prestacao_servico, 'ns2:Servico/ns2:ItemListaServico', ns_giss)
-    data['CodigoTributacaoMunicipio'] = _get_text_or_none(declaracao_prestacao_servico, 'ns2:Servico/ns2:CodigoTributacaoMunicipio', ns_giss)
-    data['CodigoMunicipioServico'] = _get_text_or_none(declaracao_prestacao_servico, 'ns2:Servico/ns2:CodigoMunicipio', ns_giss)
+    if precisa('servico'):
+        data['DescricaoServico'] = _get_text_or_none(declaracao_prestacao_servico, 'ns2:Servico/ns2:Discriminacao', ns_giss)
+        data['ItemListaServico'] = _get_text_or_none(declaracao_prestacao_servico, 'ns2:Servico/ns2:ItemListaServico', ns_giss)
+        data['CodigoTributacaoMunicipio'] = _get_text_or_none(declaracao_prestacao_servico, 'ns2:Servico/ns2:CodigoTributacaoMunicipio', ns_giss)
+        data['CodigoMunicipioServico'] = _get_text_or_none(declaracao_prestacao_servico, 'ns2:Servico/ns2:CodigoMunicipio', ns_giss)
 
     # Valores do Serviço (priorizando os valores detalhados de DeclaracaoPrestacaoServico/Servico/Valores)
-    data['ValorServicos'] = _get_text_or_none(servico_values, 'ns2:ValorServicos', ns_giss)
-    data['ValorDeducoes'] = _get_text_or_none(servico_values, 'ns2:ValorDeducoes', ns_giss)
-    data['ValorPis'] = _get_text_or_none(servico_values, 'ns2:ValorPis', ns_giss)
-    data['ValorCofins'] = _get_text_or_none(servico_values, 'ns2:ValorCofins', ns_giss)
-    data['ValorInss'] = _get_text_or_none(servico_values, 'ns2:ValorInss', ns_giss)
-    data['ValorIr'] = _get_text_or_none(servico_values, 'ns2:ValorIr', ns_giss)
-    data['ValorCsll'] = _get_text_or_none(servico_values, 'ns2:ValorCsll', ns_giss)
+    if precisa('valores'):
+        data['ValorServicos'] = _get_text_or_none(servico_values, 'ns2:ValorServicos', ns_giss)
+        data['ValorDeducoes'] = _get_text_or_none(servico_values, 'ns2:ValorDeducoes', ns_giss)
+        data['ValorPis'] = _get_text_or_none(servico_values, 'ns2:ValorPis', ns_giss)
+        data['ValorCofins'] = _get_text_or_none(servico_values, 'ns2:ValorCofins', ns_giss)
+        data['ValorInss'] = _get_text_or_none(servico_values, 'ns2:ValorInss', ns_giss)
+        data['ValorIr'] = _get_text_or_none(servico_values, 'ns2:ValorIr', ns_giss)
+        data['ValorCsll'] = _get_text_or_none(servico_values, 'ns2:ValorCsll', ns_giss)
     
-    iss_retido_code = _get_text_or_none(declaracao_prestacao_servico, 'ns2:Servico/ns2:IssRetido', ns_giss)
-    data['IssRetido'] = iss_retido_code # Código 1=Sim, 2=Não
+        iss_retido_code = _get_text_or_none(declaracao_prestacao_servico, 'ns2:Servico/ns2:IssRetido', ns_giss)
+        data['IssRetido'] = iss_retido_code # Código 1=Sim, 2=Não
     
-    valor_iss_from_service = _get_text_or_none(servico_values, 'ns2:ValorIss', ns_giss)
-    data['ValorIss'] = valor_iss_from_service
+        valor_iss_from_service = _get_text_or_none(servico_values, 'ns2:ValorIss', ns_giss)
+        data['ValorIss'] = valor_iss_from_service
     
-    data['ValorIssRetido'] = valor_iss_from_service if iss_retido_code == '1' else '0.0' 
+        data['ValorIssRetido'] = valor_iss_from_service if iss_retido_code == '1' else '0.0' 
 
-    data['OutrasRetencoes'] = _get_text_or_none(servico_values, 'ns2:OutrasRetencoes', ns_giss)
+        data['OutrasRetencoes'] = _get_text_or_none(servico_values, 'ns2:OutrasRetencoes', ns_giss)
     
-    # BaseCalculo está em ns2:InfNfse/ns2:ValoresNfse/ns2:BaseCalculo
-    base_calculo_infnfse = _get_text_or_none(inf_nfse, 'ns2:ValoresNfse/ns2:BaseCalculo', ns_giss)
-    # Aliquota também aparece em ns2:InfNfse/ns2:ValoresNfse/ns2:Aliquota
-    aliquota_infnfse = _get_text_or_none(inf_nfse, 'ns2:ValoresNfse/ns2:Aliquota', ns_giss)
-
-    # Usar a base de cálculo da NFSe se a do serviço não estiver presente (ou vice-versa)
-    # Neste XML, BaseCalculo está em inf_nfse/ValoresNfse
-    data['BaseCalculo'] = base_calculo_infnfse
+        # BaseCalculo está em ns2:InfNfse/ns2:ValoresNfse/ns2:BaseCalculo
+        base_calculo_infnfse = _get_text_or_none(inf_nfse, 'ns2:ValoresNfse/ns2:BaseCalculo', ns_giss)
+        # Aliquota também aparece em ns2:InfNfse/ns2:ValoresNfse/ns2:Aliquota
+        aliquota_infnfse = _get_text_or_none(inf_nfse, 'ns2:ValoresNfse/ns2:Aliquota', ns_giss)
+
+        # Usar a base de cálculo da NFSe se a do serviço não estiver presente (ou vice-versa)
+        # Neste XML, BaseCalculo está em inf_nfse/ValoresNfse
+        data['BaseCalculo'] = base_calculo_infnfse
     
-    # Priorizar Alíquota do serviço, mas usar a da NFSe como fallback
-    data['Aliquota'] = _get_text_or_none(servico_values, 'ns2:Aliquota', ns_giss)
-    if not data['Aliquota'] and aliquota_infnfse:
-        data['Aliquota'] = aliquota_infnfse
+        # Priorizar Alíquota do serviço, mas usar a da NFSe como fallback
+        data['Aliquota'] = _get_text_or_none(servico_values, 'ns2:Aliquota', ns_giss)
+        if not data['Aliquota'] and aliquota_infnfse:
+            data['Aliquota'] = aliquota_infnfse
 
-    data['ValorLiquidoNfse'] = _get_text_or_none(inf_nfse, 'ns2:ValoresNfse/ns2:ValorLiquidoNfse', ns_giss)
-    data['DescontoIncondicionado'] = _get_text_or_none(servico_values, 'ns2:DescontoIncondicionado', ns_giss)
-    data['DescontoCondicionado'] = _get_text_or_none(servico_values, 'ns2:DescontoCondicionado', ns_giss)
+        data['ValorLiquidoNfse'] = _get_text_or_none(inf_nfse, 'ns2:ValoresNfse/ns2:ValorLiquidoNfse', ns_giss)
+        data['DescontoIncondicionado'] = _get_text_or_none(servico_values, 'ns2:DescontoIncondicionado', ns_giss)
+        data['DescontoCondicionado'] = _get_text_or_none(servico_values, 'ns2:DescontoCondicionado', ns_giss)
 
     # Prestador
     # O elemento Prestador está sob InfDeclaracaoPrestacaoServico
-    prestador_info_from_declaracao = declaracao_prestacao_servico.find('ns2:Prestador', ns_giss)
+    prestador_info_from_declaracao = declaracao_prestacao_servico.find('ns2:Prestador', ns_giss) if precisa('prestador') else None
     # PrestadorServico (que contém Endereço e Contato) está sob InfNfse
-    prestador_servico_info = inf_nfse.find('ns2:PrestadorServico', ns_giss)
-
-    prestador_cnpj_cpf_node = prestador_info_from_declaracao.find('ns2:CpfCnpj', ns_giss) if prestador_info_from_declaracao else None
-    cnpj_prestador = _get_text_or_none(prestador_cnpj_cpf_node, 'ns2:Cnpj', ns_giss)
-    cpf_prestador = _get_text_or_none(prestador_cnpj_cpf_node, 'ns2:Cpf', ns_giss)
-    data['Prestador.CpfCnpj'] = _clean_cnpj_cpf(cnpj_prestador if cnpj_prestador else cpf_prestador)
-
-    data['Prestador.InscricaoMunicipal'] = _get_text_or_none(prestador_info_from_declaracao, 'ns2:InscricaoMunicipal', ns_giss)
-    data['Prestador.RazaoSocial'] = _get_text_or_none(prestador_servico_info, 'ns2:RazaoSocial', ns_giss)
+    prestador_servico_info = inf_nfse.find('ns2:PrestadorServico', ns_giss) if (
+        precisa('prestador') or precisa('prestador_endereco') or precisa('prestador_contato')
+    ) else None
+
+    if precisa('prestador'):
+        prestador_cnpj_cpf_node = prestador_info_from_declaracao.find('ns2:CpfCnpj', ns_giss) if prestador_info_from_declaracao is not None else None
+        cnpj_prestador = _get_text_or_none(prestador_cnpj_cpf_node, 'ns2:Cnpj', ns_giss)
+        cpf_prestador = _get_text_or_none(prestador_cnpj_cpf_node, 'ns2:Cpf', ns_giss)
+        data['Prestador.CpfCnpj'] = _clean_cnpj_cpf(cnpj_prestador if cnpj_prestador else cpf_prestador)
+
+        data['Prestador.InscricaoMunicipal'] = _get_text_or_none(prestador_info_from_declaracao, 'ns2:InscricaoMunicipal', ns_giss)
+        data['Prestador.RazaoSocial'] = _get_text_or_none(prestador_servico_info, 'ns2:RazaoSocial', ns_giss)
     
-    prestador_endereco_elem = prestador_servico_info.find('ns2:Endereco', ns_giss) if prestador_servico_info else None
-    data['Prestador.Endereco.Logradouro'] = _get_text_or_none(prestador_endereco_elem, 'ns2:Endereco', ns_giss)
-    data['Prestador.Endereco.Numero'] = _get_text_or_none(prestador_endereco_elem, 'ns2:Numero', ns_giss)
-    data['Prestador.Endereco.Complemento'] = _get_text_or_none(prestador_endereco_elem, 'ns2:Complemento', ns_giss)
-    data['Prestador.Endereco.Bairro'] = _get_text_or_none(prestador_endereco_elem, 'ns2:Bairro', ns_giss)
-    data['Prestador.Endereco.CodigoMunicipio'] = _get_text_or_none(prestador_endereco_elem, 'ns2:CodigoMunicipio', ns_giss)
-    data['Prestador.Endereco.Uf'] = _get_text_or_none(prestador_endereco_elem, 'ns2:Uf', ns_giss)
-    data['Prestador.Endereco.Cep'] = _get_text_or_none(prestador_endereco_elem, 'ns2:Cep', ns_giss)
+    if precisa('prestador_endereco'):
+        prestador_endereco_elem = prestador_servico_info.find('ns2:Endereco', ns_giss) if prestador_servico_info is not None else None
+        data['Prestador.Endereco.Logradouro'] = _get_text_or_none(prestador_endereco_elem, 'ns2:Endereco', ns_giss)
+        data['Prestador.Endereco.Numero'] = _get_text_or_none(prestador_endereco_elem, 'ns2:Numero', ns_giss)
+        data['Prestador.Endereco.Complemento'] = _get_text_or_none(prestador_endereco_elem, 'ns2:Complemento', ns_giss)
+        data['Prestador.Endereco.Bairro'] = _get_text_or_none(prestador_endereco_elem, 'ns2:Bairro', ns_giss)
+        data['Prestador.Endereco.CodigoMunicipio'] = _get_text_or_none(prestador_endereco_elem, 'ns2:CodigoMunicipio', ns_giss)
+        data['Prestador.Endereco.Uf'] = _get_text_or_none(prestador_endereco_elem, 'ns2:Uf', ns_giss)
+        data['Prestador.Endereco.Cep'] = _get_text_or_none(prestador_endereco_elem, 'ns2:Cep', ns_giss)
     
-    prestador_contato_elem = prestador_servico_info.find('ns2:Contato', ns_giss) if prestador_servico_info else None
-    data['Prestador.Contato.Telefone'] = _get_text_or_none(prestador_contato_elem, 'ns2:Telefone', ns_giss)
-    data['Prestador.Contato.Email'] = _get_text_or_none(prestador_contato_elem, 'ns2:Email', ns_giss)
+    if precisa('prestador_contato'):
+        prestador_contato_elem = prestador_servico_info.find('ns2:Contato', ns_giss) if prestador_servico_info is not None else None
+        data['Prestador.Contato.Telefone'] = _get_text_or_none(prestador_contato_elem, 'ns2:Telefone', ns_giss)
+        data['Prestador.Contato.Email'] = _get_text_or_none(prestador_contato_elem, 'ns2:Email', ns_giss)
 
     # Tomador
     # O elemento TomadorServico está sob InfDeclaracaoPrestacaoServico
-    tomador_servico_info = declaracao_prestacao_servico.find('ns2:TomadorServico', ns_giss)
+    tomador_servico_info = declaracao_prestacao_servico.find('ns2:TomadorServico', ns_giss) if (
+        precisa('tomador') or precisa('tomador_endereco') or precisa('tomador_contato')
+    ) else None
     
-    tomador_cnpj_cpf_node = tomador_servico_info.find('ns2:IdentificacaoTomador/ns2:CpfCnpj', ns_giss) if tomador_servico_info else None
-    cnpj_tomador = _get_text_or_none(tomador_cnpj_cpf_node, 'ns2:Cnpj', ns_giss)
-    cpf_tomador = _get_text_or_none(tomador_cnpj_cpf_node, 'ns2:Cpf', ns_giss)
-    data['TomadorServico.CpfCnpj'] = _clean_cnpj_cpf(cnpj_tomador if cnpj_tomador else cpf_tomador)
+    if precisa('tomador'):
+        tomador_cnpj_cpf_node = tomador_servico_info.find('ns2:IdentificacaoTomador/ns2:CpfCnpj', ns_giss) if tomador_servico_info is not None else None
+        cnpj_tomador = _get_text_or_none(tomador_cnpj_cpf_node, 'ns2:Cnpj', ns_giss)
+        cpf_tomador = _get_text_or_none(tomador_cnpj_cpf_node, 'ns2:Cpf', ns_giss)
+        data['TomadorServico.CpfCnpj'] = _clean_cnpj_cpf(cnpj_tomador if cnpj_tomador else cpf_tomador)
 
-    data['TomadorServico.RazaoSocial'] = _get_text_or_none(tomador_servico_info, 'ns2:RazaoSocial', ns_giss)
+        data['TomadorServico.RazaoSocial'] = _get_text_or_none(tomador_servico_info, 'ns2:RazaoSocial', ns_giss)
     
-    tomador_endereco_elem = tomador_servico_info.find('ns2:Endereco', ns_giss) if tomador_servico_info else None
-    data['TomadorServico.Endereco.Logradouro'] = _get_text_or_none(tomador_endereco_elem, 'ns2:Endereco', ns_giss)
-    data['TomadorServico.Endereco.Numero'] = _get_text_or_none(tomador_endereco_elem, 'ns2:Numero', ns_giss)
-    data['TomadorServico.Endereco.Bairro'] = _get_text_or_none(tomador_endereco_elem, 'ns2:Bairro', ns_giss)
-    data['TomadorServico.Endereco.CodigoMunicipio'] = _get_text_or_none(tomador_endereco_elem, 'ns2:CodigoMunicipio', ns_giss)
-    data['TomadorServico.Endereco.Uf'] = _get_text_or_none(tomador_endereco_elem, 'ns2:Uf', ns_giss)
-    data['TomadorServico.Endereco.Cep'] = _get_text_or_none(tomador_endereco_elem, 'ns2:Cep', ns_giss)
+    if precisa('tomador_endereco'):
+        tomador_endereco_elem = tomador_servico_info.find('ns2:Endereco', ns_giss) if tomador_servico_info is not None else None
+        data['TomadorServico.Endereco.Logradouro'] = _get_text_or_none(tomador_endereco_elem, 'ns2:Endereco', ns_giss)
+        data['TomadorServico.Endereco.Numero'] = _get_text_or_none(tomador_endereco_elem, 'ns2:Numero', ns_giss)
+        data['TomadorServico.Endereco.Bairro'] = _get_text_or_none(tomador_endereco_elem, 'ns2:Bairro', ns_giss)
+        data['TomadorServico.Endereco.CodigoMunicipio'] = _get_text_or_none(tomador_endereco_elem, 'ns2:CodigoMunicipio', ns_giss)
+        data['TomadorServico.Endereco.Uf'] = _get_text_or_none(tomador_endereco_elem, 'ns2:Uf', ns_giss)
+        data['TomadorServico.Endereco.Cep'] = _get_text_or_none(tomador_endereco_elem, 'ns2:Cep', ns_giss)
     
-    tomador_contato_elem = tomador_servico_info.find('ns2:Contato', ns_giss) if tomador_servico_info else None
-    data['TomadorServico.Contato.Telefone'] = _get_text_or_none(tomador_contato_elem, 'ns2:Telefone', ns_giss)
+    if precisa('tomador_contato'):
+        tomador_contato_elem = tomador_servico_info.find('ns2:Contato', ns_giss) if tomador_servico_info is not None else None
+        data['TomadorServico.Contato.Telefone'] = _get_text_or_none(tomador_contato_elem, 'ns2:Telefone', ns_giss)
 
     # Órgão Gerador
-    orgao_gerador_info = inf_nfse.find('ns2:OrgaoGerador', ns_giss)
-    data['OrgaoGerador.CodigoMunicipio'] = _get_text_or_none(orgao_gerador_info, 'ns2:CodigoMunicipio', ns_giss)
-    data['OrgaoGerador.Uf'] = _get_text_or_none(orgao_gerador_info, 'ns2:Uf', ns_giss)
+    if precisa('orgao_gerador'):
+        orgao_gerador_info = inf_nfse.find('ns2:OrgaoGerador', ns_giss)
+        data['OrgaoGerador.CodigoMunicipio'] = _get_text_or_none(orgao_gerador_info, 'ns2:CodigoMunicipio', ns_giss)
+        data['OrgaoGerador.Uf'] = _get_text_or_none(orgao_gerador_info, 'ns2:Uf', ns_giss)
 
 
     # --- Adicionado para depuração ---
-    print("\nDEBUG GISS EXTRACTED VALUES (AFTER CORRECTION):")
-    print(f"  Nfse.Id: {data['Nfse.Id']}")
-    print(f"  Numero: {data['Numero']}")
-    print(f"  DataEmissao: {data['DataEmissao']}")
-    print(f"  OptanteSimplesNacional: {data['OptanteSimplesNacional']}")
-    print(f"  ValorServicos: {data['ValorServicos']}")
-    print(f"  ValorDeducoes: {data['ValorDeducoes']}")
-    print(f"  ValorPis: {data['ValorPis']}")
-    print(f"  ValorCofins: {data['ValorCofins']}")
-    print(f"  ValorInss: {data['ValorInss']}")
-    print(f"  ValorIr: {data['ValorIr']}")
-    print(f"  ValorCsll: {data['ValorCsll']}")
-    print(f"  IssRetido (code): {data['IssRetido']}")
-    print(f"  ValorIss: {data['ValorIss']}")
-    print(f"  ValorIssRetido: {data['ValorIssRetido']}")
-    print(f"  BaseCalculo: {data['BaseCalculo']}")
-    print(f"  Aliquota: {data['Aliquota']}")
-    print(f"  ValorLiquidoNfse: {data['ValorLiquidoNfse']}")
-    print(f"  DescontoIncondicionado: {data['DescontoIncondicionado']}")
-    print(f"  DescontoCondicionado: {data['DescontoCondicionado']}")
-    print(f"  Prestador.CpfCnpj: {data['Prestador.CpfCnpj']}")
-    print(f"  Prestador.RazaoSocial: {data['Prestador.RazaoSocial']}")
-    print(f"  TomadorServico.CpfCnpj: {data['TomadorServico.CpfCnpj']}")
-    print(f"  TomadorServico.RazaoSocial: {data['TomadorServico.RazaoSocial']}")
+    if DEBUG_GISS:
+        print("\nDEBUG GISS EXTRACTED VALUES (AFTER CORRECTION):")
+        print(f"  Nfse.Id: {data['Nfse.Id']}")
+        print(f"  Numero: {data['Numero']}")
+        print(f"  DataEmissao: {data['DataEmissao']}")
+        print(f"  OptanteSimplesNacional: {data['OptanteSimplesNacional']}")
+        print(f"  ValorServicos: {data['ValorServicos']}")
+        print(f"  ValorDeducoes: {data['ValorDeducoes']}")
+        print(f"  ValorPis: {data['ValorPis']}")
+        print(f"  ValorCofins: {data['ValorCofins']}")
+        print(f"  ValorInss: {data['ValorInss']}")
+        print(f"  ValorIr: {data['ValorIr']}")
+        print(f"  ValorCsll: {data['ValorCsll']}")
+        print(f"  IssRetido (code): {data['IssRetido']}")
+        print(f"  ValorIss: {data['ValorIss']}")
+        print(f"  ValorIssRetido: {data['ValorIssRetido']}")
+        print(f"  BaseCalculo: {data['BaseCalculo']}")
+        print(f"  Aliquota: {data['Aliquota']}")
+        print(f"  ValorLiquidoNfse: {data['ValorLiquidoNfse']}")
+        print(f"  DescontoIncondicionado: {data['DescontoIncondicionado']}")
+        print(f"  DescontoCondicionado: {data['DescontoCondicionado']}")
+        print(f"  Prestador.CpfCnpj: {data['Prestador.CpfCnpj']}")
+        print(f"  Prestador.RazaoSocial: {data['Prestador.RazaoSocial']}")
+        print(f"  TomadorServico.CpfCnpj: {data['TomadorServico.CpfCnpj']}")
+        print(f"  TomadorServico.RazaoSocial: {data['TomadorServico.RazaoSocial']}")
     # --- Fim dos prints de depuração ---
 
 
@@ -263,12 +336,14 @@ def _parse_giss_nfse(root):
 
 # --- Parser Específico para o Layout GINFES ---
 # ... (manter o código _parse_ginfes_nfse inalterado) ...
-def _parse_ginfes_nfse(root, xml_file_path):
+def _parse_ginfes_nfse(root, xml_file_path, grupos=None):
     """
     Extrai dados de NFSe no layout GINFES, baseado no seu script original,
     assumindo que os elementos internos estão no "empty namespace".
+    grupos: grupos de campos a extrair (ver _GRUPOS_CAMPOS); None extrai todos.
     """
     data = _DEFAULT_NFSE_DATA.copy()
+    precisa = lambda grupo: grupos is None or grupo in grupos
 
     lista_nfse = root.find('ListaNfse')
     if lista_nfse is None:
@@ -287,24 +362,26 @@ def _parse_ginfes_nfse(root, xml_file_path):
         return data
 
     # --- Extração dos Dados a partir de <InfNfse> ---
-    data['Nfse.Id'] = _get_attr_or_none(inf_nfse_element, '.', 'Id')
-    data['Numero'] = _get_text_or_none(inf_nfse_element, 'Numero')
-    data['CodigoVerificacao'] = _get_text_or_none(inf_nfse_element, 'CodigoVerificacao')
-    data['DataEmissao'] = _get_text_or_none(inf_nfse_element, 'DataEmissao')
-    data['NaturezaOperacao'] = _get_text_or_none(inf_nfse_element, 'NaturezaOperacao')
-    data['RegimeEspecialTributacao'] = _get_text_or_none(inf_nfse_element, 'RegimeEspecialTributacao')
-    data['OptanteSimplesNacional'] = _get_text_or_none(inf_nfse_element, 'OptanteSimplesNacional')
-    data['IncentivadorCultural'] = _get_text_or_none(inf_nfse_element, 'IncentivadorCultural')
+    if precisa('geral'):
+        data['Nfse.Id'] = _get_attr_or_none(inf_nfse_element, '.', 'Id')
+        data['Numero'] = _get_text_or_none(inf_nfse_element, 'Numero')
+        data['CodigoVerificacao'] = _get_text_or_none(inf_nfse_element, 'CodigoVerificacao')
+        data['DataEmissao'] = _get_text_or_none(inf_nfse_element, 'DataEmissao')
+        data['NaturezaOperacao'] = _get_text_or_none(inf_nfse_element, 'NaturezaOperacao')
+        data['RegimeEspecialTributacao'] = _get_text_or_none(inf_nfse_element, 'RegimeEspecialTributacao')
+        data['OptanteSimplesNacional'] = _get_text_or_none(inf_nfse_element, 'OptanteSimplesNacional')
+        data['IncentivadorCultural'] = _get_text_or_none(inf_nfse_element, 'IncentivadorCultural')
 
     # Dados do Serviço
-    servico_element = inf_nfse_element.find('Servico')
+    servico_element = inf_nfse_element.find('Servico') if precisa('servico') or precisa('valores') else None
     if servico_element is not None:
-        data['DescricaoServico'] = _get_text_or_none(servico_element, 'Discriminacao')
-        data['ItemListaServico'] = _get_text_or_none(servico_element, 'ItemListaServico')
-        data['CodigoTributacaoMunicipio'] = _get_text_or_none(servico_element, 'CodigoTributacaoMunicipio')
-        data['CodigoMunicipioServico'] = _get_text_or_none(servico_element, 'CodigoMunicipio')
+        if precisa('servico'):
+            data['DescricaoServico'] = _get_text_or_none(servico_element, 'Discriminacao')
+            data['ItemListaServico'] = _get_text_or_none(servico_element, 'ItemListaServico')
+            data['CodigoTributacaoMunicipio'] = _get_text_or_none(servico_element, 'CodigoTributacaoMunicipio')
+            data['CodigoMunicipioServico'] = _get_text_or_none(servico_element, 'CodigoMunicipio')
         
-        valores_servico = servico_element.find('Valores')
+        valores_servico = servico_element.find('Valores') if precisa('valores') else None
         if valores_servico is not None:
             data['ValorServicos'] = _get_text_or_none(valores_servico, 'ValorServicos')
             data['ValorDeducoes'] = _get_text_or_none(valores_servico, 'ValorDeducoes')
@@ -325,18 +402,21 @@ def _parse_ginfes_nfse(root, xml_file_path):
     
 
     # Dados do Prestador de Serviços
-    prestador_element = inf_nfse_element.find('PrestadorServico')
+    prestador_element = inf_nfse_element.find('PrestadorServico') if (
+        precisa('prestador') or precisa('prestador_endereco') or precisa('prestador_contato')
+    ) else None
     if prestador_element is not None:
-        identificacao_prestador = prestador_element.find('IdentificacaoPrestador')
+        identificacao_prestador = prestador_element.find('IdentificacaoPrestador') if precisa('prestador') else None
         if identificacao_prestador is not None:
             cnpj_prestador = _get_text_or_none(identificacao_prestador, 'Cnpj')
             cpf_prestador = _get_text_or_none(identificacao_prestador, 'Cpf')
             data['Prestador.CpfCnpj'] = _clean_cnpj_cpf(cnpj_prestador if cnpj_prestador else cpf_prestador)
             data['Prestador.InscricaoMunicipal'] = _get_text_or_none(identificacao_prestador, 'InscricaoMunicipal')
         
-        data['Prestador.RazaoSocial'] = _get_text_or_none(prestador_element, 'RazaoSocial')
+        if precisa('prestador'):
+            data['Prestador.RazaoSocial'] = _get_text_or_none(prestador_element, 'RazaoSocial')
         
-        endereco_prestador = prestador_element.find('Endereco')
+        endereco_prestador = prestador_element.find('Endereco') if precisa('prestador_endereco') else None
         if endereco_prestador is not None:
             data['Prestador.Endereco.Logradouro'] = _get_text_or_none(endereco_prestador, 'Endereco') # Tag Endereco é o nome da rua
             data['Prestador.Endereco.Numero'] = _get_text_or_none(endereco_prestador, 'Numero')
@@ -346,16 +426,18 @@ def _parse_ginfes_nfse(root, xml_file_path):
             data['Prestador.Endereco.Uf'] = _get_text_or_none(endereco_prestador, 'Uf')
             data['Prestador.Endereco.Cep'] = _get_text_or_none(endereco_prestador, 'Cep')
 
-        contato_prestador = prestador_element.find('Contato')
+        contato_prestador = prestador_element.find('Contato') if precisa('prestador_contato') else None
         if contato_prestador is not None:
             data['Prestador.Contato.Telefone'] = _get_text_or_none(contato_prestador, 'Telefone')
             data['Prestador.Contato.Email'] = _get_text_or_none(contato_prestador, 'Email')
 
 
     # Dados do Tomador de Serviços
-    tomador_element = inf_nfse_element.find('TomadorServico')
+    tomador_element = inf_nfse_element.find('TomadorServico') if (
+        precisa('tomador') or precisa('tomador_endereco') or precisa('tomador_contato')
+    ) else None
     if tomador_element is not None:
-        identificacao_tomador = tomador_element.find('IdentificacaoTomador')
+        identificacao_tomador = tomador_element.find('IdentificacaoTomador') if precisa('tomador') else None
         if identificacao_tomador is not None:
             cpf_cnpj_tomador = identificacao_tomador.find('CpfCnpj')
             if cpf_cnpj_tomador is not None:
@@ -363,9 +445,10 @@ def _parse_ginfes_nfse(root, xml_file_path):
                 cpf_tomador = _get_text_or_none(cpf_cnpj_tomador, 'Cpf')
                 data['TomadorServico.CpfCnpj'] = _clean_cnpj_cpf(cnpj_tomador if cnpj_tomador else cpf_tomador)
             
-        data['TomadorServico.RazaoSocial'] = _get_text_or_none(tomador_element, 'RazaoSocial')
+        if precisa('tomador'):
+            data['TomadorServico.RazaoSocial'] = _get_text_or_none(tomador_element, 'RazaoSocial')
         
-        endereco_tomador = tomador_element.find('Endereco')
+        endereco_tomador = tomador_element.find('Endereco') if precisa('tomador_endereco') else None
         if endereco_tomador is not None:
             data['TomadorServico.Endereco.Logradouro'] = _get_text_or_none(endereco_tomador, 'Endereco')
             data['TomadorServico.Endereco.Numero'] = _get_text_or_none(endereco_tomador, 'Numero')
@@ -374,12 +457,12 @@ def _parse_ginfes_nfse(root, xml_file_path):
             data['TomadorServico.Endereco.Uf'] = _get_text_or_none(endereco_tomador, 'Uf')
             data['TomadorServico.Endereco.Cep'] = _get_text_or_none(endereco_tomador, 'Cep')
 
-        contato_tomador = tomador_element.find('Contato')
+        contato_tomador = tomador_element.find('Contato') if precisa('tomador_contato') else None
         if contato_tomador is not None:
             data['TomadorServico.Contato.Telefone'] = _get_text_or_none(contato_tomador, 'Telefone')
 
     # Dados do Órgão Gerador
-    orgao_gerador_element = inf_nfse_element.find('OrgaoGerador')
+    orgao_gerador_element = inf_nfse_element.find('OrgaoGerador') if precisa('orgao_gerador') else None
     if orgao_gerador_element is not None:
         data['OrgaoGerador.CodigoMunicipio'] = _get_text_or_none(orgao_gerador_element, 'CodigoMunicipio')
         data['OrgaoGerador.Uf'] = _get_text_or_none(orgao_gerador_element, 'Uf')
@@ -408,36 +491,91 @@ def _parse_ginfes_nfse(root, xml_file_path):
     return data
 
 # --- Função principal de extração de dados da NFSe ---
-def extract_nfse_data(xml_file_path):
+def detect_nfse_layout(root):
+    """Detecta o layout do XML pela raiz: 'GISS', 'GINFES' ou None (formato desconhecido)."""
+    # Define o namespace URI para o formato GISS
+    giss_namespace_uri = 'http://www.giss.com.br/tipos-v2_04.xsd'
+
+    # 1. Tenta detectar o formato GISS (verifica a tag raiz e o namespace)
+    if root.tag == '{' + giss_namespace_uri + '}CompNfse':
+        return 'GISS'
+
+    # 2. Tenta detectar o formato GINFES (verifica a presença de 'ListaNfse' na raiz ou em primeiro nível)
+    # Mais robusto para GINFES: verifica tags comuns na raiz ou sub-raízes
+    if root.tag in ['ConsultarNfseResposta', 'GerarNfseResposta', 'PedidoCancelamentoNFSeEnvio'] or root.find('ListaNfse') is not None:
+        return 'GINFES'
+    return None
+
+def extract_nfse_data_from_root(root, xml_file_path, campos=None):
+    """
+    Extrai os dados de um XML já parseado (raiz do ElementTree), detectando o layout.
+    xml_file_path só é usado nas mensagens. Permite reaproveitar a árvore (ex.: na validação).
+    campos: projeção (lista de chaves de _DEFAULT_NFSE_DATA, ou PROJECOES['sequencia'] etc.); só esses
+    campos são extraídos e devolvidos. None (padrão) extrai todos.
+    """
+    grupos = _grupos_da_projecao(campos)
+    layout = detect_nfse_layout(root)
+    if layout == 'GISS':
+        print(f"Detectado formato GISS para {_source_name(xml_file_path)}")
+        return _projetar(_parse_giss_nfse(root, grupos), campos)
+    if layout == 'GINFES':
+        print(f"Detectado formato GINFES para {_source_name(xml_file_path)}")
+        return _projetar(_parse_ginfes_nfse(root, xml_file_path, grupos), campos)
+
+    # 3. Se nenhum formato conhecido for detectado
+    print(f"Formato XML desconhecido ou não suportado para {_source_name(xml_file_path)}")
+    return _projetar(_DEFAULT_NFSE_DATA.copy(), campos) # Retorna dados padrão
+
+def extract_nfse_data(xml_file_path, campos=None):
     """
     Função principal para extrair dados de um arquivo XML de NFSe.
+    Aceita o caminho do arquivo ou um objeto de arquivo (ex.: io.BytesIO com o conteúdo do XML).
     Detecta automaticamente o formato do XML (GISS ou GINFES) e usa o parser apropriado.
+    Com campos (projeção), só os campos pedidos são extraídos e devolvidos: as sub-árvores que
+    não os contêm (endereços, contatos etc.) não são percorridas. Campo desconhecido gera ValueError.
     """
+    _grupos_da_projecao(campos)  # Projeção inválida é erro de quem chama, não do XML
     try:
         tree = ET.parse(xml_file_path)
-        root = tree.getroot()
-
-        # Define o namespace URI para o formato GISS
-        giss_namespace_uri = 'http://www.giss.com.br/tipos-v2_04.xsd'
-        
-        # 1. Tenta detectar o formato GISS (verifica a tag raiz e o namespace)
-        if root.tag == '{' + giss_namespace_uri + '}CompNfse':
-            print(f"Detectado formato GISS para {os.path.basename(xml_file_path)}")
-            return _parse_giss_nfse(root)
-        
-        # 2. Tenta detectar o formato GINFES (verifica a presença de 'ListaNfse' na raiz ou em primeiro nível)
-        # Mais robusto para GINFES: verifica tags comuns na raiz ou sub-raízes
-        if root.tag in ['ConsultarNfseResposta', 'GerarNfseResposta', 'PedidoCancelamentoNFSeEnvio'] or root.find('ListaNfse') is not None:
-            print(f"Detectado formato GINFES para {os.path.basename(xml_file_path)}")
-            return _parse_ginfes_nfse(root, xml_file_path)
-        
-        # 3. Se nenhum formato conhecido for detectado
-        print(f"Formato XML desconhecido ou não suportado para {os.path.basename(xml_file_path)}")
-        return _DEFAULT_NFSE_DATA.copy() # Retorna dados padrão
+        return extract_nfse_data_from_root(tree.getroot(), xml_file_path, campos)
 
     except ET.ParseError as e:
-        print(f"ERRO: Falha ao fazer o parsing do XML '{os.path.basename(xml_file_path)}': {e}")
-        return _DEFAULT_NFSE_DATA.copy() # Retorna dados padrão em caso de erro de parsing
+        print(f"ERRO: Falha ao fazer o parsing do XML '{_source_name(xml_file_path)}': {e}")
+        return _projetar(_DEFAULT_NFSE_DATA.copy(), campos) # Retorna dados padrão em caso de erro de parsing
     except Exception as e:
-        print(f"ERRO: Ocorreu um erro inesperado ao processar '{os.path.basename(xml_file_path)}': {e}")
-        return _DEFAULT_NFSE_DATA.copy() # Retorna dados padrão em caso de erro inesperado
\ No newline at end of file
+        print(f"ERRO: Ocorreu um erro inesperado ao processar '{_source_name(xml_file_path)}': {e}")
+        return _projetar(_DEFAULT_NFSE_DATA.copy(), campos) # Retorna dados padrão em caso de erro inesperado
+def nfse_fingerprint(data):
+    """
+    Impressão digital da NFS-e (da nota, não do arquivo): identifica a mesma nota em XMLs diferentes,
+    como reexportações do portal ou lotes sobrepostos. Usa o CNPJ/CPF do prestador com o Id da NFS-e
+    ou, sem ele, com o número e o código de verificação. Retorna None se não houver dados suficientes.
+    """
+    prestador = _clean_cnpj_cpf(data.get('Prestador.CpfCnpj')) or ''
+    nfse_id = str(data.get('Nfse.Id') or '').strip()
+    if nfse_id:
+        return f"{prestador}|id:{nfse_id}"
+    numero = str(data.get('Numero') or '').strip().lstrip('0')
+    codigo = str(data.get('CodigoVerificacao') or '').strip().upper()
+    if numero and codigo:
+        return f"{prestador}|{numero}|{codigo}"
+    return None
+
+def extract_xmls_from_zip(zip_source, zip_name="<ZIP>"):
+    """
+    Lê os arquivos .xml de um ZIP (caminho ou objeto de arquivo) como texto UTF-8.
+    Retorna a lista de (nome, conteúdo) e a lista de (nome, erro) dos que não puderam ser lidos.
+    """
+    xmls, errors = [], []
+    try:
+        with zipfile.ZipFile(zip_source) as archive:
+            for member in archive.infolist():
+                if member.is_dir() or not member.filename.lower().endswith(".xml"):
+                    continue
+                try:
+                    xmls.append((member.filename, archive.read(member).decode("utf-8")))
+                except UnicodeDecodeError as e:
+                    errors.append((f"{zip_name}/{member.filename}", e))
+    except zipfile.BadZipFile as e:
+        errors.append((zip_name, e))
+    return xmls, errors
@@ -0,0 +1,104 @@
+# nfse_perfil.py - Modo de medição (profiling) do viewer
+#
+# Quando o processamento fica lento, não dá para saber se o culpado é o parsing dos XMLs, o
+# format_dataframe_for_display, o detect_sequence_issues ou a renderização da página. Com o modo de
+# medição ligado (variável de ambiente NFSE_PERFIL=1 ou a chave na barra lateral do viewer):
+#   - cada etapa do processamento é cronometrada (medir_etapa) e a renderização de cada rerun é
+#     dividida em marcos (marco), exibidos em uma tabela na barra lateral;
+#   - opcionalmente, o processamento inteiro roda sob cProfile e tracemalloc (capturar_perfil), e os
+#     resultados vão para arquivos locais em DIRETORIO_PERFIS:
+#       <rótulo>-<data-hora>.prof  (pstats; abra com snakeviz ou python -m pstats)
+#       <rótulo>-<data-hora>.txt   (funções mais custosas e linhas que mais alocaram memória)
+# Desligado, medir_etapa e marco não fazem nada.
+
+import contextlib
+import cProfile
+import datetime
+import io
+import os
+import pstats
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+# ====== CONFIGURAÇÕES ======
+PERFIL_POR_PADRAO = os.environ.get("NFSE_PERFIL", "").strip().lower() in ("1", "true", "sim")
+DIRETORIO_PERFIS = os.environ.get("NFSE_PERFIS_DIR", os.path.join(tempfile.gettempdir(), "nfse_perfis"))
+LINHAS_RELATORIO = 30  # Funções (cProfile) e linhas (tracemalloc) listadas no relatório em texto
+
+
+# ====== CRONOMETRAGEM ======
+@contextlib.contextmanager
+def medir_etapa(medicoes, etapa):
+    """Cronometra o bloco e acrescenta {'Etapa', 'Segundos'} em medicoes (lista). Com medicoes None, só executa."""
+    if medicoes is None:
+        yield
+        return
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        medicoes.append({'Etapa': etapa, 'Segundos': time.perf_counter() - inicio})
+
+def iniciar_cronometro(ativo=True):
+    """Cronômetro de marcos (usado na renderização, onde as etapas são trechos seguidos do script), ou None."""
+    return {'medicoes': [], 'ultimo': time.perf_counter()} if ativo else None
+
+def marco(cronometro, etapa):
+    """Registra o tempo decorrido desde o marco anterior (ou do início) como a etapa informada."""
+    if cronometro is None:
+        return
+    agora = time.perf_counter()
+    cronometro['medicoes'].append({'Etapa': etapa, 'Segundos': agora - cronometro['ultimo']})
+    cronometro['ultimo'] = agora
+
+def tabela_etapas(medicoes):
+    """DataFrame das medições (etapas repetidas somadas, na ordem em que apareceram) com o % do total."""
+    if not medicoes:
+        return pd.DataFrame(columns=['Etapa', 'Segundos', '%'])
+    tabela = pd.DataFrame(medicoes).groupby('Etapa', sort=False, as_index=False)['Segundos'].sum()
+    total = tabela['Segundos'].sum()
+    tabela['%'] = (100 * tabela['Segundos'] / total).round(1) if total else 0.0
+    tabela['Segundos'] = tabela['Segundos'].round(3)
+    return tabela
+
+
+# ====== CAPTURA (cProfile + tracemalloc) ======
+@contextlib.contextmanager
+def capturar_perfil(rotulo, memoria=True, diretorio=None):
+    """
+    Executa o bloco sob cProfile (e tracemalloc, com memoria=True) e grava os arquivos .prof e .txt.
+    Produz um dicionário que, ao fim do bloco, traz os caminhos gravados em 'prof' e 'txt'.
+    """
+    diretorio = diretorio or DIRETORIO_PERFIS
+    os.makedirs(diretorio, exist_ok=True)
+    base = os.path.join(diretorio, f"{rotulo}-{datetime.datetime.now():%Y%m%d-%H%M%S}")
+    arquivos = {}
+    # Se outro código já estiver rastreando a memória, o rastreamento não é reiniciado nem encerrado aqui
+    rastrear_memoria = memoria and not tracemalloc.is_tracing()
+    if rastrear_memoria:
+        tracemalloc.start()
+    perfil = cProfile.Profile()
+    perfil.enable()
+    try:
+        yield arquivos
+    finally:
+        perfil.disable()
+        relatorio = io.StringIO()
+        if rastrear_memoria:
+            instantaneo = tracemalloc.take_snapshot()
+            _, pico = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            relatorio.write(f"Pico de memória rastreada: {pico / 2**20:.1f} MiB\n")
+            relatorio.write("Linhas que mais alocaram memória (ainda alocada ao fim da captura):\n")
+            for estatistica in instantaneo.statistics('lineno')[:LINHAS_RELATORIO]:
+                relatorio.write(f"  {estatistica}\n")
+            relatorio.write("\n")
+        perfil.dump_stats(base + ".prof")
+        estatisticas = pstats.Stats(perfil, stream=relatorio)
+        estatisticas.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(LINHAS_RELATORIO)
+        with open(base + ".txt", "w", encoding="utf-8") as f:
+            f.write(relatorio.getvalue())
+        arquivos.update({'prof': base + ".prof", 'txt': base + ".txt"})
@@ -0,0 +1,186 @@
+# nfse_relatorios.py - Pacote de relatórios do fechamento (todas as competências, por prestador)
+#
+# A seção 5 do viewer exporta só a competência selecionada. No fechamento, o pacote reúne em um
+# único ZIP uma pasta de trabalho Excel por competência e prestador, com as abas:
+#   - Notas: todas as notas (inclusive canceladas), valores numéricos;
+#   - Inconsistências: notas ativas com INCONSISTÊNCIA ou ATENÇÃO no status geral das retenções;
+#   - Sequência: problemas de sequência de NF do prestador na competência;
+#   - Resumo Impostos: painel de faturamento, retenções e estimativa de impostos a pagar.
+#
+# As pastas de trabalho são montadas em paralelo (ProcessPoolExecutor) e gravadas no ZIP à medida
+# que ficam prontas: só algumas partes ficam em trânsito por vez, e o ZIP vai direto para o destino
+# (arquivo ou buffer), sem juntar todas as planilhas na memória.
+
+import io
+import os
+import re
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import pandas as pd
+
+from nfse_conferencia import (
+    atualizar_conferencia,
+    base_conferencia,
+    compute_tax_panel,
+    filter_by_competence,
+    format_currency_columns,
+    unformat_currency_columns,
+)
+from nfse_analitico import carregar_competencia, listar_competencias
+
+# ====== CONFIGURAÇÕES ======
+PARTES_EM_TRANSITO_POR_PROCESSO = 2  # Partes enviadas e ainda não gravadas no ZIP, por processo
+
+COLUNAS_STATUS_RETENCAO = ['Status IR', 'Status CSLL', 'Status PIS', 'Status COFINS', 'Status ISS Retido']
+
+# Linhas da aba Resumo Impostos (chave do compute_tax_panel -> descrição)
+DESCRICAO_PAINEL = {
+    'total_faturamento': 'Total Faturamento Bruto',
+    'total_liquido_recebido': 'Valor Líquido Recebido (NFSe)',
+    'total_ir_retido': 'IR Retido',
+    'total_csll_retido': 'CSLL Retida',
+    'total_pis_retido': 'PIS Retido',
+    'total_cofins_retido': 'COFINS Retida',
+    'total_iss_retido': 'ISS Retido',
+    'base_calculo_issqn': 'Base de Cálculo ISSQN',
+    'irpj_a_pagar': 'IRPJ a Pagar',
+    'csll_a_pagar': 'CSLL a Pagar',
+    'pis_a_pagar': 'PIS a Pagar',
+    'cofins_a_pagar': 'COFINS a Pagar',
+    'issqn_a_pagar': 'ISSQN a Pagar',
+    'total_impostos_a_pagar': 'Total Impostos a Pagar',
+}
+
+
+# ====== PARTES (competência x prestador) ======
+def _prestador(df_parte):
+    """CNPJ e razão social do prestador da parte (o CNPJ vazio vira 'sem_cnpj')."""
+    cnpj = df_parte['Prestador CNPJ'].iloc[0]
+    razao = df_parte['Prestador Razão Social'].dropna()
+    return (str(cnpj) if pd.notna(cnpj) else 'sem_cnpj'), (str(razao.iloc[0]) if not razao.empty else '')
+
+def _dividir_por_prestador(competencia, df_competencia):
+    for _, df_parte in df_competencia.groupby(df_competencia['Prestador CNPJ'].astype(object).fillna('sem_cnpj'), sort=True):
+        yield (competencia, *_prestador(df_parte), df_parte)
+
+def partes_do_dataframe(df_full, faixas=None):
+    """
+    Partes do pacote a partir do DataFrame processado do viewer (colunas monetárias formatadas,
+    'Competência' em AAAA-MM). Com as faixas de indexar_competencias, cada competência é lida como
+    visão do df_full. Retorna a lista de (competência, CNPJ, razão social, notas).
+    """
+    partes = []
+    if faixas is not None:
+        for competencia in sorted(faixas):
+            df_competencia, _ = filter_by_competence(df_full, competencia, faixas)
+            partes.extend(_dividir_por_prestador(competencia, df_competencia))
+        return partes
+    df_valido = df_full[df_full['Competência'].notna()]
+    for competencia, df_competencia in df_valido.groupby(df_valido['Competência'].astype(str), sort=True):
+        partes.extend(_dividir_por_prestador(competencia, df_competencia))
+    return partes
+
+def contar_partes_do_conjunto(caminho):
+    """Número de partes do conjunto Parquet (partições prestador/competência), sem ler os arquivos."""
+    return sum(
+        1
+        for prestador in os.scandir(caminho) if prestador.is_dir()
+        for entrada in os.scandir(prestador.path) if entrada.is_dir() and entrada.name.startswith("competencia=")
+    )
+
+def partes_do_conjunto(caminho, regras):
+    """
+    Partes do pacote a partir do conjunto Parquet (modo de baixo uso de memória): cada competência
+    é lida, conferida com as regras informadas e formatada só quando chega a vez dela.
+    """
+    for competencia in sorted(listar_competencias(caminho)):
+        df_competencia = carregar_competencia(caminho, competencia)
+        atualizar_conferencia(df_competencia, base_conferencia(df_competencia), regras, format_currency=False)
+        yield from _dividir_por_prestador(competencia, format_currency_columns(df_competencia))
+
+
+# ====== PASTA DE TRABALHO DE UMA PARTE ======
+def _nome_arquivo(competencia, cnpj, razao):
+    """Caminho da pasta de trabalho no ZIP: <competência>/<CNPJ>_<razão social>.xlsx (sem caracteres inválidos)."""
+    razao = re.sub(r'[^\w\-]+', '_', razao, flags=re.UNICODE).strip('_')[:60]
+    cnpj = re.sub(r'\D+', '', cnpj) or 'sem_cnpj'
+    return f"{competencia}/{cnpj}{'_' + razao if razao else ''}.xlsx"
+
+def montar_pasta_trabalho(competencia, cnpj, razao, df_parte, df_sequencia, lucro_presumido_tipo="Normal", regras=None):
+    """Gera a pasta de trabalho (bytes .xlsx) de uma competência e prestador. Retorna (nome no ZIP, bytes)."""
+    df_ativas = df_parte[df_parte['Status Cancelamento'] == 'Não']
+    status_geral = df_ativas['Status Geral Retenções'].astype(str)
+    df_inconsistencias = df_ativas[status_geral.str.contains('INCONSISTÊNCIA|ATENÇÃO', na=False)]
+    colunas_inconsistencias = [
+        col for col in ['Número da NF', 'Tomador Razão Social', 'Valor dos Serviços', 'Status Geral Retenções', *COLUNAS_STATUS_RETENCAO]
+        if col in df_inconsistencias.columns
+    ]
+    painel = compute_tax_panel(df_ativas, lucro_presumido_tipo, regras)
+    df_resumo = pd.DataFrame({
+        'Item': ["Competência", "Prestador", "Notas (todas)", "Notas ativas", "Tipo de Lucro Presumido", *DESCRICAO_PAINEL.values()],
+        'Valor': [competencia, f"{razao} ({cnpj})", len(df_parte), len(df_ativas), lucro_presumido_tipo,
+                  *(round(float(painel[chave]), 2) for chave in DESCRICAO_PAINEL)],
+    })
+
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
+        unformat_currency_columns(df_parte).to_excel(writer, index=False, sheet_name='Notas')
+        unformat_currency_columns(df_inconsistencias[colunas_inconsistencias]).to_excel(writer, index=False, sheet_name='Inconsistências')
+        df_sequencia.to_excel(writer, index=False, sheet_name='Sequência')
+        df_resumo.to_excel(writer, index=False, sheet_name='Resumo Impostos')
+    return _nome_arquivo(competencia, cnpj, razao), buffer.getvalue()
+
+def _montar_pasta_trabalho_tarefa(argumentos):
+    return montar_pasta_trabalho(*argumentos)
+
+
+# ====== PACOTE (ZIP) ======
+def gerar_pacote_relatorios(partes, sequence_issues, destino, regras=None, lucro_presumido_tipo="Normal",
+                            processos=None, progresso=None, total=None):
+    """
+    Monta as pastas de trabalho das partes (ver partes_do_dataframe / partes_do_conjunto) em paralelo
+    e as grava no ZIP 'destino' (caminho ou arquivo aberto em modo binário) conforme ficam prontas.
+    progresso(feitos, total), se informado, é chamado a cada pasta gravada (total: len(partes) se
+    for uma lista, ou o valor informado). Retorna o número de pastas de trabalho no pacote.
+    """
+    processos = processos or os.cpu_count() or 1
+    total = len(partes) if total is None and isinstance(partes, list) else total
+    colunas_sequencia = list(sequence_issues.columns)
+    sequencia_por_parte = {}
+    if not sequence_issues.empty:
+        chaves = [sequence_issues['Competência'].astype(str), sequence_issues['Prestador CNPJ'].astype(object).fillna('sem_cnpj').astype(str)]
+        sequencia_por_parte = {chave: grupo for chave, grupo in sequence_issues.groupby(chaves, sort=False)}
+
+    def argumentos(parte):
+        competencia, cnpj, razao, df_parte = parte
+        df_sequencia = sequencia_por_parte.get((competencia, cnpj), pd.DataFrame(columns=colunas_sequencia))
+        return competencia, cnpj, razao, df_parte, df_sequencia, lucro_presumido_tipo, regras
+
+    feitos = 0
+    # As pastas .xlsx já são compactadas: ZIP_STORED evita comprimir de novo
+    with zipfile.ZipFile(destino, 'w', compression=zipfile.ZIP_STORED) as pacote:
+        def gravar(nome, conteudo):
+            nonlocal feitos
+            pacote.writestr(nome, conteudo)
+            feitos += 1
+            if progresso is not None:
+                progresso(feitos, total)
+
+        if processos == 1:
+            for parte in partes:
+                gravar(*_montar_pasta_trabalho_tarefa(argumentos(parte)))
+            return feitos
+
+        limite_em_transito = processos * PARTES_EM_TRANSITO_POR_PROCESSO
+        with ProcessPoolExecutor(processos) as executor:
+            em_transito = set()
+            for parte in partes:
+                em_transito.add(executor.submit(_montar_pasta_trabalho_tarefa, argumentos(parte)))
+                if len(em_transito) >= limite_em_transito:
+                    prontos, em_transito = wait(em_transito, return_when=FIRST_COMPLETED)
+                    for futuro in prontos:
+                        gravar(*futuro.result())
+            for futuro in wait(em_transito).done:
+                gravar(*futuro.result())
+    return feitos
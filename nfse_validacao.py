@@ -0,0 +1,183 @@
+# nfse_validacao.py - Validação dos XMLs de NFS-e (esquema XSD e campos obrigatórios)
+#
+# XML malformado ou fora do esquema não quebra o extract_nfse_data: ele devolve a linha padrão, toda
+# em None, que passa despercebida e contamina os totais. Aqui cada XML é validado junto com a
+# extração e o erro é descrito com precisão:
+#   1. XML bem formado (posição do erro de parsing);
+#   2. layout reconhecido (GISS ou GINFES);
+#   3. esquema XSD do layout, se o lxml estiver instalado e o XSD estiver em DIRETORIO_ESQUEMAS
+#      (os esquemas são compilados uma vez por processo e reaproveitados);
+#   4. campos obrigatórios presentes e valores/datas em formato válido.
+#
+# Os XSDs oficiais não acompanham o repositório: copie-os para esquemas/ (ver esquemas/LEIA-ME.md).
+# Sem lxml ou sem os XSDs, as etapas 1, 2 e 4 continuam valendo.
+#
+# Cada XML é parseado uma vez só: com algum esquema disponível, pelo lxml (a árvore validada pelo XSD
+# é a mesma da extração, cujas buscas no estilo ElementTree funcionam nos elementos do lxml); sem
+# esquema, pelo ElementTree.
+#
+# validar_e_extrair_lote distribui os arquivos entre processos (ProcessPoolExecutor); cada processo
+# compila os esquemas ao iniciar.
+
+import datetime
+import functools
+import os
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+
+from nfse_parser import detect_nfse_layout, extract_nfse_data_from_root
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:  # lxml é opcional: sem ele a validação por XSD é pulada
+    lxml_etree = None
+
+# ====== CONFIGURAÇÕES ======
+DIRETORIO_ESQUEMAS = os.environ.get(
+    "NFSE_ESQUEMAS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "esquemas")
+)
+
+# Arquivo XSD (em DIRETORIO_ESQUEMAS) que valida o documento inteiro de cada layout
+ESQUEMAS = {
+    'GISS': 'tipos-v2_04.xsd',
+    'GINFES': 'servico_consultar_nfse_resposta_v03.xsd',
+}
+
+# Campos sem os quais a linha da nota não serve para a conferência (chave do parser -> onde fica no XML)
+CAMPOS_OBRIGATORIOS = {
+    'Numero': 'InfNfse/Numero',
+    'DataEmissao': 'InfNfse/DataEmissao',
+    'Prestador.CpfCnpj': 'Prestador/CpfCnpj',
+    'ValorServicos': 'Servico/Valores/ValorServicos',
+}
+CAMPOS_NUMERICOS = [
+    'ValorServicos', 'ValorDeducoes', 'ValorPis', 'ValorCofins', 'ValorInss', 'ValorIr', 'ValorCsll',
+    'ValorIss', 'ValorIssRetido', 'OutrasRetencoes', 'BaseCalculo', 'Aliquota', 'ValorLiquidoNfse',
+]
+
+# Arquivos por tarefa enviada aos processos (menos ida e volta entre processos)
+ARQUIVOS_POR_TAREFA = 50
+
+
+# ====== ESQUEMAS XSD ======
+@functools.lru_cache(maxsize=None)
+def carregar_esquema(layout):
+    """Esquema XSD compilado do layout (uma vez por processo), ou None sem lxml ou sem o arquivo."""
+    arquivo = ESQUEMAS.get(layout)
+    if lxml_etree is None or arquivo is None:
+        return None
+    caminho = os.path.join(DIRETORIO_ESQUEMAS, arquivo)
+    if not os.path.exists(caminho):
+        return None
+    return lxml_etree.XMLSchema(lxml_etree.parse(caminho))
+
+def esquemas_disponiveis():
+    """Layouts cujo XSD será usado na validação."""
+    return [layout for layout in ESQUEMAS if carregar_esquema(layout) is not None]
+
+def _parsear(xml_bytes):
+    """
+    Raiz do XML: pelo lxml se algum esquema estiver disponível (a mesma árvore vai para o XSD), senão
+    pelo ElementTree. Comentários e instruções de processamento são descartados, como no ElementTree.
+    XML malformado gera SyntaxError (ET.ParseError e XMLSyntaxError derivam dele).
+    """
+    if not esquemas_disponiveis():
+        return ET.fromstring(xml_bytes)
+    # Um parser por chamada: instâncias do XMLParser não podem ser compartilhadas entre threads (nfse_api)
+    parser = lxml_etree.XMLParser(resolve_entities=False, no_network=True, remove_comments=True, remove_pis=True)
+    return lxml_etree.fromstring(xml_bytes, parser)
+
+def _erros_esquema(layout, root):
+    """Erros do XSD do layout ('linha N: mensagem'); lista vazia se válido ou sem esquema disponível."""
+    esquema = carregar_esquema(layout)
+    if esquema is None:
+        return []
+    if esquema.validate(root):
+        return []
+    return [f"linha {erro.line}: {erro.message}" for erro in esquema.error_log]
+
+
+# ====== CAMPOS ======
+def _erros_campos(data):
+    """
+    Campos obrigatórios ausentes e valores numéricos ou datas em formato inválido. Numa extração
+    com projeção, só os campos extraídos (chaves de data) são verificados.
+    """
+    erros = [
+        f"campo obrigatório ausente: {caminho}"
+        for campo, caminho in CAMPOS_OBRIGATORIOS.items()
+        if campo in data and data.get(campo) in (None, '')
+    ]
+    for campo in CAMPOS_NUMERICOS:
+        valor = data.get(campo)
+        if valor in (None, ''):
+            continue
+        try:
+            float(valor)
+        except ValueError:
+            erros.append(f"valor numérico inválido em {campo}: '{valor}'")
+    if data.get('DataEmissao'):
+        try:
+            datetime.datetime.fromisoformat(str(data['DataEmissao'])[:19])
+        except ValueError:
+            erros.append(f"data inválida em DataEmissao: '{data['DataEmissao']}'")
+    return erros
+
+
+# ====== VALIDAÇÃO + EXTRAÇÃO ======
+def validar_e_extrair(nome, xml_content, campos=None):
+    """
+    Valida e extrai um XML (texto ou bytes). Retorna (nome, data, erros): data é o dicionário do
+    extract_nfse_data (None se o XML não pôde ser lido) e erros a lista de problemas encontrados.
+    campos: projeção repassada à extração (ver extract_nfse_data); campo desconhecido gera ValueError.
+    """
+    xml_bytes = xml_content.encode("utf-8") if isinstance(xml_content, str) else xml_content
+    try:
+        root = _parsear(xml_bytes)
+    except SyntaxError as e:
+        return nome, None, [f"XML malformado: {e}"]
+
+    layout = detect_nfse_layout(root)
+    if layout is None:
+        return nome, None, [f"layout não reconhecido (raiz <{root.tag}>)"]
+
+    erros = _erros_esquema(layout, root)
+    try:
+        data = extract_nfse_data_from_root(root, nome, campos)
+    except ValueError:  # Projeção com campo desconhecido: erro da requisição, não do XML
+        raise
+    except Exception as e:
+        return nome, None, erros + [f"falha na extração ({layout}): {type(e).__name__}: {e}"]
+    return nome, data, erros + _erros_campos(data)
+
+def _validar_e_extrair_tarefa(arquivos):
+    return [validar_e_extrair(nome, xml_content) for nome, xml_content in arquivos]
+
+def _iniciar_processo():
+    """Inicializador dos processos: compila os esquemas antes do primeiro arquivo."""
+    esquemas_disponiveis()
+
+def validar_e_extrair_lote(arquivos, processos=None, progresso=None):
+    """
+    Valida e extrai uma lista de (nome, xml_content), em paralelo quando houver mais de um núcleo.
+    progresso(feitos, total), se informado, é chamado a cada tarefa concluída.
+    Retorna a lista de (nome, data, erros) na ordem de 'arquivos'.
+    """
+    processos = processos or os.cpu_count() or 1
+    tarefas = [arquivos[i:i + ARQUIVOS_POR_TAREFA] for i in range(0, len(arquivos), ARQUIVOS_POR_TAREFA)]
+    resultados = []
+
+    def acumular(parcial):
+        resultados.extend(parcial)
+        if progresso is not None:
+            progresso(len(resultados), len(arquivos))
+
+    if processos == 1 or len(tarefas) <= 1:
+        for tarefa in tarefas:
+            acumular(_validar_e_extrair_tarefa(tarefa))
+        return resultados
+
+    with ProcessPoolExecutor(processos, initializer=_iniciar_processo) as executor:
+        for parcial in executor.map(_validar_e_extrair_tarefa, tarefas):
+            acumular(parcial)
+    return resultados
@@ -0,0 +1,34 @@
+# conftest.py - Ambiente isolado para os testes
+#
+# O nfse_db cria o banco (NFSE_DB_PATH) e lê o diretório das partições ao ser importado; por isso
+# as variáveis de ambiente são definidas aqui, antes de qualquer import dos módulos do projeto,
+# apontando para um diretório temporário (o database.db do repositório nunca é tocado).
+
+import os
+import sys
+import tempfile
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+sys.path.insert(0, os.path.join(RAIZ, "benchmarks"))
+
+_DIRETORIO_TESTES = tempfile.mkdtemp(prefix="nfse_testes_")
+os.environ["NFSE_DB_PATH"] = os.path.join(_DIRETORIO_TESTES, "database.db")
+os.environ["NFSE_PARTICOES_DIR"] = os.path.join(_DIRETORIO_TESTES, "particoes")
+os.environ["NFSE_REGRAS_PATH"] = os.path.join(_DIRETORIO_TESTES, "regras_tributarias.json")
+os.environ["NFSE_ANALITICO_DIR"] = os.path.join(_DIRETORIO_TESTES, "analitico")
+
+# XML GISS mínimo (layout reconhecido por extract_nfse_data); use XML_GISS.format(...)
+XML_GISS = """<?xml version="1.0" encoding="UTF-8"?>
+<ns2:CompNfse xmlns:ns2="http://www.giss.com.br/tipos-v2_04.xsd">
+<ns2:Nfse versao="2.04"><ns2:InfNfse Id="nfse{numero}"><ns2:Numero>{numero}</ns2:Numero><ns2:CodigoVerificacao>ABC{numero}</ns2:CodigoVerificacao><ns2:DataEmissao>{data}T10:00:00</ns2:DataEmissao>
+<ns2:ValoresNfse><ns2:BaseCalculo>{valor}</ns2:BaseCalculo><ns2:Aliquota>2.00</ns2:Aliquota><ns2:ValorLiquidoNfse>{valor}</ns2:ValorLiquidoNfse></ns2:ValoresNfse>
+<ns2:PrestadorServico><ns2:RazaoSocial>CLINICA TESTE LTDA</ns2:RazaoSocial></ns2:PrestadorServico>
+<ns2:DeclaracaoPrestacaoServico><ns2:InfDeclaracaoPrestacaoServico>
+<ns2:Servico><ns2:Valores><ns2:ValorServicos>{valor}</ns2:ValorServicos><ns2:ValorIss>0</ns2:ValorIss><ns2:Aliquota>2.00</ns2:Aliquota></ns2:Valores><ns2:IssRetido>2</ns2:IssRetido><ns2:ItemListaServico>4.03</ns2:ItemListaServico><ns2:Discriminacao>Consulta {numero}</ns2:Discriminacao><ns2:CodigoMunicipio>3550308</ns2:CodigoMunicipio></ns2:Servico>
+<ns2:Prestador><ns2:CpfCnpj><ns2:Cnpj>11222333000144</ns2:Cnpj></ns2:CpfCnpj></ns2:Prestador>
+<ns2:TomadorServico><ns2:IdentificacaoTomador><ns2:CpfCnpj><ns2:Cnpj>99888777000166</ns2:Cnpj></ns2:CpfCnpj></ns2:IdentificacaoTomador><ns2:RazaoSocial>TOMADOR SA</ns2:RazaoSocial></ns2:TomadorServico>
+<ns2:OptanteSimplesNacional>2</ns2:OptanteSimplesNacional>
+</ns2:InfDeclaracaoPrestacaoServico></ns2:DeclaracaoPrestacaoServico></ns2:InfNfse></ns2:Nfse>
+</ns2:CompNfse>
+"""
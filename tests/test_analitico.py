@@ -0,0 +1,40 @@
+# test_analitico.py - Limpeza dos conjuntos Parquet abandonados (nfse_analitico)
+
+import os
+import time
+
+import pandas as pd
+
+from nfse_analitico import apagar_conjuntos_abandonados, conjunto_disponivel, gravar_conjunto, listar_competencias
+
+
+def _notas():
+    return pd.DataFrame({
+        'Prestador CNPJ': ['11222333000144', '11222333000144'],
+        'Competência': ['2026-01', '2026-02'],
+        'Status Cancelamento': ['Não', 'Não'],
+        'Valor dos Serviços': [1000.0, 500.0],
+    })
+
+
+def _envelhecer(caminho, horas):
+    instante = time.time() - horas * 3600
+    os.utime(caminho, (instante, instante))
+
+
+def test_gravar_conjunto_apaga_so_os_abandonados(tmp_path):
+    abandonado = gravar_conjunto(_notas(), diretorio=str(tmp_path))
+    em_uso = gravar_conjunto(_notas(), diretorio=str(tmp_path))
+    outro = tmp_path / "nao_e_conjunto"
+    outro.mkdir()
+    for caminho in (abandonado, em_uso, str(outro)):
+        _envelhecer(caminho, 48)
+
+    # A leitura marca o uso: o conjunto da sessão ativa sai do prazo de limpeza
+    assert listar_competencias(em_uso) == ['2026-02', '2026-01']
+    novo = gravar_conjunto(_notas(), diretorio=str(tmp_path))
+
+    assert not conjunto_disponivel(abandonado)
+    assert conjunto_disponivel(em_uso) and conjunto_disponivel(novo)
+    assert outro.is_dir()  # Só diretórios com nome de conjunto (uuid) são apagados
+    assert apagar_conjuntos_abandonados(str(tmp_path)) == 0
@@ -0,0 +1,58 @@
+# test_api.py - Serviço HTTP: XMLs inválidos ficam fora da conferência; o caminho leve de uma nota
+# (conferir_registro) devolve o mesmo que a conferência vetorizada
+
+import pandas as pd
+import pytest
+
+from conftest import XML_GISS
+from nfse_api import _dataframe_para_registros, conferir_registros, extrair_registros
+from nfse_conferencia import format_dataframe_for_display
+
+XMLS = [
+    ("1.xml", XML_GISS.format(numero=1, data="2026-01-10", valor="1000.00")),
+    ("3.xml", XML_GISS.format(numero=3, data="2026-01-12", valor="500.00")),
+    ("quebrado.xml", "<ns2:CompNfse><ns2:Nfse>"),
+    ("outro_layout.xml", "<?xml version='1.0'?><Recibo><Numero>7</Numero></Recibo>"),
+]
+
+
+def test_xmls_invalidos_ficam_em_erros():
+    registros, erros = extrair_registros(XMLS)
+    assert [r["arquivo"] for r in registros] == ["1.xml", "3.xml"]
+    assert [nome for nome, _ in erros] == ["quebrado.xml", "outro_layout.xml"]
+    assert "malformado" in erros[0][1] and "layout não reconhecido" in erros[1][1]
+
+    resultado = conferir_registros(registros)
+    assert len(resultado["notas"]) == 2
+
+
+def test_projecao_so_verifica_campos_extraidos():
+    registros, erros = extrair_registros(XMLS, campos=["Numero", "DataEmissao"])
+    assert [r["arquivo"] for r in registros] == ["1.xml", "3.xml"]
+    assert set(registros[0]) == {"arquivo", "Numero", "DataEmissao"}
+    assert len(erros) == 2
+
+
+CANCELAMENTO = ("</ns2:Nfse>", "</ns2:Nfse><ns2:NfseCancelamento><ns2:Confirmacao><ns2:DataHora>"
+                "2026-01-20T10:00:00</ns2:DataHora></ns2:Confirmacao></ns2:NfseCancelamento>")
+
+
+@pytest.mark.parametrize("trocas", [
+    [],  # Lucro Presumido, tomador PJ, sem IR retido (divergência)
+    [("<ns2:OptanteSimplesNacional>2<", "<ns2:OptanteSimplesNacional>1<")],
+    [("99888777000166", "12345678901")],  # Tomador pessoa física
+    [("<ns2:IssRetido>2<", "<ns2:IssRetido>1<"), ("<ns2:ValorIss>0<", "<ns2:ValorIss>20.00<")],
+    [("<ns2:ValorServicos>1000.00<", "<ns2:ValorServicos>100.00<")],  # Abaixo dos limites de retenção
+    [CANCELAMENTO],
+])
+def test_conferencia_de_uma_nota_igual_a_vetorizada(trocas):
+    xml = XML_GISS.format(numero=50, data="2026-01-10", valor="1000.00")
+    for antigo, novo in trocas:
+        xml = xml.replace(antigo, novo)
+    (registro,), _ = extrair_registros([("nota.xml", xml)])
+
+    esperado = _dataframe_para_registros(format_dataframe_for_display(pd.DataFrame([registro]), format_currency=False))
+    resultado = conferir_registros([registro])
+    assert resultado["notas"] == esperado
+    assert list(resultado["notas"][0]) == list(esperado[0])
+    assert resultado["problemas_sequencia"] == []
@@ -0,0 +1,101 @@
+# test_numeracao.py - Índice de numeração por prestador (numeros_emitidos / lacunas_numeracao)
+
+from conftest import XML_GISS
+from nfse_db import (
+    NFSe, NumeroEmitido, NumeracaoPrestador, comprimir_xml, engine, hash_xml, lacunas_abertas,
+    numeros_cancelados, numeros_repetidos, preencher_campos_pendentes, reconstruir_indice_numeracao, resumo_numeracao,
+    salvar_lote_nfse, session_scope,
+)
+
+# Um prestador por teste: o banco de testes é compartilhado entre os módulos
+PRESTADOR_REPETIDOS = "55666777000188"
+PRESTADOR_LACUNAS = "55666777000269"
+PRESTADOR_PENDENTES = "55666777000340"
+PRESTADOR_RECONSTRUCAO = "55666777000420"
+
+CANCELAMENTO = ("</ns2:Nfse>", "</ns2:Nfse><ns2:NfseCancelamento><ns2:Confirmacao><ns2:DataHora>"
+                "2025-02-20T10:00:00</ns2:DataHora></ns2:Confirmacao></ns2:NfseCancelamento>")
+
+
+def _xml(prestador, numero, id_nfse=None, data="2025-02-10"):
+    xml = XML_GISS.format(numero=numero, data=data, valor="500.00").replace("11222333000144", prestador)
+    if id_nfse is not None:
+        # Outra nota com o mesmo número (Id e código de verificação diferentes)
+        xml = xml.replace(f'Id="nfse{numero}"', f'Id="{id_nfse}"').replace(f"ABC{numero}", f"XYZ{id_nfse}")
+    return xml
+
+
+def test_numero_repetido_no_mesmo_lote():
+    def xml(*args, **kwargs):
+        return _xml(PRESTADOR_REPETIDOS, *args, **kwargs)
+
+    with session_scope() as session:
+        resultado = salvar_lote_nfse(session, "Cliente", [("a.xml", xml(5)), ("b.xml", xml(5, id_nfse="outra5"))])
+        assert sorted(resultado['inseridos']) == ["a.xml", "b.xml"]
+        assert numeros_repetidos(session, PRESTADOR_REPETIDOS) == [(5, 2)]
+
+    # Nova repetição em outro lote continua contando
+    with session_scope() as session:
+        salvar_lote_nfse(session, "Cliente", [("c.xml", xml(5, id_nfse="terceira5"))])
+        assert numeros_repetidos(session, PRESTADOR_REPETIDOS) == [(5, 3)]
+
+
+def test_lacunas_abertas_e_fechadas():
+    def xml(numero):
+        return _xml(PRESTADOR_LACUNAS, numero)
+
+    with session_scope() as session:
+        salvar_lote_nfse(session, "Cliente", [("n5.xml", xml(5)), ("n10.xml", xml(10)), ("n7.xml", xml(7))])
+        assert lacunas_abertas(session, PRESTADOR_LACUNAS) == [(6, 6), (8, 9)]
+        salvar_lote_nfse(session, "Cliente", [("n8.xml", xml(8)), ("n2.xml", xml(2))])
+        assert lacunas_abertas(session, PRESTADOR_LACUNAS) == [(3, 4), (6, 6), (9, 9)]
+        (linha,) = [linha for linha in resumo_numeracao(session) if linha[0] == PRESTADOR_LACUNAS]
+        assert linha[1:3] == (2, 10)
+
+
+def test_preencher_campos_pendentes_com_numero_repetido():
+    # Registros gravados sem os campos (bancos anteriores a nfse_campos): o índice é montado no preenchimento
+    with session_scope() as session:
+        for numero, id_nfse in [(20, None), (20, "outra20"), (22, None)]:
+            xml = _xml(PRESTADOR_PENDENTES, numero, id_nfse=id_nfse)
+            session.add(NFSe(cliente="Cliente", data_envio="2025-02-11 09:00:00", xml_hash=hash_xml(xml),
+                             xml_comprimido=comprimir_xml(xml)))
+    with session_scope() as session:
+        assert preencher_campos_pendentes(session) == 3
+        assert numeros_repetidos(session, PRESTADOR_PENDENTES) == [(20, 2)]
+        assert lacunas_abertas(session, PRESTADOR_PENDENTES) == [(21, 21)]
+
+
+def _indice(session, prestador):
+    return (
+        session.query(NumeroEmitido.numero, NumeroEmitido.ocorrencias, NumeroEmitido.cancelada)
+        .filter(NumeroEmitido.prestador_cpf_cnpj == prestador).order_by(NumeroEmitido.numero).all(),
+        lacunas_abertas(session, prestador),
+        session.query(NumeracaoPrestador.menor_numero, NumeracaoPrestador.maior_numero)
+        .filter(NumeracaoPrestador.prestador_cpf_cnpj == prestador).all(),
+    )
+
+
+def test_indice_incremental_igual_a_reconstrucao():
+    lotes = [
+        [("r40.xml", 40), ("r43.xml", 43)],
+        [("r38.xml", 38), ("r43b.xml", 43, "outra43"), ("r47.xml", 47)],
+        [("r41c.xml", 41, None, True), ("r45.xml", 45), ("r38b.xml", 38, "outra38", True)],
+    ]
+    for lote in lotes:
+        arquivos = []
+        for nome, numero, *extra in lote:
+            id_nfse, cancelada = (extra + [None, False])[:2]
+            xml = _xml(PRESTADOR_RECONSTRUCAO, numero, id_nfse=id_nfse)
+            arquivos.append((nome, xml.replace(*CANCELAMENTO) if cancelada else xml))
+        with session_scope() as session:
+            salvar_lote_nfse(session, "Cliente", arquivos)
+
+    with session_scope() as session:
+        incremental = _indice(session, PRESTADOR_RECONSTRUCAO)
+        assert numeros_cancelados(session, PRESTADOR_RECONSTRUCAO) == [38, 41]
+    with engine.begin() as conn:
+        reconstruir_indice_numeracao(conn)
+    with session_scope() as session:
+        assert _indice(session, PRESTADOR_RECONSTRUCAO) == incremental
+        assert incremental[1] == [(39, 39), (42, 42), (44, 44), (46, 46)]
@@ -0,0 +1,26 @@
+# test_orcamento_memoria.py - Orçamento de memória dos reruns do viewer (AppTest)
+#
+# Cada rerun (troca de competência, colunas, lucro presumido, re-conferência) deve exibir visões do
+# DataFrame da sessão, sem copiá-lo inteiro. O pico rastreado (tracemalloc) de cada interação é
+# comparado com uma fração do tamanho do conjunto carregado.
+#
+# Com poucas notas o custo fixo do script (widgets, gráficos, ~3,5 MiB) esconde uma cópia do
+# DataFrame; com 5 mil notas (~11 MiB) os reruns ficam em ~0,35x o conjunto, e uma cópia inteira
+# a cada rerun leva o pico para ~0,65x.
+
+import logging
+
+from bench_rerun import run_reruns, verificar_orcamento
+
+NOTAS = 5_000
+ORCAMENTO = 0.5  # Pico máximo por rerun, em múltiplos do tamanho do conjunto carregado
+
+
+def test_reruns_dentro_do_orcamento_de_memoria():
+    logging.disable(logging.WARNING)
+    try:
+        records, dataset_mib = run_reruns(NOTAS, repeats=1, measure_memory=True)
+    finally:
+        logging.disable(logging.NOTSET)
+    assert any(r['peak_mib'] is not None for r in records)
+    assert verificar_orcamento(records, dataset_mib, ORCAMENTO) == []
@@ -0,0 +1,30 @@
+# test_particoes.py - Notas de anos arquivados (particoes/nfse_<ano>.db) não podem ser regravadas
+
+from conftest import XML_GISS
+from nfse_db import NFSe, arquivar_ano, salvar_lote_nfse, salvar_nfse, session_scope
+
+
+def _xml(numero, data="2024-03-10", valor="1000.00"):
+    return XML_GISS.format(numero=numero, data=data, valor=valor)
+
+
+def test_reenvio_de_nota_arquivada_e_duplicado():
+    xml = _xml(9001)
+    with session_scope() as session:
+        assert salvar_lote_nfse(session, "Cliente", [("original.xml", xml)])['inseridos'] == ["original.xml"]
+    assert arquivar_ano(2024) == 1
+
+    # Mesmo arquivo (xml_hash) e mesma nota reexportada com outra formatação (canônico / impressão digital)
+    reexportado = xml.replace("<ns2:Nfse versao", "\n  <ns2:Nfse versao")
+    with session_scope() as session:
+        antes = session.query(NFSe).count()  # O banco de testes é compartilhado entre os módulos
+        resultado = salvar_lote_nfse(session, "Cliente", [("again.xml", xml), ("reexportado.xml", reexportado)])
+        assert resultado['inseridos'] == []
+        assert sorted(resultado['duplicados']) == ["again.xml", "reexportado.xml"]
+        assert salvar_nfse(session, "Cliente", xml, "again.xml") is None
+        assert salvar_nfse(session, "Cliente", reexportado, "reexportado.xml") is None
+        assert session.query(NFSe).count() == antes
+
+    # Nota nova do mesmo ano arquivado continua sendo gravada no banco principal
+    with session_scope() as session:
+        assert salvar_lote_nfse(session, "Cliente", [("nova.xml", _xml(9002))])['inseridos'] == ["nova.xml"]
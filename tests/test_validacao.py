@@ -0,0 +1,70 @@
+# test_validacao.py - Com esquema XSD disponível, cada XML é parseado uma vez só (pelo lxml)
+
+import xml.etree.ElementTree as ET
+
+import pytest
+
+import nfse_validacao
+from conftest import XML_GISS
+from nfse_validacao import validar_e_extrair
+
+pytest.importorskip("lxml")
+
+# XSD mínimo do layout GISS: CompNfse com uma Nfse (conteúdo livre) e o cancelamento opcional
+XSD_GISS = """<?xml version="1.0" encoding="UTF-8"?>
+<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema" xmlns:ns2="http://www.giss.com.br/tipos-v2_04.xsd"
+           targetNamespace="http://www.giss.com.br/tipos-v2_04.xsd" elementFormDefault="qualified">
+  <xs:complexType name="Livre">
+    <xs:sequence><xs:any processContents="skip" minOccurs="0" maxOccurs="unbounded"/></xs:sequence>
+    <xs:anyAttribute processContents="skip"/>
+  </xs:complexType>
+  <xs:element name="CompNfse">
+    <xs:complexType><xs:sequence>
+      <xs:element name="Nfse" type="ns2:Livre"/>
+      <xs:element name="NfseCancelamento" type="ns2:Livre" minOccurs="0"/>
+    </xs:sequence></xs:complexType>
+  </xs:element>
+</xs:schema>
+"""
+XML = XML_GISS.format(numero=12, data="2026-01-10", valor="1000.00")
+
+
+def _usar_esquemas(diretorio, monkeypatch):
+    monkeypatch.setattr(nfse_validacao, "DIRETORIO_ESQUEMAS", str(diretorio))
+    nfse_validacao.carregar_esquema.cache_clear()  # Os esquemas compilados ficam em cache por processo
+
+
+@pytest.fixture(autouse=True)
+def _limpar_cache_esquemas():
+    yield
+    nfse_validacao.carregar_esquema.cache_clear()
+
+
+def test_com_esquema_o_xml_e_parseado_uma_vez(tmp_path, monkeypatch):
+    _usar_esquemas(tmp_path, monkeypatch)  # Diretório vazio: sem esquema, extração pelo ElementTree
+    _, esperado, erros = validar_e_extrair("nota.xml", XML)
+    assert erros == [] and esperado["Numero"] == "12"
+
+    (tmp_path / nfse_validacao.ESQUEMAS['GISS']).write_text(XSD_GISS, encoding="utf-8")
+    _usar_esquemas(tmp_path, monkeypatch)
+
+    # A árvore do lxml serve à validação e à extração: o ElementTree não pode ser chamado
+    def fromstring_proibido(*args, **kwargs):
+        raise AssertionError("XML parseado duas vezes")
+
+    monkeypatch.setattr(ET, "fromstring", fromstring_proibido)
+    _, data, erros = validar_e_extrair("nota.xml", XML)
+    assert erros == []
+    assert data == esperado
+
+
+def test_com_esquema_aponta_erros_de_esquema_e_de_parsing(tmp_path, monkeypatch):
+    (tmp_path / nfse_validacao.ESQUEMAS['GISS']).write_text(XSD_GISS, encoding="utf-8")
+    _usar_esquemas(tmp_path, monkeypatch)
+
+    fora_do_esquema = XML.replace('<ns2:Nfse versao', '<ns2:Outro/><ns2:Nfse versao')
+    _, data, erros = validar_e_extrair("fora.xml", fora_do_esquema)
+    assert data is not None and len(erros) == 1 and erros[0].startswith("linha 3:")
+
+    _, data, erros = validar_e_extrair("quebrado.xml", XML[:200])
+    assert data is None and erros[0].startswith("XML malformado:")